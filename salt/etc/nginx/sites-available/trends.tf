@@ -67,6 +67,9 @@ server {
 		expires    365d;
 		add_header Cache-Control "immutable";
 		access_log off;
+		# Precompressed by trends.site.assets
+		gzip_static   on;
+		brotli_static on;
 	}
 
 	# favicon.ico
@@ -24,6 +24,7 @@ setuptools.setup(
     install_requires = [
         'flask >= 2.0',
         'mpmetrics',
+        'numpy',
         'prometheus-flask-exporter',
         'psycopg2',
         'pylibmc',
@@ -0,0 +1,25 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import gzip
+import json
+import shutil
+
+import zstandard
+
+from trends.site.assets import build, hash_files, load_manifest
+
+def test_build(tmp_path):
+    static = tmp_path / 'static'
+    shutil.copytree('trends/site/static', static)
+    manifest = build(static)
+
+    assert 'css/style.css' in manifest
+    assert manifest == hash_files(static) == load_manifest(static)
+    assert json.loads((static / 'manifest.json').read_text()) == manifest
+
+    style = (static / 'css/style.css').read_bytes()
+    assert gzip.decompress((static / 'css/style.css.gz').read_bytes()) == style
+    assert zstandard.ZstdDecompressor().decompress(
+        (static / 'css/style.css.zst').read_bytes()) == style
+    assert not (static / 'img/logo.png.gz').exists()
@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import pytest
+
+import trends.importer.backfill
+from trends.importer.backfill import backfill, get_checkpoint
+from trends.sql import db_connect
+
+def extract_map(log):
+    if log['info']['map'] == "":
+        return None
+    return (log['info']['map'],)
+
+def run(database, **kwargs):
+    with db_connect(database.url()) as c:
+        return backfill(c, 'test', extract_map, (('map', 'TEXT'),),
+                        ("INSERT INTO backfill_test SELECT * FROM backfill;",), jobs=2,
+                        batch_size=3, **kwargs)
+
+def test_backfill(database, monkeypatch):
+    with db_connect(database.url()) as c:
+        cur = c.cursor()
+        cur.execute("CREATE TABLE backfill_test (logid INT PRIMARY KEY, map TEXT NOT NULL);")
+        cur.execute("""SELECT
+                           logid,
+                           data->'info'->>'map'
+                       FROM log_json
+                       WHERE data->'info'->>'map' != ''
+                       ORDER BY logid;""")
+        expected = cur.fetchall()
+
+    partitions = 0
+    def copy_rows(cur, table, columns, rows):
+        # Interrupt the backfill after a few (non-empty) partitions
+        nonlocal partitions
+        rows = list(rows)
+        if rows:
+            if partitions == 3:
+                raise KeyboardInterrupt()
+            partitions += 1
+        return orig_copy_rows(cur, table, columns, rows)
+
+    orig_copy_rows = trends.importer.backfill.copy_rows
+    monkeypatch.setattr(trends.importer.backfill, 'copy_rows', copy_rows)
+    with pytest.raises(KeyboardInterrupt):
+        run(database)
+    monkeypatch.undo()
+
+    try:
+        with db_connect(database.url()) as c:
+            cur = c.cursor()
+            checkpoint = get_checkpoint(cur, 'test')
+            cur.execute("SELECT logid, map FROM backfill_test ORDER BY logid;")
+            partial = cur.fetchall()
+        assert partial
+        assert partial == [row for row in expected if row[0] < checkpoint]
+        assert partial != expected
+
+        assert run(database) == len(expected) - len(partial)
+        with db_connect(database.url()) as c:
+            cur = c.cursor()
+            cur.execute("SELECT logid, map FROM backfill_test ORDER BY logid;")
+            assert cur.fetchall() == expected
+
+            # Restarting processes everything again (and would fail on duplicates)
+            cur.execute("TRUNCATE backfill_test;")
+        assert run(database, restart=True) == len(expected)
+    finally:
+        with db_connect(database.url()) as c:
+            cur = c.cursor()
+            cur.execute("DROP TABLE backfill_test;")
+            cur.execute("DELETE FROM backfill_progress WHERE name = 'test';")
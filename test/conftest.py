@@ -12,8 +12,9 @@ from testing.postgresql import Postgresql
 import trends.importer.logs
 import trends.importer.etf2l
 import trends.importer.link_matches
+import trends.importer.summaries
 from trends.importer.fetch import ETF2LFileFetcher, FileFetcher
-from trends.sql import db_connect, db_init, db_schema
+from trends.sql import create_partitions, db_connect, db_init, db_schema
 
 @contextmanager
 def caplog_session(request):
@@ -71,15 +72,14 @@ def database(request):
         with db_connect(database.url()) as c:
             cur = c.cursor()
             cur.execute("ANALYZE;")
-            # A second time to test partitioning log_json
-            db_init(c)
-            cur.execute("REFRESH MATERIALIZED VIEW leaderboard_cube;")
+            create_partitions(c)
             cur.execute("REFRESH MATERIALIZED VIEW map_popularity;")
 
         with db_connect(database.url()) as c:
             class args:
                 since = datetime.fromtimestamp(0)
             trends.importer.link_matches.link_matches(args, c)
+            trends.importer.summaries.rank_leaderboard(None, c)
 
         yield database
 
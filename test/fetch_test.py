@@ -2,6 +2,7 @@
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
 from datetime import datetime
+import io
 import re
 import json
 
@@ -10,7 +11,8 @@ from hypothesis import given, strategies as st
 import pytest
 import responses, responses.registries
 
-from trends.importer.fetch import ListFetcher, BulkFetcher, ReverseFetcher, DemoBulkFetcher
+from trends.importer.fetch import ListFetcher, BulkFetcher, ReverseFetcher, DemoBulkFetcher, \
+                                  json_items
 
 def response_200(logid):
     return responses.Response(method=responses.GET, url=f"https://logs.tf/api/v1/log/{logid}",
@@ -179,3 +181,21 @@ def test_demo(args):
         if last_demoid is not None:
             assert demoid < last_demoid
         last_demoid = demoid
+
+json_values = st.recursive(st.none() | st.booleans() | st.floats(allow_nan=False) | st.text()
+                           | st.integers(), lambda children: st.lists(children)
+                           | st.dictionaries(st.text(), children), max_leaves=10)
+
+@given(items=st.lists(json_values), before=st.dictionaries(st.text(), json_values),
+       after=st.dictionaries(st.text(), json_values), size=st.integers(1, 64),
+       indent=st.none() | st.integers(0, 2))
+def test_json_items(items, before, after, size, indent):
+    assert list(json_items(io.StringIO(json.dumps(items, indent=indent)), size=size)) == items
+
+    before.pop('items', None)
+    after.pop('items', None)
+    data = before | { 'items': items } | after
+    rest = {}
+    assert list(json_items(io.StringIO(json.dumps(data, indent=indent)), 'items', rest,
+                           size=size)) == items
+    assert rest == { k: v for k, v in data.items() if k != 'items' }
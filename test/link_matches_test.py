@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import time
+
+from trends.importer.link_matches import FETCHED_WINDOW, MATCH_WINDOW, get_since
+from trends.sql import db_connect
+
+def test_since(database):
+    with db_connect(database.url()) as c:
+        cur = c.cursor()
+        # Matches are fetched when the fixtures' files were modified, which may be recent
+        cur.execute("UPDATE match SET fetched = %s;", (int(time.time()) - 2 * FETCHED_WINDOW,))
+        cur.execute("SELECT max(time) - 24 * 60 * 60 FROM log WHERE league NOTNULL;")
+        since = cur.fetchone()[0]
+        assert get_since(cur, None) == since
+
+        # Pretend we just fetched an old match which no logs have been linked to
+        cur.execute("""SELECT
+                           league,
+                           matchid,
+                           scheduled
+                       FROM match
+                       WHERE scheduled NOTNULL
+                           AND NOT EXISTS (SELECT *
+                               FROM log
+                               WHERE log.league = match.league
+                                   AND log.matchid = match.matchid
+                           )
+                       ORDER BY scheduled
+                       LIMIT 1;""")
+        league, matchid, scheduled = cur.fetchone()
+        cur.execute("UPDATE match SET fetched = %s WHERE league = %s AND matchid = %s;",
+                    (int(time.time()), league, matchid))
+        assert get_since(cur, None) <= scheduled - MATCH_WINDOW
+        c.rollback()
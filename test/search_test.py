@@ -0,0 +1,30 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+from hypothesis import given, strategies as st
+
+from trends.site.search import PlayerIndex
+
+aliases = st.text(alphabet="abAB", max_size=4)
+
+@given(rows=st.lists(st.tuples(st.integers(0, 5), aliases, st.integers(1, 10))),
+       prefix=aliases, limit=st.integers(1, 10))
+def test_player_index(rows, prefix, limit):
+    # Each (player, alias) pair is unique, and each player has one last_active
+    rows = { (playerid, alias): logs for playerid, alias, logs in rows }
+    index = PlayerIndex((playerid, alias, logs, str(playerid), None, None, -playerid)
+                        for (playerid, alias), logs in rows.items())
+
+    expected = {}
+    for (playerid, alias), logs in rows.items():
+        if alias.lower().startswith(prefix.lower()):
+            expected[playerid] = expected.get(playerid, 0) + logs
+
+    results = index.search(prefix, limit)
+    order = sorted(expected, key=lambda playerid: (expected[playerid], -playerid), reverse=True)
+    assert [int(result['steamid64']) for result in results] == order[:limit]
+    for result in results:
+        playerid = int(result['steamid64'])
+        assert sorted(result['aliases']) == \
+            sorted(alias for id, alias in rows
+                   if id == playerid and alias.lower().startswith(prefix.lower()))
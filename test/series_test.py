@@ -0,0 +1,23 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+from hypothesis import given, strategies as st
+import numpy as np
+
+from trends.site.series import lttb, rolling_sum
+
+@given(values=st.lists(st.integers(-10000, 10000)), window=st.integers(1, 20))
+def test_rolling_sum(values, window):
+    expected = [sum(values[max(i - window + 1, 0):i + 1]) for i in range(len(values))]
+    assert rolling_sum(np.array(values, dtype=np.float64), window).tolist() == expected
+
+@given(values=st.lists(st.none() | st.floats(-1e6, 1e6)), threshold=st.integers(0, 50))
+def test_lttb(values, threshold):
+    y = np.array(values, dtype=np.float64)
+    indices = lttb(np.arange(len(y)), y, threshold)
+
+    assert len(indices) == (threshold if 3 <= threshold < len(y) else len(y))
+    assert (np.diff(indices) > 0).all()
+    if len(y):
+        assert indices[0] == 0
+        assert indices[-1] == len(y) - 1
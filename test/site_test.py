@@ -2,7 +2,10 @@
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
 import collections
+import io
+import json
 import random
+import re
 import urllib.parse
 
 from flask.testing import EnvironBuilder
@@ -12,8 +15,12 @@ import pytest
 from python_testing_crawler import Allow, Crawler, Rule, Request
 from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import HTTPException
+import zstandard
 
-from trends.site.wsgi import create_app
+from trends.site.common import get_players
+from trends.site.search import PlayerIndex
+from trends.site.util import get_filter_clauses, get_filter_params
+from trends.site.wsgi import create_app, warmup
 from trends.util import classes, leagues
 
 @pytest.fixture(scope='session')
@@ -147,6 +154,22 @@ def test_filter(client, logs, players, titles, maps, names, compids, teamids, co
     hypothesis.note(f"path={path} params={params}")
     assert client.get(path, query_string=params, follow_redirects=True).status_code < 500
 
+def test_filter_clauses(app, connection):
+    cur = connection.cursor()
+    cur.execute("SELECT map FROM map ORDER BY mapid LIMIT 2;")
+    maps = [row[0] for row in cur]
+
+    # Different filter values shouldn't change the text of (prepared) queries
+    clauses = set()
+    mapids = []
+    for map, cls in zip(maps, ('scout', 'medic')):
+        with app.test_request_context(query_string={'map': map, 'class': cls}):
+            filters = get_filter_params()
+            clauses.add(get_filter_clauses(filters, 'classid', 'primary_classid', 'mapid'))
+            mapids.append(filters['mapids'])
+    assert len(clauses) == 1
+    assert mapids[0] != mapids[1]
+
 def test_search(client, connection):
     players = connection.cursor()
     players.execute("""SELECT steamid64, name
@@ -170,6 +193,20 @@ def test_search(client, connection):
                 resp = client.get(path, query_string={'q': player['name']})
                 assert str(player['steamid64']) in resp.get_data(as_text=True)
 
+def test_search_rank(app, connection):
+    cur = connection.cursor()
+    cur.execute("SELECT DISTINCT left(alias, 3) FROM player_search WHERE length(alias) >= 3;")
+    prefixes = [row[0] for row in cur]
+    cur.execute("SELECT count(*) FROM player_search;")
+    size = cur.fetchone()[0]
+
+    # Autocompletion should give the same results whether or not the index is used
+    with app.test_request_context():
+        index = PlayerIndex.load(size)
+        for prefix in prefixes + ['%%%', '___']:
+            assert index.search(prefix, 25) == \
+                [dict(player) for player in get_players(prefix, prefix=True)]
+
 def test_linked(connection):
     cur = connection.cursor()
     cur.execute("SELECT 1 FROM log WHERE league NOTNULL;")
@@ -177,3 +214,133 @@ def test_linked(connection):
         break
     else:
         pytest.fail("No linked matches")
+
+@pytest.mark.parametrize('order', ({}, {'sort': 'duration'}, {'sort': 'date', 'sort_dir': 'asc'}))
+def test_keyset(client, order):
+    def fetch(**params):
+        return client.get("/api/v1/logs", query_string={ **order, 'limit': 3, **params }).json
+
+    expected = []
+    offset = 0
+    while logs := fetch(offset=offset)['logs']:
+        expected.extend(log['logid'] for log in logs)
+        offset += 3
+
+    actual = []
+    page = fetch()
+    while True:
+        actual.extend(log['logid'] for log in page['logs'])
+        if not page['next']:
+            break
+        page = client.get(page['next']).json
+    assert actual == expected
+
+    assert client.get("/api/v1/logs", query_string={'after': 'garbage'}).status_code == 400
+
+@pytest.mark.parametrize('compress', (False, True))
+def test_export(client, connection, compress):
+    headers = { 'Accept-Encoding': 'zstd' } if compress else {}
+
+    def decompress(resp):
+        data = resp.get_data()
+        if compress:
+            assert resp.content_encoding == 'zstd'
+            reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data),
+                                                                 read_across_frames=True)
+            data = reader.read()
+        return data
+
+    def export(path, **params):
+        resp = client.get(path, query_string=params, headers=headers)
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        return [json.loads(line) for line in decompress(resp).splitlines()]
+
+    cur = connection.cursor()
+    cur.execute("SELECT logid FROM log ORDER BY logid;")
+    logids = [row[0] for row in cur]
+    assert [log['logid'] for log in export("/api/v1/export/logs")] == logids
+
+    logid_from, logid_to = logids[1], logids[-2]
+    assert [log['logid'] for log in export("/api/v1/export/logs", logid_from=logid_from,
+                                           logid_to=logid_to)] == logids[1:-1]
+
+    cur.execute("SELECT count(*) FROM player_stats WHERE logid BETWEEN %s AND %s;",
+                (logid_from, logid_to))
+    assert len(export("/api/v1/export/player_stats", logid_from=logid_from,
+                      logid_to=logid_to)) == cur.fetchone()[0]
+
+    cur.execute("SELECT count(*) FROM match_pretty;")
+    assert len(export("/api/v1/export/matches")) == cur.fetchone()[0]
+
+    cur.execute("SELECT data FROM log_json WHERE logid BETWEEN %s AND %s ORDER BY logid;",
+                (logid_from, logid_to))
+    datas = [row[0] for row in cur]
+    assert export("/api/v1/export/log_json", logid_from=logid_from, logid_to=logid_to) == datas
+
+    resp = client.get(f"/api/v1/log/{logid_from}/raw", headers=headers)
+    assert resp.status_code == 200
+    assert json.loads(decompress(resp)) == datas[0]
+    assert client.get("/api/v1/log/0/raw").status_code == 404
+
+@pytest.mark.parametrize('sort', ('rating', 'dpm', 'acc'))
+@pytest.mark.parametrize('dir', ('desc', 'asc'))
+def test_leaderboard_rank(client, connection, sort, dir):
+    cur = connection.cursor()
+    cur.execute("""SELECT
+                       array_agg(steamid64::TEXT ORDER BY ord),
+                       nonnull
+                   FROM leaderboard_rank
+                   CROSS JOIN unnest(players) WITH ORDINALITY AS rank (playerid, ord)
+                   JOIN player USING (playerid)
+                   WHERE sort = %s AND grouping_id = 15
+                   GROUP BY nonnull;""", (sort,))
+    players, nonnull = cur.fetchone()
+    # Ascending rankings still have NULLs last
+    expected = players if dir == 'desc' else players[:nonnull][::-1] + players[nonnull:]
+
+    limit = 7
+    steamids = []
+    for offset in range(0, len(expected) + limit, limit):
+        resp = client.get("/leaderboard", query_string={
+            'sort': sort,
+            'sort_dir': dir,
+            'limit': limit,
+            'offset': offset,
+        })
+        steamids += re.findall(r'href="/player/(\d+)/"', resp.get_data(as_text=True))
+    assert steamids == expected
+
+def test_trends_players(client, connection):
+    cur = connection.cursor()
+    # Find a player who played with someone else in only some of their logs
+    cur.execute("""SELECT
+                       player.steamid64,
+                       peer.steamid64
+                   FROM player_stats AS ps
+                   JOIN player_stats AS peer_ps USING (logid)
+                   JOIN player ON (player.playerid = ps.playerid)
+                   JOIN player AS peer ON (peer.playerid = peer_ps.playerid)
+                   WHERE ps.playerid != peer_ps.playerid
+                   GROUP BY player.steamid64, peer.steamid64
+                   HAVING count(*) < (SELECT
+                           count(*)
+                       FROM player_stats
+                       WHERE playerid = min(ps.playerid)
+                   )
+                   LIMIT 1;""")
+    steamid, peer = cur.fetchone()
+
+    def trends(**params):
+        resp = client.get(f"/player/{steamid}/trends", query_string=params)
+        assert resp.status_code == 200
+        data = re.search(r'<script id="trend-data" type="application/json">(.*?)</script>',
+                         resp.get_data(as_text=True))
+        return json.loads(data[1])
+
+    assert trends() != trends(steamid64=peer)
+
+def test_warmup(app):
+    warmup(app)
+    assert len(app.jinja_env.cache) == len(app.jinja_env.list_templates())
+    assert not app.extensions['db_pool'].idle
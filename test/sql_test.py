@@ -0,0 +1,34 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import sentry_sdk
+from sentry_sdk.transport import Transport
+
+from trends.sql import disable_tracing
+
+class ListTransport(Transport):
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.transactions = []
+
+    def capture_event(self, event):
+        pass
+
+    def capture_envelope(self, envelope):
+        if transaction := envelope.get_transaction_event():
+            self.transactions.append(transaction)
+
+def test_tracing(connection):
+    transport = ListTransport()
+    with sentry_sdk.init(traces_sample_rate=1.0, transport=transport):
+        with sentry_sdk.start_transaction(name='sampled'):
+            connection.cursor().execute("SELECT 1;")
+            with disable_tracing():
+                connection.cursor().execute("SELECT 2;")
+            connection.cursor().execute("SELECT 3;")
+
+        with sentry_sdk.start_transaction(name='unsampled', sampled=False):
+            connection.cursor().execute("SELECT 4;")
+
+    assert [[span['description'] for span in transaction['spans']]
+            for transaction in transport.transactions] == [["SELECT 1;", "SELECT 3;"]]
@@ -0,0 +1,69 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+from trends.importer.summaries import check_summaries
+from trends.sql import db_connect, update_summaries
+
+def test_check(database):
+    # check_summaries starts its own transaction, so it needs a fresh connection
+    with db_connect(database.url()) as c:
+        check_summaries(None, c)
+
+def test_leaderboard_cube(connection):
+    cur = connection.cursor()
+    # Rollups must not be confused with logs which are missing some dimensions
+    cur.execute("""SELECT count(*)
+                   FROM leaderboard_cube
+                   WHERE league ISNULL AND formatid ISNULL AND classid ISNULL AND mapid ISNULL
+                       AND grouping_id != 15;""")
+    assert cur.fetchone()[0]
+
+    cur.execute("""SELECT
+                       playerid,
+                       logs,
+                       duration,
+                       wins,
+                       kills,
+                       dmg
+                   FROM leaderboard_cube
+                   WHERE grouping_id = 15
+                   ORDER BY playerid;""")
+    cube = cur.fetchall()
+    cur.execute("""SELECT
+                       playerid,
+                       count(*),
+                       sum(log.duration),
+                       count(*) FILTER (WHERE wins > losses),
+                       sum(kills),
+                       sum(dmg)
+                   FROM log
+                   JOIN player_stats USING (logid)
+                   WHERE duplicate_of ISNULL
+                   GROUP BY playerid
+                   ORDER BY playerid;""")
+    assert cube == cur.fetchall()
+
+
+def test_player_version(database):
+    with db_connect(database.url()) as c:
+        cur = c.cursor()
+        cur.execute("BEGIN;")
+        cur.execute("SELECT min(logid) FROM log;")
+        logid = cur.fetchone()[0]
+        versions = """SELECT
+                          playerid,
+                          version,
+                          playerid IN (SELECT playerid FROM player_stats WHERE logid = %s)
+                      FROM player
+                      ORDER BY playerid;"""
+        cur.execute(versions, (logid,))
+        before = cur.fetchall()
+
+        # Relinking a log changes its summaries, but not its players' last_active
+        logids = f"SELECT {logid}"
+        update_summaries(cur, 'public', logids, -1)
+        update_summaries(cur, 'public', logids)
+        cur.execute(versions, (logid,))
+        for (playerid, old, modified), (_, new, _) in zip(before, cur.fetchall()):
+            assert (new != old) == modified, playerid
+        cur.execute("ROLLBACK;")
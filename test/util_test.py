@@ -0,0 +1,19 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+from hypothesis import given, strategies as st
+
+from trends.site.util import like_match, parse_like
+
+@given(string=st.text(alphabet="aB%_\\\n", max_size=8),
+       # Patterns may not end with an unescaped escape character
+       pattern=st.text(alphabet="Ab%_\\\n", max_size=8).filter(
+           lambda pattern: (len(pattern) - len(pattern.rstrip('\\'))) % 2 == 0))
+def test_like_match(connection, string, pattern):
+    cur = connection.cursor()
+    cur.execute("SELECT %s ILIKE %s;", (string, pattern))
+    assert like_match(parse_like(pattern), string) == cur.fetchone()[0]
+
+def test_like_match_wildcards():
+    # This takes minutes with a backtracking regular expression
+    assert not like_match(parse_like('%' + '_%' * 20 + 'Z%'), 'cp_granary_pro_rc8' * 4)
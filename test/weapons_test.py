@@ -0,0 +1,75 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import io
+
+from hypothesis import given, strategies as st
+import pytest
+
+from trends.importer.weapons import VDF_CLOSE, VDF_OPEN, parse_vdf, vdf_tokens
+
+def test_vdf_tokens():
+    vdf = r'''// A comment with "quotes" and {braces}
+"items"
+{
+	"1"	"C:\\path\\to\n"	// Escapes are not interpreted
+	"{"	"}"
+	bare	"// not a comment"
+	"cond"	"x" [$WIN32]
+	"nested" { "a" { } }
+}
+'''
+    assert list(vdf_tokens(io.StringIO(vdf), size=5)) == [
+        "items", VDF_OPEN,
+            "1", r"C:\\path\\to\n",
+            "{", "}",
+            "bare", "// not a comment",
+            "cond", "x",
+            "nested", VDF_OPEN, "a", VDF_OPEN, VDF_CLOSE, VDF_CLOSE,
+        VDF_CLOSE,
+    ]
+
+@pytest.mark.parametrize('vdf', ('"unterminated', '"a" { "b" "c"', '"a" "b" }', '"a" }',
+                                 '{ "a" "b" }'))
+def test_vdf_errors(vdf):
+    with pytest.raises(ValueError):
+        parse_vdf(io.StringIO(vdf))
+
+def test_parse_vdf_paths():
+    vdf = """"items_game" {
+        "items" { "1" { "name" "one" } "2" { "name" "two" } }
+        "prefabs" { "p" { "name" "prefab" } }
+        "qualities" { "q" "1" }
+        "other" "value"
+    }"""
+
+    assert parse_vdf(io.StringIO(vdf), (('items_game', 'items', '2'),
+                                        ('items_game', 'prefabs'))) == {
+        'items_game': {
+            'items': { '2': { 'name': "two" } },
+            'prefabs': { 'p': { 'name': "prefab" } },
+        },
+    }
+
+def test_parse_vdf_replace():
+    vdf = '''"a" { "b" "1" } "a" { "c" "2" } "d" "3" "d" "4"'''
+    assert parse_vdf(io.StringIO(vdf)) == { 'a': { 'c': "2" }, 'd': "4" }
+
+# Anything but quotes, which can't be escaped
+vdf_strings = st.text(st.characters(blacklist_characters='"', blacklist_categories=('Cs',)),
+                      max_size=8)
+vdf_objects = st.recursive(vdf_strings, lambda children: st.dictionaries(vdf_strings, children),
+                           max_leaves=10)
+
+def dump_vdf(obj):
+    lines = []
+    for key, value in obj.items():
+        if isinstance(value, dict):
+            lines.append(f'"{key}" // {{ "comment"\n{{\n{dump_vdf(value)}}}')
+        else:
+            lines.append(f'"{key}" "{value}" [$X360]')
+    return "\n".join(lines) + "\n"
+
+@given(obj=st.dictionaries(vdf_strings, vdf_objects), size=st.integers(1, 16))
+def test_parse_vdf(obj, size):
+    assert parse_vdf(io.StringIO(dump_vdf(obj)), size=size) == obj
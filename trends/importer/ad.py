@@ -1,42 +1,21 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # Copyright (C) 2021 Sean Anderson <seanga2@gmail.com>
 
-import json
-import logging
-
-import psycopg2.extras
-import zstandard
-
-from ..util import chunk
+from .backfill import add_backfill_args, backfill
 
 def create_ad_parser(sub):
     ad = sub.add_parser("ad", help="Import A/D scoring data from existing logs")
     ad.set_defaults(importer=import_ad)
+    add_backfill_args(ad)
 
-def extract_ad(c):
-    dctx = zstandard.ZstdDecompressor()
-    with c.cursor(name='ad', withhold=True) as cur:
-        cur.execute("""SELECT
-                           logid,
-                           data
-                       FROM log_json
-                       JOIN log USING (logid)
-                       WHERE ad_scoring ISNULL""")
-        for log in cur:
-            try:
-                yield log[0], json.loads(dctx.decompress(log[1]))['info']['AD_scoring']
-            except (IndexError, KeyError, TypeError):
-                logging.exception("Could not parse log %s", log[0])
+def extract_ad(log):
+    return (log['info']['AD_scoring'],)
 
 def import_ad(args, c):
-    cur = c.cursor()
-
-    for logs in chunk(extract_ad(c), 1000):
-        cur.execute("BEGIN;")
-        psycopg2.extras.execute_values(cur,
-            """UPDATE log
-               SET ad_scoring = data.ad
-               FROM (VALUES %s) AS data (logid, ad)
-               WHERE log.logid = data.logid;""", logs)
-        cur.execute("COMMIT;")
-        logging.info("Imported chunk")
+    backfill(c, 'ad', extract_ad, (('ad', 'BOOLEAN'),),
+             ("""UPDATE log
+                 SET ad_scoring = backfill.ad,
+                     version = DEFAULT
+                 FROM backfill
+                 WHERE log.logid = backfill.logid;""",),
+             where="ad_scoring ISNULL", jobs=args.jobs, restart=args.restart)
@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import functools
+import json
+import logging
+import multiprocessing
+import time
+
+from ..sql import PARTITION_SIZE, copy_rows
+
+def add_backfill_args(parser):
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes. Defaults to the number of CPUs")
+    parser.add_argument("-r", "--restart", action='store_true',
+                        help="Ignore any saved progress and start from the first log")
+
+def _extract(extract, row):
+    logid, data = row
+    try:
+        values = extract(json.loads(data))
+    except (IndexError, KeyError, TypeError, ValueError):
+        logging.exception("Could not parse log %s", logid)
+        return None
+
+    if values is None:
+        return None
+    return (logid, *values)
+
+def get_checkpoint(cur, name):
+    cur.execute("SELECT logid FROM backfill_progress WHERE name = %s;", (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def backfill(c, name, extract, columns, update, where="TRUE", jobs=None, restart=False,
+             batch_size=1000):
+    """Extract data from the JSON of existing logs
+
+    Logs are scanned one partition at a time. Each log's JSON is parsed and passed to ``extract``
+    in a pool of worker processes. The extracted rows are copied into the temporary table
+    ``backfill`` (with ``logid`` as the first column), after which ``update`` is executed. The
+    partition's changes and the backfill's progress are committed together, so interrupted
+    backfills resume from the last completed partition.
+
+    :param c: The database connection
+    :param str name: The name of this backfill, used to save progress
+    :param extract: Function to extract data from a log. It must be picklable (e.g. defined at the
+                    top level of a module), and is called with the parsed JSON of a log. It should
+                    return a sequence of values for ``columns`` or ``None`` to skip the log.
+                    ``IndexError``, ``KeyError``, ``TypeError``, and ``ValueError`` are logged and
+                    the log is skipped.
+    :param columns: The extracted columns, as (name, type) tuples
+    :type columns: sequence of tuple
+    :param update: SQL statements to update logs using ``backfill``
+    :type update: sequence of str
+    :param str where: Condition selecting which logs to process. ``log`` is joined with
+                      ``log_json``.
+    :param int jobs: Number of worker processes, defaulting to the number of CPUs
+    :param bool restart: Whether to ignore saved progress
+    :param int batch_size: Number of logs to fetch and process at once
+    :return: The number of logs extracted
+    :rtype: int
+    """
+
+    cur = c.cursor()
+    cur.execute("BEGIN;")
+    cur.execute("""CREATE TEMP TABLE backfill (
+                       logid INT PRIMARY KEY,
+                       {}
+                   );""".format(",\n".join(f"{col} {type}" for col, type in columns)))
+    cur.execute("COMMIT;")
+
+    cur.execute("SELECT min(logid), max(logid) FROM log_json;")
+    first, last = cur.fetchone()
+    if first is None:
+        logging.info("No logs to backfill")
+        return 0
+
+    checkpoint = None if restart else get_checkpoint(cur, name)
+    if checkpoint is not None:
+        logging.info("Resuming %s from log %s", name, checkpoint)
+        first = max(first, checkpoint)
+
+    worker = functools.partial(_extract, extract)
+    start = time.monotonic()
+    scanned = 0
+    extracted = 0
+    with multiprocessing.Pool(jobs) as pool:
+        # Scan log_json in ranges which line up with its partitions
+        for lower in range(first // PARTITION_SIZE * PARTITION_SIZE, last + 1, PARTITION_SIZE):
+            lower = max(lower, first)
+            upper = (lower // PARTITION_SIZE + 1) * PARTITION_SIZE
+            partition_start = time.monotonic()
+
+            cur.execute("BEGIN;")
+            rows = []
+            with c.cursor(name=f"backfill_{name}") as logs:
+                logs.itersize = batch_size
+                logs.execute(f"""SELECT
+                                     logid,
+                                     data::TEXT
+                                 FROM log_json
+                                 JOIN log USING (logid)
+                                 WHERE logid >= %s AND logid < %s AND ({where});""",
+                             (lower, upper))
+
+                # Parse the next batch while we fetch this one
+                pending = None
+                while True:
+                    batch = logs.fetchmany(batch_size)
+                    if pending is not None:
+                        rows.extend(row for row in pending.get() if row is not None)
+                        pending = None
+                    if not batch:
+                        break
+                    scanned += len(batch)
+                    pending = pool.map_async(worker, batch, chunksize=max(len(batch) // 64, 1))
+
+            count = copy_rows(cur, 'backfill', ('logid', *(col for col, type in columns)), rows)
+            for statement in update:
+                cur.execute(statement)
+            cur.execute("DELETE FROM backfill;")
+            cur.execute("""INSERT INTO backfill_progress (name, logid)
+                           VALUES (%s, %s)
+                           ON CONFLICT (name) DO UPDATE
+                           SET logid = EXCLUDED.logid;""", (name, upper))
+            cur.execute("COMMIT;")
+
+            extracted += count
+            now = time.monotonic()
+            logging.info("Backfilled %s log(s) below %s in %.2fs (%.1f%% done, %.0f logs/s)",
+                         count, upper, now - partition_start,
+                         100 * (min(upper, last + 1) - first) / (last + 1 - first),
+                         scanned / (now - start))
+
+    cur.execute("DROP TABLE backfill;")
+    logging.info("Backfilled %s log(s) out of %s scanned in %.2fs", extracted, scanned,
+                 time.monotonic() - start)
+    return extracted
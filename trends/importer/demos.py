@@ -11,7 +11,7 @@ import sentry_sdk
 
 from .fetch import DemoFileFetcher, DemoListFetcher, DemoBulkFetcher
 from ..steamid import SteamID
-from ..sql import disable_tracing, publicize
+from ..sql import copy_rows, disable_tracing, publicize
 from .. import util
 from ..util import chunk
 
@@ -26,7 +26,14 @@ def filter_demoids(c, demoids):
                    WHERE public.demo.demoid IS NULL""", ((demoid,) for demoid in demoids))
             yield from (row[0] for row in cur)
 
-def import_demo(c, demo):
+def parse_demo(demo):
+    """Parse a demo from demos.tf
+
+    :param demo: A demo parsed from json
+    :return: The demo, with players as a list of (steamid64, name) tuples
+    :raises KeyError: if a required property is missing
+    """
+
     players = []
     for player in demo['players']:
         # Probably nothing useful here
@@ -34,36 +41,93 @@ def import_demo(c, demo):
             continue
 
         try:
-            steamid = SteamID(player['steamid'])
+            steamid = int(str(SteamID(player['steamid'])))
         except ValueError:
             continue
 
-        c.execute("INSERT INTO name (name) VALUES (%(name)s) ON CONFLICT DO NOTHING;", player)
-        c.execute("""INSERT INTO player (
-                         steamid64,
-                         nameid,
-                         last_active
-                     ) VALUES (
-                         %s,
-                         (SELECT nameid FROM name WHERE name = %s),
-                         %s
-                     ) ON CONFLICT (steamid64)
-                     DO UPDATE SET
-                         last_active = greatest(player.last_active, EXCLUDED.last_active);""",
-                  (steamid, player['name'], demo['time']))
-        players.append(steamid)
-
-    demo['players'] = players
-    c.execute("INSERT INTO map (map) VALUES (%(map)s) ON CONFLICT DO NOTHING;", demo)
-    c.execute("""INSERT INTO demo (
-                     demoid, url, server, duration, mapid, time, red_name, blue_name, red_score,
-                     blue_score, players
-                 ) VALUES (
-                     %(id)s, %(url)s, %(server)s, %(duration)s,
-                     (SELECT mapid FROM map WHERE map = %(map)s), %(time)s, %(red)s, %(blue)s,
-                     %(redScore)s, %(blueScore)s,
-                     (SELECT array_agg(playerid) FROM player WHERE steamid64 = ANY(%(players)s))
-                 )""", demo);
+        players.append((steamid, player['name']))
+
+    return {
+        'demoid': demo['id'],
+        'url': demo['url'],
+        'server': demo['server'],
+        'duration': demo['duration'],
+        'map': demo['map'],
+        'time': demo['time'],
+        'red_name': demo['red'],
+        'blue_name': demo['blue'],
+        'red_score': demo['redScore'],
+        'blue_score': demo['blueScore'],
+        'players': players,
+    }
+
+demo_columns = ('demoid', 'url', 'server', 'duration', 'mapid', 'time', 'red_name', 'blue_name',
+                'red_score', 'blue_score', 'players')
+
+def import_demo_batch(c, demos, players):
+    """Import a batch of parsed demos into the temporary demo table
+
+    :param c: The database cursor
+    :param demos: The demos to import
+    :type demos: sequence of dicts returned by :func:`parse_demo`
+    :param players: A cache of steamid64s to (playerid, last_active) tuples. Players already in the
+                    cache with a later ``last_active`` than a demo will not be updated.
+    :return: New entries for ``players``
+    :rtype: dict
+    """
+
+    # Only upsert the latest appearance of each player we need to update
+    new_players = {}
+    for demo in demos:
+        for steamid, name in demo['players']:
+            playerid, last_active = players.get(steamid, (None, None))
+            if last_active is not None and last_active >= demo['time']:
+                continue
+
+            if steamid not in new_players or demo['time'] > new_players[steamid][2]:
+                new_players[steamid] = (steamid, name, demo['time'])
+
+    resolved = {}
+    if new_players:
+        psycopg2.extras.execute_values(c,
+            "INSERT INTO name (name) VALUES %s ON CONFLICT DO NOTHING;",
+            { (player[1],) for player in new_players.values() })
+        rows = psycopg2.extras.execute_values(c,
+            """INSERT INTO player (steamid64, nameid, last_active)
+               SELECT
+                   steamid64,
+                   nameid,
+                   time
+               FROM (VALUES %s) AS new (steamid64, name, time)
+               JOIN name USING (name)
+               ON CONFLICT (steamid64)
+               DO UPDATE SET
+                   last_active = greatest(player.last_active, EXCLUDED.last_active)
+               RETURNING steamid64, playerid, last_active;""", new_players.values(), fetch=True)
+        for steamid64, playerid, last_active in rows:
+            resolved[steamid64] = (playerid, last_active)
+
+    def get_playerid(steamid):
+        try:
+            return resolved[steamid][0]
+        except KeyError:
+            return players[steamid][0]
+
+    maps = tuple({ demo['map'] for demo in demos })
+    psycopg2.extras.execute_values(c, "INSERT INTO map (map) VALUES %s ON CONFLICT DO NOTHING;",
+                                   ((map,) for map in maps))
+    c.execute("SELECT map, mapid FROM map WHERE map IN %s;", (maps,))
+    mapids = { row[0]: row[1] for row in c }
+
+    def demo_row(demo):
+        demo = demo.copy()
+        demo['mapid'] = mapids[demo['map']]
+        playerids = dict.fromkeys(get_playerid(steamid) for steamid, name in demo['players'])
+        demo['players'] = list(playerids) or None
+        return tuple(demo[col] for col in demo_columns)
+
+    copy_rows(c, 'demo', demo_columns, (demo_row(demo) for demo in demos))
+    return resolved
 
 def create_demos_parser(sub):
     demos = sub.add_parser("demos", help="Import demos")
@@ -109,47 +173,64 @@ def import_demos_cli(args, c):
 def import_demos(c, fetcher):
     cur = c.cursor()
 
-    # Create a temporary tables for bulk inserts
+    # Create a temporary tables for bulk inserts. Commit it so it survives failed batches.
+    cur.execute("BEGIN;")
     cur.execute("""CREATE TEMP TABLE demo (
                        LIKE demo INCLUDING ALL EXCLUDING INDEXES,
                        PRIMARY KEY (demoid)
                    );""")
+    cur.execute("COMMIT;")
 
-    def commit():
-        with sentry_sdk.start_span(op='db.transaction', description="commit"):
-            cur.execute("BEGIN;")
-            publicize(c, (('demo', 'demoid'),))
-            cur.execute("COMMIT;")
-            logging.info("Committed %s imported demo(s)...", count)
+    # Cache of resolved players so we don't have to upsert them for every batch
+    players = {}
 
-    count = 0
-    start = datetime.now()
-    for demoid in filter_demoids(c, fetcher.get_ids()):
-        demo = fetcher.get_data(demoid)
-        if demo is None:
-            continue
+    def commit(demos):
+        if not demos:
+            return 0
 
-        with sentry_sdk.start_span(op='db.transaction', description=f"import {demoid}"), \
+        with sentry_sdk.start_span(op='db.transaction', description="commit"), \
              disable_tracing():
             cur.execute("BEGIN;")
             try:
-                import_demo(c.cursor(), demo)
-            except (IndexError, KeyError, psycopg2.errors.NumericValueOutOfRange):
-                logging.exception("Could not parse demo %s", demoid)
+                resolved = import_demo_batch(c.cursor(), demos, players)
+                publicize(c, (('demo', 'demoid'),))
+            except psycopg2.errors.DataError:
                 cur.execute("ROLLBACK;")
+                if len(demos) == 1:
+                    logging.exception("Could not import demo %s", demos[0]['demoid'])
+                    return 0
+
+                # Find the bad demo(s) by importing everything individually
+                logging.warning("Could not import %s demo(s) in bulk; retrying individually",
+                                len(demos))
+                return sum(commit((demo,)) for demo in demos)
             except psycopg2.Error:
-                logging.error("Could not import demo %s", demoid)
+                logging.error("Could not import demos %s", [demo['demoid'] for demo in demos])
                 raise
-            else:
-                count += 1
             cur.execute("COMMIT;")
 
+        players.update(resolved)
+        logging.info("Committed %s imported demo(s)...", len(demos))
+        return len(demos)
+
+    demos = {}
+    start = datetime.now()
+    for demoid in filter_demoids(c, fetcher.get_ids()):
+        demo = fetcher.get_data(demoid)
+        if demo is None:
+            continue
+
+        try:
+            demos[demoid] = parse_demo(demo)
+        except (IndexError, KeyError, TypeError):
+            logging.exception("Could not parse demo %s", demoid)
+            continue
+
         now = datetime.now()
-        if (now - start).total_seconds() > 60 or count > 500:
-            commit()
-            cur.execute("BEGIN;")
-            count = 0
+        if (now - start).total_seconds() > 60 or len(demos) >= 500:
+            commit(tuple(demos.values()))
+            demos = {}
             # Committing may take a while, so start the timer when we can actually import stuff
             start = datetime.now()
 
-    commit()
+    commit(tuple(demos.values()))
@@ -0,0 +1,44 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2020 Sean Anderson <seanga2@gmail.com>
+
+import logging
+
+from ..sql import update_summaries
+
+def create_dupes_parser(sub):
+    dupes = sub.add_parser("dupes", help="Find duplicates among all logs")
+    dupes.set_defaults(importer=mark_dupes)
+
+def mark_dupes(args, c):
+    """Find duplicates among all logs
+
+    Unlike the duplicate detection done while importing logs, this compares all logs with each
+    other. As with imports, later logs are marked as duplicates of earlier ones.
+    """
+
+    cur = c.cursor()
+    cur.execute("BEGIN;")
+    cur.execute("""CREATE TEMP TABLE dupes AS SELECT
+                       r1.logid AS logid,
+                       array_agg(DISTINCT r2.logid) AS of
+                   FROM round AS r1
+                   JOIN round AS r2 USING (
+                       time, duration, firstcap, red_score, blue_score, red_kills, blue_kills,
+                       red_dmg, blue_dmg, red_ubers, blue_ubers
+                   ) WHERE r1.logid > r2.logid
+                   GROUP BY r1.logid;""")
+    cur.execute("""DELETE FROM dupes
+                   USING log
+                   WHERE log.logid = dupes.logid
+                       AND log.duplicate_of @> dupes.of;""")
+
+    # Duplicates are not summarized
+    update_summaries(cur, 'public', "SELECT logid FROM dupes", -1)
+    cur.execute("""UPDATE log SET
+                       duplicate_of = coalesce(duplicate_of, ARRAY[]::INT[]) | dupes.of,
+                       version = DEFAULT
+                   FROM dupes
+                   WHERE log.logid = dupes.logid;""")
+    logging.info("Marked %s log(s) as duplicates", cur.rowcount)
+    cur.execute("DROP TABLE dupes;")
+    cur.execute("COMMIT;")
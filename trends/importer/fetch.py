@@ -2,10 +2,12 @@
 # Copyright (C) 2020-21 Sean Anderson <seanga2@gmail.com>
 
 import collections
+import io
 import itertools
 import json
 import logging
 import os
+import re
 import sqlite3
 import time
 
@@ -27,6 +29,107 @@ def create_session():
         s.mount("https://", requests.adapters.HTTPAdapter(max_retries=retries))
         return s
 
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_DELIMITERS = frozenset(' \t\n\r,:]}')
+
+def json_items(f, key=None, rest=None, size=1 << 16):
+    """Incrementally parse the items of a JSON array
+
+    Only one item at a time is kept in memory, so items can be processed while the rest of the
+    file is still being read.
+
+    :param f: The (text) file to read from
+    :param str key: If present, the file contains an object, and the array is the value of ``key``.
+                    Otherwise, the file contains the array.
+    :param dict rest: If present, the rest of the object's keys are stored here once they have been
+                      parsed. Keys after the array will only be present after all of its items
+                      have been parsed.
+    :param int size: How much to read at once
+    :return: Each item of the array
+    :raises ValueError: If the file could not be parsed
+    """
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        data = f.read(size)
+        eof = not data
+        buf = buf[pos:] + data
+        pos = 0
+
+    def peek():
+        nonlocal pos
+        while True:
+            pos = JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            fill()
+
+    def expect(chars):
+        nonlocal pos
+        char = peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} at {buf[pos:pos + 20]!r}")
+        pos += 1
+        return char
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                val, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # Numbers may continue past the end of the buffer
+                if eof or buf[end:end + 1] in JSON_DELIMITERS:
+                    pos = end
+                    return val
+            fill()
+
+    def items():
+        nonlocal pos
+        expect('[')
+        if peek() == ']':
+            pos += 1
+            return
+
+        while True:
+            yield value()
+            if expect(',]') == ']':
+                return
+
+    if key is None:
+        yield from items()
+        return
+
+    expect('{')
+    if peek() == '}':
+        return
+
+    while True:
+        k = value()
+        expect(':')
+        if k == key and peek() == '[':
+            yield from items()
+        else:
+            v = value()
+            if rest is not None:
+                rest[k] = v
+        if expect(',}') == '}':
+            return
+
+def stream_json(resp):
+    """Get a text file from a streaming response"""
+    resp.raw.decode_content = True
+    return io.TextIOWrapper(resp.raw, encoding=resp.encoding or 'utf-8')
+
 class ListFetcher:
     """Fetcher for a list of log ids for logs to get from logs.tf"""
     def __init__(self, logids=None, **kwargs):
@@ -406,21 +509,19 @@ class DemoBulkFetcher(DemoListFetcher):
                     params['after'] = self.since
                 if self.until:
                     params['before'] = self.until
-                resp = self.s.get("https://api.demos.tf/demos", params=params)
-                resp.raise_for_status()
-                demo_list = resp.json()
-
                 page_demos = 0
-                for demo in demo_list:
-                    if last_demoid is not None and demo['id'] >= last_demoid:
-                        continue
-                    else:
-                        yield demo['id']
-                        last_demoid = demo['id']
-                        page_demos += 1
-                        yielded += 1
-                        if self.count is not None and yielded >= self.count:
-                            return
+                with self.s.get("https://api.demos.tf/demos", params=params, stream=True) as resp:
+                    resp.raise_for_status()
+                    for demo in json_items(stream_json(resp)):
+                        if last_demoid is not None and demo['id'] >= last_demoid:
+                            continue
+                        else:
+                            yield demo['id']
+                            last_demoid = demo['id']
+                            page_demos += 1
+                            yielded += 1
+                            if self.count is not None and yielded >= self.count:
+                                return
 
                 # No new demos this page; give up
                 if not page_demos:
@@ -438,27 +539,29 @@ class ETF2LFileFetcher:
         self.xferdir = xferdir
 
     def get_results(self):
+        fetched = int(os.path.getmtime(self.results))
         with open(self.results) as resultfile:
-            results = json.load(resultfile)
-        for result in results['results']:
-            result['fetched'] = int(os.path.getmtime(self.results))
-            yield result
+            for result in json_items(resultfile, 'results'):
+                result['fetched'] = fetched
+                yield result
 
     def get_xfers(self, teamid, since=0):
         try:
             page = max_pages = 1
             while page <= max_pages:
                 path = f"{self.xferdir}/transfers_{teamid}_{page}.json"
-                with open(path) as xferfile:
-                    xfers = json.load(xferfile)
                 fetched = int(os.path.getmtime(path))
-                max_pages = xfers['page']['total_pages']
+                rest = {}
+                page_xfers = 0
+                with open(path) as xferfile:
+                    for xfer in json_items(xferfile, 'transfers', rest):
+                        xfer['fetched'] = fetched
+                        yield xfer
+                        page_xfers += 1
 
-                if not xfers['transfers']:
+                if not page_xfers:
                     break
-                for xfer in xfers['transfers']:
-                    xfer['fetched'] = fetched
-                    yield xfer
+                max_pages = rest['page']['total_pages']
                 page += 1
         except FileNotFoundError:
             pass
@@ -479,22 +582,21 @@ class ETF2LBulkFetcher:
         try:
             while True:
                 fetched = int(time.time())
-                resp = self.s.get(f"{url}/{page}.json", params={
+                rest = {}
+                with self.s.get(f"{url}/{page}.json", params={
                     'per_page': 100,
                     'since': since,
-                })
-                resp.raise_for_status()
-
-                resp = resp.json()
-                for datum in resp[data_key] or ():
-                    datum['fetched'] = fetched
-                    yield datum
-                    yielded += 1
-                    if count is not None and yielded >= count:
-                        return
+                }, stream=True) as resp:
+                    resp.raise_for_status()
+                    for datum in json_items(stream_json(resp), data_key, rest):
+                        datum['fetched'] = fetched
+                        yield datum
+                        yielded += 1
+                        if count is not None and yielded >= count:
+                            return
 
                 # No new data this page; give up
-                if page >= resp['page']['total_pages']:
+                if page >= rest['page']['total_pages']:
                     return
 
                 page += 1
@@ -4,6 +4,8 @@
 from datetime import datetime, timedelta
 import logging
 
+from ..sql import update_player_versions
+
 def create_link_demos_parser(sub):
     link = sub.add_parser("link_demos", help="Link logs and demos")
     link.set_defaults(importer=link_logs)
@@ -41,8 +43,10 @@ def link_logs(args, c):
         cur.execute("SELECT count(*) from linked;");
         count = cur.fetchone()[0]
         cur.execute("""UPDATE log
-                       SET demoid = linked.demoid
+                       SET demoid = linked.demoid,
+                           version = DEFAULT
                        FROM linked
                        WHERE log.logid = linked.logid;""")
+        update_player_versions(cur, 'public', "SELECT logid FROM linked")
         cur.execute("COMMIT;")
         logging.info(f"Linked {count} logs")
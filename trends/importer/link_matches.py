@@ -3,91 +3,146 @@
 
 from datetime import datetime, timedelta
 import logging
+import time
+
+from ..sql import update_summaries
+
+# How far away from the scheduled time of a match we look for logs
+MATCH_WINDOW = 12 * 60 * 60
+# How long after fetching a match we keep trying to link logs to it
+FETCHED_WINDOW = 7 * 24 * 60 * 60
 
 def create_link_matches_parser(sub):
     link = sub.add_parser("link_matches", help="Link logs and matches")
     link.set_defaults(importer=link_matches)
-    link.add_argument("-s", "--since", type=datetime.fromisoformat,
-                   default=datetime.now() - timedelta(days=7), metavar="DATE",
-                   help="Only link logs created before DATE")
+    link.add_argument("-s", "--since", type=datetime.fromisoformat, default=None, metavar="DATE",
+                   help=("Only link logs created after DATE. Defaults to a day before the most "
+                         "recently-linked log, or to the oldest recently-fetched match without "
+                         "any logs, whichever is earlier"))
+
+def get_since(cur, since):
+    if since is not None:
+        return int(since.timestamp())
+
+    # Matches may be fetched long after they were played (or we may have missed a run), so look
+    # back far enough to cover any recently-fetched match which hasn't been linked yet
+    cur.execute("""SELECT least(
+                       (SELECT max(time) - 24 * 60 * 60 FROM log WHERE league NOTNULL),
+                       (SELECT
+                            min(scheduled) - %(window)s
+                        FROM match
+                        WHERE fetched > %(fetched)s
+                            AND NOT EXISTS (SELECT *
+                                FROM log
+                                WHERE log.league = match.league
+                                    AND log.matchid = match.matchid
+                            )
+                       )
+                   );""", {
+                       'window': MATCH_WINDOW,
+                       'fetched': int(time.time()) - FETCHED_WINDOW,
+                   })
+    if (since := cur.fetchone()[0]) is not None:
+        return since
+    return int((datetime.now() - timedelta(days=7)).timestamp())
 
 def link_matches(args, c):
     with c.cursor() as cur:
-        since = int(args.since.timestamp())
+        since = get_since(cur, args.since)
+        start = time.monotonic()
         cur.execute("BEGIN;")
+
+        # Inverted index of players to the matches they were rostered for
         cur.execute(
-            """CREATE TEMP TABLE log_teams AS SELECT
+            """CREATE TEMP TABLE match_players AS SELECT
+                   match.league,
+                   matchid,
+                   scheduled,
+                   tp.teamid = match.teamid1 AS team1,
+                   playerid
+               FROM match
+               JOIN team_player AS tp ON (
+                   tp.league = match.league
+                   AND tp.teamid IN (match.teamid1, match.teamid2)
+                   AND tp.rostered @> match.scheduled
+               ) WHERE scheduled > %s;""", (since - MATCH_WINDOW,))
+        cur.execute("CREATE INDEX match_players_playerid ON match_players (playerid, scheduled);")
+        cur.execute("ANALYZE match_players;")
+
+        cur.execute(
+            """CREATE TEMP TABLE log_players AS SELECT
                    logid,
                    time,
-                   red,
-                   blue
+                   team,
+                   playerid
                FROM log
-               JOIN (SELECT
-                       logid,
-                       array_agg(playerid) AS red
-                   FROM player_stats
-                   WHERE team = 'Red'
-                   GROUP BY logid
-               ) AS red USING (logid)
-               JOIN (SELECT
-                       logid,
-                       array_agg(playerid) AS blue
-                   FROM player_stats
-                   WHERE team = 'Blue'
-                   GROUP BY logid
-               ) AS blue USING (logid)
+               JOIN player_stats USING (logid)
                WHERE league ISNULL AND time > %s;""", (since,))
-        cur.execute("CREATE INDEX log_teams_time ON log_teams (time);")
-        cur.execute("ANALYZE log_teams;")
+        cur.execute("ANALYZE log_players;")
+
+        # Only score matches which share at least one player with a log
+        cur.execute(
+            """CREATE TEMP TABLE candidates AS SELECT DISTINCT
+                   logid,
+                   league,
+                   matchid
+               FROM log_players AS log
+               JOIN match_players AS match USING (playerid)
+               WHERE log.time BETWEEN match.scheduled - %(window)s
+                                  AND match.scheduled + %(window)s;""",
+            { 'window': MATCH_WINDOW })
+        cur.execute("SELECT count(*), count(DISTINCT logid) FROM candidates;")
+        candidates, candidate_logs = cur.fetchone()
+        indexed = time.monotonic()
+        logging.info("Generated %s candidate(s) for %s log(s) in %.2fs", candidates,
+                     candidate_logs, indexed - start)
 
         cur.execute(
             """CREATE TEMP TABLE log_matches AS SELECT
                    logid,
                    league,
                    matchid,
-                   #(match1.players & log.red) + #(match2.players & log.blue) >
-                       #(match1.players & log.blue) + #(match2.players & log.red) AS team1_is_red
-               FROM (SELECT
-                       match.league,
-                       matchid,
-                       match.compid,
-                       scheduled AS time,
-                       array_agg(playerid) AS players
-                   FROM match
-                   JOIN team_player AS tp ON (
-                       tp.league = match.league
-                       AND tp.teamid = match.teamid1
-                       AND tp.rostered @> match.scheduled
-                   ) WHERE scheduled > %s
-                   GROUP BY match.league, matchid, match.compid, match.scheduled
-               ) AS match1
+                   #(roster.team1 & log.red) + #(roster.team2 & log.blue) >
+                       #(roster.team1 & log.blue) + #(roster.team2 & log.red) AS team1_is_red
+               FROM candidates
+               JOIN (SELECT
+                       logid,
+                       array_agg(playerid) FILTER (WHERE team = 'Red') AS red,
+                       array_agg(playerid) FILTER (WHERE team = 'Blue') AS blue
+                   FROM log_players
+                   WHERE logid IN (SELECT logid FROM candidates)
+                   GROUP BY logid
+               ) AS log USING (logid)
                JOIN (SELECT
-                       match.league,
+                       league,
                        matchid,
-                       array_agg(playerid) AS players
-                   FROM match
-                   JOIN team_player AS tp ON (
-                       tp.league = match.league
-                       AND tp.teamid = match.teamid2
-                       AND tp.rostered @> match.scheduled
-                   ) GROUP BY match.league, matchid
-               ) AS match2 USING (league, matchid)
+                       array_agg(playerid) FILTER (WHERE team1) AS team1,
+                       array_agg(playerid) FILTER (WHERE NOT team1) AS team2
+                   FROM match_players
+                   WHERE (league, matchid) IN (SELECT league, matchid FROM candidates)
+                   GROUP BY league, matchid
+               ) AS roster USING (league, matchid)
+               JOIN match USING (league, matchid)
                JOIN competition USING (league, compid)
                JOIN format USING (formatid)
-               CROSS JOIN log_teams AS log
-               WHERE log.time BETWEEN match1.time - 12 * 60 * 60 AND match1.time + 12 * 60 * 60
-                   AND (#(match1.players & (log.red | log.blue)) >= format.players / 3
-                        AND #(match2.players & (log.red | log.blue)) >= format.players / 3)
-                   AND #((log.red | log.blue) - match1.players - match2.players) <=
-                         format.players / 3;""", (since,))
+               WHERE (#(roster.team1 & (log.red | log.blue)) >= format.players / 3
+                      AND #(roster.team2 & (log.red | log.blue)) >= format.players / 3)
+                   AND #((log.red | log.blue) - roster.team1 - roster.team2) <=
+                         format.players / 3;""")
 
         cur.execute("SELECT count(*) from log_matches;");
         count = cur.fetchone()[0]
+        update_summaries(cur, 'public', "SELECT logid FROM log_matches", -1)
         cur.execute("""UPDATE log SET
                            league = log_matches.league,
                            matchid = log_matches.matchid,
-                           team1_is_red = log_matches.team1_is_red
+                           team1_is_red = log_matches.team1_is_red,
+                           version = DEFAULT
                        FROM log_matches
                        WHERE log.logid = log_matches.logid;""")
+        update_summaries(cur, 'public', "SELECT logid FROM log_matches")
+        for table in ('log_matches', 'candidates', 'log_players', 'match_players'):
+            cur.execute(f"DROP TABLE {table};")
         cur.execute("COMMIT;")
-        logging.info(f"Linked {count} logs")
+        logging.info("Linked %s logs from %s candidate(s) in %.2fs (scoring took %.2fs)", count,
+                     candidates, time.monotonic() - start, time.monotonic() - indexed)
@@ -12,7 +12,8 @@ import systemd_watchdog
 
 from .fetch import ListFetcher, BulkFetcher, FileFetcher, ReverseFetcher, CloneLogsFetcher
 from ..steamid import SteamID
-from ..sql import disable_tracing, delete_logs, log_tables, publicize, table_columns
+from ..sql import disable_tracing, delete_logs, log_tables, publicize, table_columns, \
+                  update_summaries
 from .. import util
 from ..util import chunk
 
@@ -808,6 +809,9 @@ def import_logs(c, fetcher, update_only):
             update_wlt(cur)
             update_player_classes(cur)
             update_acc(cur)
+            # Remove any old versions of these logs before adding them
+            update_summaries(cur, 'public', "SELECT logid FROM pg_temp.log", -1)
+            update_summaries(cur, 'pg_temp', "SELECT logid FROM pg_temp.log")
             publicize(c, log_tables)
             cur.execute("COMMIT;")
             logging.info("Committed %s imported log(s)...", count)
@@ -0,0 +1,13 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+from ..sql import create_partitions
+
+def create_partitions_parser(sub):
+    partitions = sub.add_parser("partitions", help="Create log_json partitions")
+    partitions.set_defaults(importer=import_partitions)
+    partitions.add_argument("-a", "--ahead", type=int, default=2, metavar="COUNT",
+                            help="Create COUNT empty partitions past the newest log")
+
+def import_partitions(args, c):
+    create_partitions(c, args.ahead)
@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import logging
+import sys
+
+from ..sql import summarize_all, summary_tables, update_leaderboard_ranks
+
+def create_summaries_parser(sub):
+    summaries = sub.add_parser("summaries", help="Check or rebuild per-player summaries")
+    summaries_sub = summaries.add_subparsers()
+    check = summaries_sub.add_parser("check", help=("Compare the summaries against a full "
+                                                     "recompute, and exit with an error if they "
+                                                     "differ"))
+    check.set_defaults(importer=check_summaries)
+    rebuild = summaries_sub.add_parser("rebuild", help="Recompute the summaries from scratch")
+    rebuild.set_defaults(importer=rebuild_summaries)
+    rank = summaries_sub.add_parser("rank", help="Recompute the leaderboard rankings")
+    rank.set_defaults(importer=rank_leaderboard)
+
+def check_summaries(args, c):
+    cur = c.cursor()
+    # Use one snapshot so that imports which commit while we are recomputing don't show up as
+    # inconsistencies
+    cur.execute("BEGIN ISOLATION LEVEL REPEATABLE READ;")
+    for table in summary_tables:
+        cur.execute(f"CREATE TEMP TABLE {table} (LIKE public.{table} INCLUDING INDEXES);")
+    summarize_all(cur, 'pg_temp')
+
+    consistent = True
+    for table in summary_tables:
+        cur.execute(f"""SELECT
+                            (SELECT count(*)
+                             FROM (SELECT * FROM pg_temp.{table}
+                                   EXCEPT ALL
+                                   SELECT * FROM public.{table}) AS missing),
+                            (SELECT count(*)
+                             FROM (SELECT * FROM public.{table}
+                                   EXCEPT ALL
+                                   SELECT * FROM pg_temp.{table}) AS extra);""")
+        missing, extra = cur.fetchone()
+        if missing or extra:
+            logging.error("%s has %s missing or different row(s) and %s extra row(s)", table,
+                          missing, extra)
+            consistent = False
+        else:
+            logging.info("%s is consistent", table)
+    cur.execute("ROLLBACK;")
+
+    if not consistent:
+        sys.exit(1)
+
+def rebuild_summaries(args, c):
+    cur = c.cursor()
+    # Do everything in one transaction so the site never sees a partial summary
+    cur.execute("BEGIN;")
+    cur.execute(f"TRUNCATE {', '.join(summary_tables)};")
+    summarize_all(cur)
+    update_leaderboard_ranks(cur)
+    cur.execute("COMMIT;")
+    logging.info("Rebuilt %s", ", ".join(summary_tables))
+
+def rank_leaderboard(args, c):
+    cur = c.cursor()
+    cur.execute("BEGIN;")
+    update_leaderboard_ranks(cur)
+    cur.execute("COMMIT;")
@@ -3,7 +3,7 @@
 # Copyright (C) 2021 Sean Anderson <seanga2@gmail.com>
 
 import argparse
-import json
+import io
 import os
 import re
 import sys
@@ -11,27 +11,127 @@ import time
 
 import requests
 
-def items_to_json(items):
-    # encapsulate in braces
-    items = "{\n%s\n}" % items
-    # replace open braces
-    items = re.sub(r'"([^"]*)"(\s*){', r'"\1": {', items)
-    # escape backslashes (from windows-style paths)
-    items = re.sub(r'\\', r'\\\\', items)
-    # remove tabs
-    items = re.sub(r'\t', r' ', items)
-    # replace values
-    items = re.sub(r'"([^"]*)"\s*"([^"]*)"', r'"\1": "\2",', items)
-    # remove trailing commas
-    items = re.sub(r',(\s*[}\]])', r'\1', items)
-    # add commas
-    items = re.sub(r'([}\]])(\s*)("[^"]*":\s*)?([{\[])', r'\1,\2\3\4', items)
-    # object as value
-    items = re.sub(r'}(\s*"[^"]*":)',  r'},\1', items)
-    return json.loads(items)
+VDF_TOKEN = re.compile(r'''\s*(?:
+    (?P<comment>//[^\n]*)
+    |"(?P<string>[^"]*)"
+    |(?P<open>{)
+    |(?P<close>})
+    |(?P<conditional>\[[^\]\n]*\])
+    |(?P<bare>[^\s{}"\[]+)
+)''', re.VERBOSE)
+
+# Markers for braces, so they can't be confused with strings
+VDF_OPEN = object()
+VDF_CLOSE = object()
+
+def vdf_tokens(f, size=1 << 16):
+    """Tokenize a VDF (KeyValues) file
+
+    Comments and conditionals (e.g. ``[$WIN32]``) are skipped. Like TF2, escape sequences are not
+    interpreted.
+
+    :param f: The file to read from
+    :param int size: How much to read at once
+    :return: Each string in the file, or :data:`VDF_OPEN` and :data:`VDF_CLOSE` for braces
+    :raises ValueError: If there is trailing garbage, such as an unterminated string
+    """
+
+    buf = ''
+    eof = False
+    while not eof:
+        data = f.read(size)
+        eof = not data
+        buf += data
+
+        pos = 0
+        while match := VDF_TOKEN.match(buf, pos):
+            # This token might continue in the next chunk
+            if match.end() == len(buf) and not eof:
+                break
+
+            pos = match.end()
+            kind = match.lastgroup
+            if kind == 'open':
+                yield VDF_OPEN
+            elif kind == 'close':
+                yield VDF_CLOSE
+            elif kind in ('string', 'bare'):
+                yield match[kind]
+        buf = buf[pos:]
+
+    if buf.strip():
+        raise ValueError(f"Could not parse VDF near {buf[:20]!r}")
+
+def parse_vdf(f, paths=None, size=1 << 16):
+    """Parse a VDF (KeyValues) file in one pass
+
+    Objects are parsed into dicts. Later keys replace earlier ones.
+
+    :param f: The file to read from
+    :param paths: If present, only parse objects at these paths. Everything else is skipped without
+                  being stored. For example, ``(('a', 'b'),)`` would parse ``{"a": {"b": ...}}``
+                  but not ``{"a": {"c": ...}}``.
+    :type paths: sequence of sequences of str
+    :param int size: How much to read at once
+    :return: The parsed file
+    :rtype: dict
+    :raises ValueError: If the file is malformed
+    """
+
+    tokens = vdf_tokens(f, size)
+
+    def next_token():
+        token = next(tokens, None)
+        if token is None:
+            raise ValueError("Unexpected end of VDF")
+        return token
+
+    def skip_object():
+        depth = 1
+        while depth:
+            token = next_token()
+            if token is VDF_OPEN:
+                depth += 1
+            elif token is VDF_CLOSE:
+                depth -= 1
+
+    # A trie of the objects to keep; None keeps everything
+    def parse_object(keep, top=False):
+        obj = {}
+        while True:
+            key = next(tokens, None) if top else next_token()
+            if key is None or key is VDF_CLOSE:
+                if top and key is VDF_CLOSE:
+                    raise ValueError("Unexpected } in VDF")
+                return obj
+            elif key is VDF_OPEN:
+                raise ValueError("Unexpected { in VDF")
+
+            value = next_token()
+            if value is VDF_OPEN:
+                if keep is None:
+                    obj[key] = parse_object(None)
+                elif key in keep:
+                    obj[key] = parse_object(keep[key])
+                else:
+                    skip_object()
+            elif value is VDF_CLOSE:
+                raise ValueError(f"Missing value for {key!r} in VDF")
+            elif keep is None:
+                obj[key] = value
+
+    trie = None
+    if paths is not None:
+        trie = {}
+        for path in paths:
+            node = trie
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = None
+    return parse_object(trie, top=True)
 
 def import_weapons(c, items):
-    items = items_to_json(items)
+    items = parse_vdf(items, (('items_game', 'items'), ('items_game', 'prefabs')))
     weapons = {}
 
     def set_base(name, weapon):
@@ -212,10 +312,11 @@ def import_remote(args, c):
         pass
 
     with open(args.etag, 'w') as etag:
-        resp = s.get(args.url)
+        resp = s.get(args.url, stream=True)
         resp.raise_for_status()
-        import_weapons(c, resp.text)
+        resp.raw.decode_content = True
+        import_weapons(c, io.TextIOWrapper(resp.raw, encoding=resp.encoding or 'utf-8'))
         etag.write(resp.headers['etag'])
 
 def import_local(args, c):
-    import_weapons(c, args.items.read())
+    import_weapons(c, args.items)
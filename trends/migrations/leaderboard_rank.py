@@ -0,0 +1,21 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import logging
+import sys
+
+from ..sql import db_connect, db_schema, update_leaderboard_ranks
+from ..importer.cli import init_logging
+
+def migrate():
+    init_logging(logging.DEBUG)
+    with db_connect(sys.argv[1]) as c:
+        cur = c.cursor()
+        cur.execute("BEGIN;")
+        db_schema(cur)
+        logging.info("CREATE TABLE")
+        update_leaderboard_ranks(cur)
+        cur.execute("COMMIT;")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,6 @@
+BEGIN;
+CREATE SEQUENCE log_version AS BIGINT;
+-- Avoid rewriting the table
+ALTER TABLE log ADD version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE log ALTER version SET DEFAULT nextval('log_version');
+COMMIT;
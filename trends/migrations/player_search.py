@@ -0,0 +1,25 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+# This may also be used to rebuild player_search
+
+import logging
+import sys
+
+from ..sql import db_connect, db_schema, summarize_all, update_player_search
+from ..importer.cli import init_logging
+
+def migrate():
+    init_logging(logging.DEBUG)
+    with db_connect(sys.argv[1]) as c:
+        cur = c.cursor()
+        # Do everything in one transaction so the site never sees a partial summary
+        cur.execute("BEGIN;")
+        db_schema(cur)
+        cur.execute("TRUNCATE player_search;")
+        logging.info("CREATE TABLE")
+        summarize_all(cur, update=update_player_search)
+        cur.execute("COMMIT;")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,3 @@
+BEGIN;
+ALTER TABLE player ADD version BIGINT NOT NULL DEFAULT 0;
+COMMIT;
@@ -69,6 +69,8 @@ CREATE TABLE IF NOT EXISTS player (
 	banned BOOL NOT NULL DEFAULT FALSE,
 	ban_reason TEXT,
 	eu_playerid INT UNIQUE,
+	-- Incremented whenever one of the player's logs is modified; see log.version
+	version BIGINT NOT NULL DEFAULT 0,
 	CHECK (ban_reason NOTNULL = banned)
 );
 
@@ -421,6 +423,9 @@ CREATE TABLE IF NOT EXISTS demo (
 
 CREATE INDEX IF NOT EXISTS demo_time ON demo (time) INCLUDE (demoid);
 
+-- Incremented whenever a log is modified, so cached pages can be invalidated
+CREATE SEQUENCE IF NOT EXISTS log_version AS BIGINT;
+
 CREATE TABLE IF NOT EXISTS log (
 	logid INTEGER PRIMARY KEY, -- SQLite won't infer a rowid alias unless the type is INTEGER
 	time BIGINT NOT NULL, -- Upload time
@@ -439,6 +444,8 @@ CREATE TABLE IF NOT EXISTS log (
 	league LEAGUE,
 	matchid INT,
 	team1_is_red BOOL,
+	-- Set to DEFAULT when updating a log
+	version BIGINT NOT NULL DEFAULT nextval('log_version'),
 	FOREIGN KEY (league, matchid) REFERENCES match (league, matchid),
 	CHECK ((uploader ISNULL) = (uploader_nameid ISNULL)),
 	-- All duplicates must be newer (and have larger logids) than what they are duplicates of
@@ -501,6 +508,12 @@ PARTITION OF log_json (
 	CONSTRAINT minimum CHECK (logid >= 0)
 ) DEFAULT;
 
+-- Progress of backfills extracting data from log_json
+CREATE TABLE IF NOT EXISTS backfill_progress (
+	name TEXT PRIMARY KEY,
+	logid INT NOT NULL -- Logs below this have been processed
+);
+
 CREATE TABLE IF NOT EXISTS round (
 	logid INT NOT NULL REFERENCES log (logid),
 	seq INT NOT NULL, -- Round number, starting at 0
@@ -689,34 +702,205 @@ CREATE STATISTICS IF NOT EXISTS class_stats (ndistinct)
 ON logid, playerid
 FROM class_stats;
 
-CREATE MATERIALIZED VIEW IF NOT EXISTS leaderboard_cube AS SELECT
-	playerid,
-	league,
-	formatid,
-	primary_classid AS classid,
-	mapid,
-	sum(log.duration) AS duration,
-	sum((wins > losses)::INT) AS wins,
-	sum((wins = losses)::INT) AS ties,
-	sum((wins < losses)::INT) AS losses,
-	sum(kills) AS kills,
-	sum(deaths) AS deaths,
-	sum(assists) AS assists,
-	sum(dmg) AS dmg,
-	sum(dt) AS dt,
-	sum(shots) AS shots,
-	sum(hits) AS hits
-FROM log_nodups AS log
-JOIN player_stats USING (logid)
-GROUP BY CUBE (playerid, league, formatid, classid, mapid)
-ORDER BY mapid, classid, formatid, playerid, league
-WITH NO DATA;
+-- Per-player class totals for the player overview, maintained by update_class_summary()
+CREATE TABLE IF NOT EXISTS player_class_summary (
+	playerid INT NOT NULL,
+	classid INT NOT NULL,
+	formatid INT,
+	league LEAGUE,
+	logs INT NOT NULL,
+	-- Results of logs where this class was the player's primary class
+	wins INT NOT NULL,
+	losses INT NOT NULL,
+	ties INT NOT NULL,
+	duration BIGINT NOT NULL,
+	dmg BIGINT NOT NULL,
+	-- Only from logs with accuracy
+	hits BIGINT NOT NULL,
+	shots BIGINT NOT NULL,
+	UNIQUE NULLS NOT DISTINCT (playerid, classid, formatid, league)
+);
+
+-- Per-player totals with and against each peer for the peers page, maintained by
+-- update_peer_summary()
+CREATE TABLE IF NOT EXISTS player_peer (
+	playerid INT NOT NULL,
+	peerid INT NOT NULL,
+	formatid INT,
+	league LEAGUE,
+	logs_with INT NOT NULL,
+	logs_against INT NOT NULL,
+	wins_with INT NOT NULL,
+	ties_with INT NOT NULL,
+	wins_against INT NOT NULL,
+	ties_against INT NOT NULL,
+	duration_with BIGINT NOT NULL,
+	duration_against BIGINT NOT NULL,
+	-- The remaining columns only include logs where the peer was a teammate
+	dmg_with BIGINT NOT NULL,
+	dt_with BIGINT NOT NULL,
+	-- These count the logs which contributed to the above, so we can tell "none" from "0"
+	dt_logs INT NOT NULL,
+	healing_to BIGINT NOT NULL,
+	healing_to_logs INT NOT NULL,
+	healing_from BIGINT NOT NULL,
+	healing_from_logs INT NOT NULL,
+	UNIQUE NULLS NOT DISTINCT (playerid, peerid, formatid, league)
+);
+
+-- Each player's names and how often they were used, for searching. Maintained by
+-- update_player_search().
+CREATE TABLE IF NOT EXISTS player_search (
+	playerid INT NOT NULL,
+	nameid INT NOT NULL,
+	alias TEXT NOT NULL, -- lower(name)
+	logs INT NOT NULL,
+	PRIMARY KEY (playerid, nameid)
+);
+
+CREATE INDEX IF NOT EXISTS player_search_tgrm ON player_search USING GIN (alias gin_trgm_ops);
+
+-- Per-player totals for the totals and maps pages, maintained by update_player_cube(). Unlike
+-- leaderboard_cube, this is not a CUBE; pages sum the rows matching their filters.
+CREATE TABLE IF NOT EXISTS player_cube (
+	playerid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	primary_classid INT,
+	mapid INT NOT NULL,
+	logs INT NOT NULL,
+	wins INT NOT NULL,
+	losses INT NOT NULL,
+	ties INT NOT NULL,
+	round_wins INT NOT NULL,
+	round_losses INT NOT NULL,
+	round_ties INT NOT NULL,
+	duration BIGINT NOT NULL,
+	-- NULL stats count as 0
+	kills BIGINT NOT NULL,
+	deaths BIGINT NOT NULL,
+	assists BIGINT NOT NULL,
+	dmg BIGINT NOT NULL,
+	dt BIGINT NOT NULL,
+	hits BIGINT NOT NULL,
+	shots BIGINT NOT NULL,
+	hr BIGINT NOT NULL,
+	airshots BIGINT NOT NULL,
+	medkits BIGINT NOT NULL,
+	medkits_hp BIGINT NOT NULL,
+	backstabs BIGINT NOT NULL,
+	headshots BIGINT NOT NULL,
+	headshots_hit BIGINT NOT NULL,
+	sentries BIGINT NOT NULL,
+	cpc BIGINT NOT NULL,
+	ic BIGINT NOT NULL,
+	healing BIGINT NOT NULL,
+	ubers BIGINT NOT NULL,
+	drops BIGINT NOT NULL,
+	advantages_lost BIGINT NOT NULL,
+	deaths_after_uber BIGINT NOT NULL,
+	deaths_before_uber BIGINT NOT NULL,
+	UNIQUE NULLS NOT DISTINCT (playerid, league, formatid, primary_classid, mapid)
+);
+
+-- Per-player weapon totals for the weapons page
+CREATE TABLE IF NOT EXISTS player_weapon_cube (
+	playerid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	classid INT NOT NULL,
+	mapid INT NOT NULL,
+	weaponid INT NOT NULL,
+	logs INT NOT NULL,
+	kills BIGINT NOT NULL,
+	duration BIGINT NOT NULL,
+	-- Columns ending in _logs count the logs which contributed to the preceding columns, so we
+	-- can tell "none" from "0"
+	dmg BIGINT NOT NULL,
+	dmg_logs INT NOT NULL,
+	shots BIGINT NOT NULL,
+	hits BIGINT NOT NULL,
+	shots_logs INT NOT NULL,
+	-- Damage from logs with shots/hits, for damage per shot/hit
+	dmg_shot BIGINT NOT NULL,
+	dmg_shot_logs INT NOT NULL,
+	dmg_hit BIGINT NOT NULL,
+	dmg_hit_logs INT NOT NULL,
+	UNIQUE NULLS NOT DISTINCT (playerid, league, formatid, classid, mapid, weaponid)
+);
+
+-- Per-player event totals for the totals page
+CREATE TABLE IF NOT EXISTS player_event_cube (
+	playerid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	primary_classid INT,
+	mapid INT NOT NULL,
+	eventid INT NOT NULL,
+	logs INT NOT NULL,
+	demoman BIGINT NOT NULL,
+	engineer BIGINT NOT NULL,
+	heavyweapons BIGINT NOT NULL,
+	medic BIGINT NOT NULL,
+	pyro BIGINT NOT NULL,
+	scout BIGINT NOT NULL,
+	sniper BIGINT NOT NULL,
+	soldier BIGINT NOT NULL,
+	spy BIGINT NOT NULL,
+	UNIQUE NULLS NOT DISTINCT (playerid, league, formatid, primary_classid, mapid, eventid)
+);
+
+-- A CUBE over league, format, primary class, and map for each player, maintained by
+-- update_leaderboard_cube()
+CREATE TABLE IF NOT EXISTS leaderboard_cube (
+	playerid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	classid INT,
+	mapid INT,
+	-- GROUPING(league, formatid, classid, mapid); distinguishes rollups (e.g. of all leagues) from
+	-- logs which have no league
+	grouping_id INT NOT NULL,
+	logs BIGINT NOT NULL,
+	duration BIGINT NOT NULL,
+	wins BIGINT NOT NULL,
+	ties BIGINT NOT NULL,
+	losses BIGINT NOT NULL,
+	kills BIGINT NOT NULL,
+	deaths BIGINT NOT NULL,
+	assists BIGINT NOT NULL,
+	dmg BIGINT NOT NULL,
+	-- NULL dt counts as 0; dt_logs counts the logs which have it
+	dt BIGINT NOT NULL,
+	dt_logs BIGINT NOT NULL,
+	-- Only from logs with accuracy
+	shots BIGINT NOT NULL,
+	hits BIGINT NOT NULL
+);
 
 CREATE UNIQUE INDEX IF NOT EXISTS leaderboard_pkey
-	ON leaderboard_cube (mapid, classid, formatid, playerid, league);
+	ON leaderboard_cube (mapid, classid, formatid, playerid, league, grouping_id)
+	NULLS NOT DISTINCT;
 
 CREATE INDEX IF NOT EXISTS leaderboard_classid ON leaderboard_cube (classid, formatid);
 
+-- Players in each (map-less) leaderboard_cube cell, sorted by each leaderboard column. This lets
+-- the leaderboard look up a page of players without sorting the whole cell. Refreshed by
+-- update_leaderboard_ranks().
+CREATE TABLE IF NOT EXISTS leaderboard_rank (
+	league LEAGUE,
+	formatid INT,
+	classid INT,
+	-- As for leaderboard_cube
+	grouping_id INT NOT NULL,
+	sort TEXT NOT NULL,
+	-- In descending order, with NULLs last
+	players INT[] NOT NULL,
+	-- The number of players with non-NULL values
+	nonnull INT NOT NULL,
+	UNIQUE NULLS NOT DISTINCT (sort, league, formatid, classid, grouping_id)
+);
+
 CREATE TABLE IF NOT EXISTS weapon (
 	weaponid SERIAL PRIMARY KEY,
 	weapon TEXT NOT NULL UNIQUE,
@@ -2,7 +2,15 @@
 # Copyright (C) 2021 Sean Anderson <seanga2@gmail.com>
 
 from ..util import sentry_init
-from .wsgi import create_app
+from .wsgi import create_app, warmup
 
 sentry_init()
 application = create_app()
+
+try:
+    import uwsgi
+except ImportError:
+    pass
+else:
+    # We are being imported by the uWSGI master, before it forks the workers
+    warmup(application)
@@ -3,9 +3,11 @@
 
 import flask
 import werkzeug.exceptions
+import zstandard
 
-from .common import get_logs, get_players, logs_last_modified
-from .util import get_db, get_pagination
+from .common import get_logs, logs_last_modified
+from .search import autocomplete_players
+from .util import get_db, get_filter_clauses, get_filter_params, get_next_cursor, get_pagination
 
 api = flask.Blueprint('api', __name__)
 
@@ -19,7 +21,9 @@ def json_handler(error):
 
 @api.after_request
 def do_cache(resp):
-    resp.add_etag()
+    # Don't buffer streamed responses just to hash them
+    if not resp.is_streamed:
+        resp.add_etag()
     if resp.cache_control.max_age is None:
         resp.cache_control.max_age = 300
     return resp
@@ -28,7 +32,15 @@ def do_cache(resp):
 def logs():
     if resp := logs_last_modified():
         return resp
-    return flask.jsonify(logs=[dict(log) for log in get_logs()])
+    logs = get_logs().fetchall()
+    if cursor := get_next_cursor(logs):
+        args = flask.request.args.to_dict(flat=False)
+        args.pop('offset', None)
+        args['after'] = cursor
+        next = flask.url_for('.logs', **args)
+    else:
+        next = None
+    return flask.jsonify(logs=[dict(log) for log in logs], next=next)
 
 @api.route('/maps')
 def maps():
@@ -47,4 +59,191 @@ def maps():
 @api.route('/players')
 def players():
     q = flask.request.args.get('q', '', str)
-    return flask.jsonify(players=[dict(player) for player in get_players(q)])
+    return flask.jsonify(players=autocomplete_players(q))
+
+# Number of rows to fetch from the database (and send to the client) at once when exporting
+EXPORT_ITERSIZE = 1000
+
+def export(query, params, itersize=EXPORT_ITERSIZE, raw=False):
+    """Stream the results of a query as newline-delimited JSON
+
+    The rows are fetched using a server-side cursor, so the response starts immediately and memory
+    use doesn't depend on how many rows there are. The response is compressed with zstd if the
+    client accepts it. Each batch of rows is compressed as a separate frame, so clients can
+    decompress it as soon as it arrives.
+
+    :param str query: The query to export
+    :param params: The parameters of the query
+    :param int itersize: The number of rows to fetch at once
+    :param bool raw: Whether the query returns a single column of JSON text, to be sent as-is,
+                     instead of rows to be converted to JSON objects
+    :return: The response
+    :rtype: :py:class:`flask.Response`
+    """
+
+    compress = 'zstd' in flask.request.accept_encodings
+
+    def generate():
+        cctx = zstandard.ZstdCompressor()
+        cur = get_db().cursor(name='export')
+        cur.execute(query, params)
+        while rows := cur.fetchmany(itersize):
+            if raw:
+                chunk = "".join(row[0] + "\n" for row in rows)
+            else:
+                chunk = "".join(flask.json.dumps(dict(row)) + "\n" for row in rows)
+            chunk = chunk.encode()
+            yield cctx.compress(chunk) if compress else chunk
+        cur.close()
+
+    resp = flask.Response(flask.stream_with_context(generate()),
+                          mimetype='application/x-ndjson')
+    if compress:
+        resp.content_encoding = 'zstd'
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+def get_export_clauses(column):
+    """Get clauses for the logid range of an export
+
+    :param str column: The column holding the logid
+    :return: The clauses and their parameters
+    :rtype: tuple of (str, dict)
+    """
+
+    args = flask.request.args
+    params = {
+        'logid_from': args.get('logid_from', type=int),
+        'logid_to': args.get('logid_to', type=int),
+    }
+    clauses = []
+    if params['logid_from'] is not None:
+        clauses.append(f"AND {column} >= %(logid_from)s")
+    if params['logid_to'] is not None:
+        clauses.append(f"AND {column} <= %(logid_to)s")
+    return "\n".join(clauses), params
+
+@api.route('/export/logs')
+def export_logs():
+    filters = get_filter_params()
+    filter_clauses = get_filter_clauses(filters, 'title', 'league', 'format', 'map', 'time')
+    logid_clauses, logid_params = get_export_clauses('logid')
+    return export(
+        """SELECT
+               logid,
+               time,
+               duration,
+               title,
+               map,
+               format,
+               red_score,
+               blue_score,
+               duplicate_of,
+               demoid,
+               league,
+               matchid
+           FROM log
+           JOIN map USING (mapid)
+           LEFT JOIN format USING (formatid)
+           WHERE TRUE
+               {}
+               {}
+           ORDER BY logid;""".format(filter_clauses, logid_clauses),
+        { **filters, **logid_params })
+
+@api.route('/export/player_stats')
+def export_player_stats():
+    filters = get_filter_params()
+    filter_clauses = get_filter_clauses(filters, 'title', 'league', 'format', 'map', 'time')
+    logid_clauses, logid_params = get_export_clauses('log.logid')
+    return export(
+        """SELECT
+               logid,
+               steamid64::TEXT,
+               name,
+               team,
+               classes,
+               class_durations,
+               kills,
+               assists,
+               deaths,
+               dmg,
+               dt,
+               ps.wins AS round_wins,
+               ps.losses AS round_losses,
+               ps.ties AS round_ties,
+               shots,
+               hits
+           FROM log
+           JOIN map USING (mapid)
+           LEFT JOIN format USING (formatid)
+           JOIN player_stats AS ps USING (logid)
+           JOIN player USING (playerid)
+           JOIN name ON (name.nameid = ps.nameid)
+           WHERE TRUE
+               {}
+               {}
+           ORDER BY logid, steamid64;""".format(filter_clauses, logid_clauses),
+        { **filters, **logid_params })
+
+@api.route('/export/matches')
+def export_matches():
+    filters = get_filter_params()
+    filter_clauses = get_filter_clauses(filters, 'league', 'comp', 'divid', time='scheduled')
+    return export(
+        """SELECT
+               league,
+               matchid,
+               compid,
+               comp,
+               divid,
+               div,
+               round,
+               teamid1,
+               teamid2,
+               team1,
+               team2,
+               maps,
+               score1,
+               score2,
+               forfeit,
+               scheduled,
+               submitted
+           FROM match_pretty
+           WHERE TRUE
+               {}
+           ORDER BY league, matchid;""".format(filter_clauses), filters)
+
+@api.route('/export/log_json')
+def export_log_json():
+    logid_clauses, logid_params = get_export_clauses('logid')
+    # Logs are much larger than other rows
+    return export(
+        """SELECT
+               data::TEXT
+           FROM log_json
+           WHERE TRUE
+               {}
+           ORDER BY logid;""".format(logid_clauses), logid_params, itersize=10, raw=True)
+
+@api.route('/log/<int:logid>/raw')
+def log_raw(logid):
+    cur = get_db().cursor()
+    # Casting to TEXT gets the JSON exactly as it was stored, without parsing it
+    cur.execute("SELECT data::TEXT FROM log_json WHERE logid = %s;", (logid,))
+    for (data,) in cur:
+        break
+    else:
+        flask.abort(404)
+
+    data = data.encode()
+    compress = 'zstd' in flask.request.accept_encodings
+    if compress:
+        data = zstandard.ZstdCompressor().compress(data)
+    resp = flask.make_response(data)
+    resp.mimetype = 'application/json'
+    if compress:
+        resp.content_encoding = 'zstd'
+    resp.vary.add('Accept-Encoding')
+    resp.cache_control.max_age = 86400
+    return resp
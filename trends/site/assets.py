@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import os, os.path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+import zstandard
+
+MANIFEST = 'manifest.json'
+# Extensions of files worth compressing; images are already compressed
+COMPRESSIBLE = {'.css', '.ico', '.js', '.json', '.svg', '.txt'}
+
+def compressors():
+    yield '.gz', lambda data: gzip.compress(data, 9, mtime=0)
+    yield '.zst', zstandard.ZstdCompressor(level=19).compress
+    if brotli:
+        yield '.br', lambda data: brotli.compress(data, quality=11)
+
+# Extensions of precompressed variants
+VARIANTS = {'.br', '.gz', '.zst'}
+
+def static_files(folder):
+    """Find static files
+
+    :param str folder: The static folder
+    :return: Paths of files, relative to ``folder``, excluding the manifest and compressed variants
+    :rtype: iterable of str
+    """
+
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.relpath(os.path.join(dirpath, filename), folder)
+            if path != MANIFEST and os.path.splitext(path)[1] not in VARIANTS:
+                yield path.replace(os.sep, '/')
+
+def hash_file(filename):
+    with open(filename, 'rb') as file:
+        digest = hashlib.md5(file.read()).digest()
+    return base64.urlsafe_b64encode(digest)[:10].decode()
+
+def hash_files(folder):
+    """Hash static files
+
+    :param str folder: The static folder
+    :return: A manifest of file paths (as used with ``url_for``) to content hashes
+    :rtype: dict of str to str
+    """
+
+    return { path: hash_file(os.path.join(folder, path)) for path in static_files(folder) }
+
+def load_manifest(folder):
+    """Load the manifest written by :py:func:`build`
+
+    If there is no manifest (such as during development), the files are hashed instead.
+
+    :param str folder: The static folder
+    :return: The manifest
+    :rtype: dict of str to str
+    """
+
+    try:
+        with open(os.path.join(folder, MANIFEST)) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return hash_files(folder)
+
+def write_file(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, filename)
+
+def build(folder):
+    """Write the manifest and precompressed variants of static files
+
+    Each compressible file gets a ``.gz``, ``.zst``, and (if :py:mod:`brotli` is installed) ``.br``
+    variant next to it, if that is smaller than the original.
+
+    :param str folder: The static folder
+    :return: The manifest
+    :rtype: dict of str to str
+    """
+
+    manifest = hash_files(folder)
+    for path in manifest:
+        if os.path.splitext(path)[1] not in COMPRESSIBLE:
+            continue
+
+        filename = os.path.join(folder, path)
+        with open(filename, 'rb') as file:
+            data = file.read()
+
+        for ext, compress in compressors():
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                write_file(filename + ext, compressed)
+            elif os.path.exists(filename + ext):
+                os.remove(filename + ext)
+
+    write_file(os.path.join(folder, MANIFEST), json.dumps(manifest, indent=1).encode())
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a manifest and precompressed variants of static files")
+    parser.add_argument('folder', nargs='?',
+                        default=os.path.join(os.path.dirname(__file__), 'static'),
+                        help="Static folder (default: %(default)s)")
+    args = parser.parse_args()
+    build(args.folder)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,12 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # Copyright (C) 2021 Sean Anderson <seanga2@gmail.com>
 
+import re
+
 import flask
 
-from .util import get_db, get_filter_params, get_filter_clauses, get_order, get_pagination, \
-                  last_modified
+from .util import get_after_clause, get_db, get_filter_params, get_filter_clauses, get_order, \
+                  get_pagination, last_modified
 
 def logs_last_modified():
     db = get_db()
@@ -21,7 +23,8 @@ def get_logs():
         'logid': "logid",
         'duration': "duration",
         'date': "time",
-	}, 'logid')
+	}, 'logid', key='logid')
+    after_clause, after_params = get_after_clause()
     logs = get_db().cursor()
     logs.execute("""SELECT
                         logid,
@@ -39,17 +42,27 @@ def get_logs():
                     LEFT JOIN format USING (formatid)
                     WHERE TRUE
                         {}
+                        {}
                     ORDER BY {}
-                    LIMIT %(limit)s OFFSET %(offset)s;""".format(filter_clauses, order_clause),
-                { **filters, 'limit': limit, 'offset': offset })
+                    LIMIT %(limit)s OFFSET %(offset)s;""".format(filter_clauses, after_clause,
+                                                                 order_clause),
+                { **filters, **after_params, 'limit': limit, 'offset': offset })
     return logs
 
-def get_players(q):
+def get_players(q, prefix=False):
     if len(q) < 3:
         flask.abort(400, "Searches must contain at least 3 characters")
 
+    if prefix:
+        # Match q literally, like PlayerIndex.search
+        pattern = re.sub(r"([\\%_])", r"\\\1", q) + "%"
+    else:
+        pattern = "%{}%".format(q)
+
     limit, offset = get_pagination(limit=25)
     results = get_db().cursor()
+    # Rank players like PlayerIndex.search, so autocompletion is consistent whether or not the
+    # index is used
     results.execute(
         """SELECT
                steamid64::TEXT,
@@ -58,25 +71,19 @@ def get_players(q):
                aliases
            FROM (SELECT
                    playerid,
-                   array_agg(DISTINCT name) AS aliases,
-                   max(rank) AS rank
-               FROM (SELECT
-                       playerid,
-                       name,
-                       similarity(name, %(q)s) AS rank
-                   FROM name
-                   JOIN player_stats USING (nameid)
-                   WHERE name ILIKE %(q)s
-                   ORDER BY rank DESC
-               ) AS matches
+                   array_agg(name ORDER BY logs DESC, name COLLATE "C") AS aliases,
+                   sum(logs) AS rank
+               FROM player_search
+               JOIN name USING (nameid)
+               WHERE alias LIKE lower(%(q)s)
                GROUP BY playerid
            ) AS matches
            JOIN player USING (playerid)
            JOIN name USING (nameid)
            WHERE last_active NOTNULL
-           ORDER BY rank DESC, last_active DESC
+           ORDER BY rank DESC, last_active DESC, playerid DESC
            LIMIT %(limit)s OFFSET %(offset)s;""",
-        { 'q': "%{}%".format(q), 'limit': limit, 'offset': offset})
+        { 'q': pattern, 'limit': limit, 'offset': offset})
     return results
 
 def get_matches(compid, filters, limit=100, offset=0):
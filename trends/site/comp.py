@@ -4,7 +4,7 @@
 import flask
 
 from .common import get_matches
-from .util import get_db, get_filter_params, get_filter_clauses, get_order, get_pagination
+from .util import fanout, get_db, get_filter_params, get_filter_clauses, get_order, get_pagination
 from ..util import leagues
 
 comp = flask.Blueprint('comp', __name__)
@@ -38,52 +38,56 @@ def get_comp():
 
 @comp.route('/')
 def overview(league, compid):
-    db = get_db()
-    divs = db.cursor()
-    divs.execute(
-        """SELECT
-               divid,
-               division AS name,
-               teams
-           FROM (SELECT
-                   league,
-                   compid,
+    def get_divs():
+        divs = get_db().cursor()
+        divs.execute(
+            """SELECT
                    divid,
-                   array_agg(json_build_object(
-                       'teamid', teamid,
-                       'name', team_name,
-                       'avatarhash', avatarhash,
-                       'wins', wins,
-                       'losses', losses,
-                       'ties', ties,
-                       'winrate', (wins + 0.5 * ties) / nullif(wins + losses + ties, 0),
-                       'rounds_won', rounds_won,
-                       'rounds_lost', rounds_lost,
-                       'round_winrate', rounds_won / nullif(rounds_won + rounds_lost, 0)
-                   ) ORDER BY wins + 0.5 * ties DESC,
-                              rounds_won / (rounds_lost + 1) DESC,
-                              team_name) AS teams
-               FROM team_comp
-               JOIN (SELECT
+                   division AS name,
+                   teams
+               FROM (SELECT
                        league,
                        compid,
-                       teamid,
-                       total(win) AS wins,
-                       total(loss) AS losses,
-                       total(tie) AS ties,
-                       total(rounds_won) AS rounds_won,
-                       total(rounds_lost) AS rounds_lost
-                   FROM match_wlt
-                   GROUP BY league, compid, teamid
-               ) AS match USING (league, compid, teamid)
-               GROUP BY league, compid, divid
-           ) AS teams
-           LEFT JOIN division USING (league, compid, divid)
-           LEFT JOIN div_name USING (div_nameid)
-           WHERE league = %s AND compid = %s
-           ORDER BY tier ASC, divid ASC;""", (league, compid))
-
-    matches = get_matches(compid, get_filter_params(), limit=25)
+                       divid,
+                       array_agg(json_build_object(
+                           'teamid', teamid,
+                           'name', team_name,
+                           'avatarhash', avatarhash,
+                           'wins', wins,
+                           'losses', losses,
+                           'ties', ties,
+                           'winrate', (wins + 0.5 * ties) / nullif(wins + losses + ties, 0),
+                           'rounds_won', rounds_won,
+                           'rounds_lost', rounds_lost,
+                           'round_winrate', rounds_won / nullif(rounds_won + rounds_lost, 0)
+                       ) ORDER BY wins + 0.5 * ties DESC,
+                                  rounds_won / (rounds_lost + 1) DESC,
+                                  team_name) AS teams
+                   FROM team_comp
+                   JOIN (SELECT
+                           league,
+                           compid,
+                           teamid,
+                           total(win) AS wins,
+                           total(loss) AS losses,
+                           total(tie) AS ties,
+                           total(rounds_won) AS rounds_won,
+                           total(rounds_lost) AS rounds_lost
+                       FROM match_wlt
+                       GROUP BY league, compid, teamid
+                   ) AS match USING (league, compid, teamid)
+                   GROUP BY league, compid, divid
+               ) AS teams
+               LEFT JOIN division USING (league, compid, divid)
+               LEFT JOIN div_name USING (div_nameid)
+               WHERE league = %s AND compid = %s
+               ORDER BY tier ASC, divid ASC;""", (league, compid))
+        return divs.fetchall()
+
+    def get_overview_matches():
+        return get_matches(compid, get_filter_params(), limit=25).fetchall()
+
+    divs, matches = fanout(get_divs, get_overview_matches)
 
     return flask.render_template("league/comp/overview.html", divs=divs, matches=matches)
 
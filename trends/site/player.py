@@ -5,8 +5,9 @@ from collections import defaultdict
 
 import flask
 
-from .util import get_db, get_mc, get_filter_params, get_filter_clauses, get_order, \
-                  get_pagination, last_modified
+from .series import get_series
+from .util import cached_view, execute_prepared, fanout, get_after_clause, get_db, get_mc, \
+                  get_filter_params, get_filter_clauses, get_order, get_pagination, last_modified
 from ..util import clamp, classes
 
 player = flask.Blueprint('player', __name__)
@@ -18,9 +19,12 @@ def get_player(endpoint, values):
 @player.before_request
 def get_overview():
     cur = get_db().cursor()
-    cur.execute("SELECT playerid, eu_playerid, last_active FROM player WHERE steamid64 = %s;",
-                (flask.g.steamid,))
-    for flask.g.playerid, flask.g.etf2lid, last_active in cur:
+    execute_prepared(cur,
+                     """SELECT playerid, eu_playerid, last_active, version
+                        FROM player
+                        WHERE steamid64 = %s;""",
+                     (flask.g.steamid,))
+    for flask.g.playerid, flask.g.etf2lid, last_active, version in cur:
         if not last_active:
             flask.abort(404)
 
@@ -33,11 +37,11 @@ def get_overview():
     mc = get_mc()
     key = "overview_{}".format(flask.g.steamid)
     player_overview = mc.get(key)
-    if player_overview and player_overview['last_active'] == last_active:
+    if player_overview and player_overview.get('version') == version:
         flask.g.player = player_overview
         return
 
-    cur.execute(
+    execute_prepared(cur,
         """SELECT
                *,
                name,
@@ -69,69 +73,94 @@ def get_overview():
     else:
         flask.abort(404)
 
+# Most of a player's pages only change when one of their logs is added or modified. Rosters are
+# updated independently, so they may be stale until the cache expires.
+cached = cached_view(lambda steamid: flask.g.player['version'])
+
 # The base set of column filters for most queries in this file
 base_filter_columns = frozenset({'league', 'formatid', 'title', 'mapid', 'time', 'logid'})
 # These columns filters should be used when pretty names for class, format, and map are not used
 surrogate_filter_columns = base_filter_columns.union({'primary_classid'})
+# Columns of player_cube which are totaled by the totals page
+total_columns = ('kills', 'deaths', 'assists', 'duration', 'dmg', 'dt', 'hr', 'airshots',
+                 'medkits', 'medkits_hp', 'backstabs', 'headshots', 'headshots_hit', 'sentries',
+                 'cpc', 'ic', 'healing', 'ubers', 'drops', 'advantages_lost', 'deaths_after_uber',
+                 'deaths_before_uber')
 
-def get_logs(c, playerid, filters, duplicates=True, order_clause="logid DESC", limit=100, offset=0):
+def get_logs(c, playerid, filters, duplicates=True, order_clause="logid DESC", after_clause="",
+             after_params={}, limit=100, offset=0):
     real_offset = offset
     filter_clauses = get_filter_clauses(filters, 'primary_classid', 'league', 'formatid', 'title',
                                         'mapid', 'time', 'logid')
     if not duplicates:
         filter_clauses += "\nAND duplicate_of ISNULL"
-    if 'hpm' not in order_clause:
-        filter_clauses += """
-            ORDER BY {} NULLS LAST
+    # Healing is joined in the outer query, so we can only limit early if we aren't sorting by it
+    if 'hpm' in order_clause:
+        inner_clauses = ""
+        outer_clauses = after_clause
+    else:
+        inner_clauses = """{}
+            ORDER BY {}
             LIMIT %(limit)s OFFSET %(real_offset)s
-        """.format(order_clause)
+        """.format(after_clause, order_clause)
+        outer_clauses = ""
         offset = 0
 
     logs = c.cursor()
-    logs.execute(
-        """SELECT
-               ps.logid,
-               title,
-               map,
-               classes,
-               class_pct,
-               wins,
-               losses,
-               ties,
-               format,
-               ps.duration,
-               ps.kills,
-               ps.deaths,
-               ps.assists,
-               dpm,
-               dtm,
-               acc,
-               hsg.healing * 60.0 / ps.duration AS hpm_given,
-               hsr.healing * 60.0 / ps.duration AS hpm_recieved,
-               duplicate_of,
-               demoid,
-               league,
-               matchid,
-               time
+    execute_prepared(logs,
+        """SELECT *
            FROM (SELECT
-                   *,
-                   ps.dmg * 60.0 / nullif(log.duration, 0) AS dpm,
-                   ps.dt * 60.0 / nullif(log.duration, 0) AS dtm,
-                   hits * 1.0 / nullif(shots, 0.0) AS acc
-               FROM log
-               JOIN player_stats AS ps USING (logid)
-               WHERE playerid = %(playerid)s
-                   {}
-           ) as ps
-           JOIN map USING (mapid)
-           LEFT JOIN format USING (formatid)
-           LEFT JOIN heal_stats_given AS hsg USING (logid, playerid)
-           LEFT JOIN heal_stats_received AS hsr USING (logid, playerid)
-           WHERE ps.playerid = %(playerid)s
-           ORDER BY {} NULLS LAST
-           LIMIT %(limit)s OFFSET %(offset)s;""".format(filter_clauses, order_clause),
+                   ps.logid,
+                   title,
+                   map,
+                   classes,
+                   class_pct,
+                   wins,
+                   losses,
+                   ties,
+                   format,
+                   ps.duration,
+                   ps.kills,
+                   ps.deaths,
+                   ps.assists,
+                   dpm,
+                   dtm,
+                   acc,
+                   hsg.healing * 60.0 / ps.duration AS hpm_given,
+                   hsr.healing * 60.0 / ps.duration AS hpm_recieved,
+                   duplicate_of,
+                   demoid,
+                   league,
+                   matchid,
+                   time
+               FROM (SELECT *
+                   FROM (SELECT
+                           *,
+                           ps.dmg * 60.0 / nullif(log.duration, 0) AS dpm,
+                           ps.dt * 60.0 / nullif(log.duration, 0) AS dtm,
+                           hits * 1.0 / nullif(shots, 0.0) AS acc
+                       FROM log
+                       JOIN player_stats AS ps USING (logid)
+                       WHERE playerid = %(playerid)s
+                           {}
+                   ) AS ps
+                   WHERE TRUE
+                       {}
+               ) as ps
+               JOIN map USING (mapid)
+               LEFT JOIN format USING (formatid)
+               LEFT JOIN heal_stats_given AS hsg USING (logid, playerid)
+               LEFT JOIN heal_stats_received AS hsr USING (logid, playerid)
+               WHERE ps.playerid = %(playerid)s
+           ) AS logs
+           WHERE TRUE
+               {}
+           ORDER BY {}
+           LIMIT %(limit)s OFFSET %(offset)s;""".format(filter_clauses, inner_clauses,
+                                                        outer_clauses, order_clause),
         {
             **filters,
+            **after_params,
             'playerid': flask.g.playerid,
             'limit': limit,
             'offset': offset,
@@ -194,99 +223,131 @@ def get_teams(c, filters, order_clause="upper(rostered)", limit=10, offset=0):
     return teams.fetchall()
 
 @player.route('/')
+@cached
 def overview(steamid):
-    c = get_db()
     filters = get_filter_params()
     filter_clauses = get_filter_clauses(filters, *surrogate_filter_columns)
 
-    classes = c.cursor()
-    classes.execute("BEGIN;")
-    classes.execute("LOCK log_nodups IN ACCESS SHARE MODE;")
-    classes.execute(
-        """CREATE TEMP TABLE classes AS SELECT
-               classid,
-               classid = primary_classid AS mostly,
-               wins AS round_wins,
-               losses AS round_losses,
-               cs.duration,
-               cs.dmg,
-               cs.hits,
-               cs.shots
-           FROM player_stats
-           JOIN class_stats cs USING (logid, playerid)
-           JOIN log_nodups USING (logid)
-           WHERE playerid = %(playerid)s
-               {};""".format(filter_clauses), { 'playerid': flask.g.playerid, **filters})
-    classes.execute("COMMIT;")
-    classes.execute("ANALYZE classes");
-    classes.execute(
-        """SELECT
-               *,
-               (wins + 0.5 * ties) / (wins + losses + ties) AS winrate
-           FROM (
-               SELECT
-                   class,
-                   sum(CASE WHEN mostly THEN (round_wins > round_losses)::INT END) AS wins,
-                   sum(CASE WHEN mostly THEN (round_wins < round_losses)::INT END) AS losses,
-                   sum(CASE WHEN mostly THEN (round_wins = round_losses)::INT END) AS ties,
-                   total(duration) AS time,
-                   sum(dmg) * 60.0 / nullif(sum(duration), 0.0) AS dpm,
-                   total(hits) / nullif(sum(shots), 0.0) AS acc,
-                   total(dmg) / nullif(sum(shots), 0.0) AS dps
-               FROM class
-               LEFT JOIN classes USING (classid)
-               WHERE TRUE
-                   {}
-               GROUP BY classid
-               ORDER BY classid
-           ) AS classes;""".format(get_filter_clauses(filters, 'class')),
-        { 'playerid': flask.g.playerid, **filters})
-    classes = classes.fetchall()
-
-    formats = c.cursor()
-    formats.execute(
-        """SELECT
-               format,
-               (wins + 0.5 * ties) /
-                   (wins + losses + ties) AS winrate,
-               data.*
-           FROM (SELECT
-                   formatid,
-                   sum((wins > losses)::INT) AS wins,
-                   sum((wins < losses)::INT) AS losses,
-                   sum((wins = losses)::INT) AS ties,
-                   total(duration) as time
-               FROM log_nodups
-               JOIN player_stats USING (logid)
-               WHERE playerid = %(playerid)s
-                   {}
-               GROUP BY formatid
-           ) AS data
-           JOIN format using (formatid);""".format(filter_clauses),
-        { 'playerid': flask.g.playerid, **filters })
+    def get_classes():
+        # Filtering by league or format can use the summary, but anything else needs the full stats
+        if filter_clauses == get_filter_clauses(filters, 'league', 'formatid'):
+            source = """SELECT
+                            classid,
+                            sum(wins) AS wins,
+                            sum(losses) AS losses,
+                            sum(ties) AS ties,
+                            sum(duration) AS duration,
+                            sum(dmg) AS dmg,
+                            sum(hits) AS hits,
+                            sum(shots) AS shots
+                        FROM player_class_summary
+                        WHERE playerid = %(playerid)s
+                            {}
+                        GROUP BY classid"""
+        else:
+            source = """SELECT
+                            classid,
+                            count(*) FILTER (WHERE mostly AND round_wins > round_losses) AS wins,
+                            count(*) FILTER (WHERE mostly AND round_wins < round_losses) AS losses,
+                            count(*) FILTER (WHERE mostly AND round_wins = round_losses) AS ties,
+                            sum(duration) AS duration,
+                            sum(dmg) AS dmg,
+                            sum(hits) AS hits,
+                            sum(shots) AS shots
+                        FROM (SELECT
+                                classid,
+                                classid = primary_classid AS mostly,
+                                wins AS round_wins,
+                                losses AS round_losses,
+                                cs.duration,
+                                cs.dmg,
+                                cs.hits,
+                                cs.shots
+                            FROM player_stats
+                            JOIN class_stats cs USING (logid, playerid)
+                            JOIN log_nodups USING (logid)
+                            WHERE playerid = %(playerid)s
+                                {}
+                        ) AS classes
+                        GROUP BY classid"""
 
-    aliases = c.cursor()
-    aliases.execute(
+        classes = get_db().cursor()
+        execute_prepared(classes,
             """SELECT
-                   name,
-                   count
+                   *,
+                   (wins + 0.5 * ties) / (wins + losses + ties) AS winrate
+               FROM (
+                   SELECT
+                       class,
+                       -- Only count results when this was a primary class
+                       CASE WHEN wins + losses + ties > 0 THEN wins END AS wins,
+                       CASE WHEN wins + losses + ties > 0 THEN losses END AS losses,
+                       CASE WHEN wins + losses + ties > 0 THEN ties END AS ties,
+                       coalesce(duration, 0) AS time,
+                       dmg * 60.0 / nullif(duration, 0.0) AS dpm,
+                       hits * 1.0 / nullif(shots, 0.0) AS acc,
+                       dmg * 1.0 / nullif(shots, 0.0) AS dps
+                   FROM class
+                   LEFT JOIN ({}) AS classes USING (classid)
+                   WHERE TRUE
+                       {}
+                   ORDER BY classid
+               ) AS classes;""".format(source.format(filter_clauses),
+                                       get_filter_clauses(filters, 'class')),
+            { 'playerid': flask.g.playerid, **filters})
+        return classes.fetchall()
+
+    def get_formats():
+        formats = get_db().cursor()
+        formats.execute(
+            """SELECT
+                   format,
+                   (wins + 0.5 * ties) /
+                       (wins + losses + ties) AS winrate,
+                   data.*
                FROM (SELECT
-                       nameid,
-                       count(*) AS count
-                   FROM player_stats
-                   WHERE playerid = %s
-                   GROUP BY nameid
-                   ORDER BY count(*) DESC
-                   LIMIT 10
-               ) AS names
-               JOIN name USING (nameid)""", (flask.g.playerid,))
-
-    logs = get_logs(c, flask.g.playerid, filters, limit=25, duplicates=False)
-    teams = get_teams(c, filters)
+                       formatid,
+                       sum((wins > losses)::INT) AS wins,
+                       sum((wins < losses)::INT) AS losses,
+                       sum((wins = losses)::INT) AS ties,
+                       total(duration) as time
+                   FROM log_nodups
+                   JOIN player_stats USING (logid)
+                   WHERE playerid = %(playerid)s
+                       {}
+                   GROUP BY formatid
+               ) AS data
+               JOIN format using (formatid);""".format(filter_clauses),
+            { 'playerid': flask.g.playerid, **filters })
+
+        aliases = get_db().cursor()
+        aliases.execute(
+                """SELECT
+                       name,
+                       count
+                   FROM (SELECT
+                           nameid,
+                           count(*) AS count
+                       FROM player_stats
+                       WHERE playerid = %s
+                       GROUP BY nameid
+                       ORDER BY count(*) DESC
+                       LIMIT 10
+                   ) AS names
+                   JOIN name USING (nameid)""", (flask.g.playerid,))
+        return formats.fetchall(), aliases.fetchall()
+
+    def get_recent():
+        c = get_db()
+        logs = get_logs(c, flask.g.playerid, filters, limit=25, duplicates=False)
+        return logs.fetchall(), get_teams(c, filters)
+
+    classes, (formats, aliases), (logs, teams) = fanout(get_classes, get_formats, get_recent)
     return flask.render_template("player/overview.html", logs=logs, classes=classes,
                                  formats=formats, aliases=aliases, teams=teams)
 
 @player.route('/logs')
+@cached
 def logs(steamid):
     limit, offset = get_pagination()
     filters = get_filter_params()
@@ -305,8 +366,11 @@ def logs(steamid):
         'hrm': "hpm_recieved",
         'acc': "acc",
         'date': "time",
-	}, 'logid')
-    logs = get_logs(get_db(), flask.g.playerid, filters, order_clause=order_clause, limit=limit, offset=offset)
+	}, 'logid', key='logid', nulls_last=True)
+    after_clause, after_params = get_after_clause()
+    logs = get_logs(get_db(), flask.g.playerid, filters, order_clause=order_clause,
+                    after_clause=after_clause, after_params=after_params, limit=limit,
+                    offset=offset)
     return flask.render_template("player/logs.html", logs=logs.fetchall())
 
 @player.route('/teams')
@@ -321,6 +385,7 @@ def teams(steamid):
     return flask.render_template("player/teams.html", teams=teams)
 
 @player.route('/peers')
+@cached
 def peers(steamid):
     limit, offset = get_pagination()
     filters = get_filter_params()
@@ -329,7 +394,7 @@ def peers(steamid):
                            title='log.title', mapid='log.mapid', time='log.time', logid='log.logid',
                            primary_classid='p1.primary_classid')
     order, order_clause = get_order({
-        'logs': "count(*)",
+        'logs': "logs",
         'with': '"with"',
         'against': '"against"',
         'winrate_with': "winrate_with",
@@ -341,174 +406,238 @@ def peers(steamid):
         'hgm': "hpm_to",
         'hrm': "hpm_from",
     }, 'logs')
+
+    # Filtering by league or format can use the summary, but anything else needs the full stats
+    if filter_clauses == get_filter_clauses(filters, league='log.league', formatid='log.formatid'):
+        peers_query = """SELECT
+                             peerid AS playerid,
+                             sum(logs_with + logs_against) AS logs,
+                             sum(logs_with) AS with,
+                             sum(logs_against) AS against,
+                             (sum(wins_with) + 0.5 * sum(ties_with)) /
+                                 nullif(sum(logs_with), 0) AS winrate_with,
+                             (sum(wins_against) + 0.5 * sum(ties_against)) /
+                                 nullif(sum(logs_against), 0) AS winrate_against,
+                             sum(dmg_with) * 60.0 / nullif(sum(duration_with), 0) AS dpm,
+                             CASE WHEN sum(dt_logs) > 0 THEN
+                                 sum(dt_with) * 60.0 / nullif(sum(duration_with), 0)
+                             END AS dtm,
+                             CASE WHEN sum(healing_to_logs) > 0 THEN
+                                 sum(healing_to) * 60.0 / nullif(sum(duration_with), 0)
+                             END AS hpm_to,
+                             CASE WHEN sum(healing_from_logs) > 0 THEN
+                                 sum(healing_from) * 60.0 / nullif(sum(duration_with), 0)
+                             END AS hpm_from,
+                             sum(duration_with) AS time_with,
+                             sum(duration_against) AS time_against
+                         FROM player_peer AS log
+                         WHERE playerid = %(playerid)s
+                             {}
+                         GROUP BY peerid"""
+    else:
+        peers_query = """SELECT
+                             playerid,
+                             count(*) AS logs,
+                             total("with"::INT) AS with,
+                             total(against::INT) AS against,
+                             (sum(CASE WHEN "with" THEN win END) +
+                                 0.5 * sum(CASE WHEN "with" THEN tie END)) /
+                                 sum("with"::INT) AS winrate_with,
+                             (sum(CASE WHEN against THEN win END) +
+                                 0.5 * sum(CASE WHEN against THEN tie END)) /
+                                 sum(against::INT) AS winrate_against,
+                             sum(CASE WHEN "with" THEN dmg END) * 60.0 /
+                                 sum(CASE WHEN "with" THEN duration END) AS dpm,
+                             sum(CASE WHEN "with" THEN dt END) * 60.0 /
+                                 sum(CASE WHEN "with" THEN duration END) AS dtm,
+                             sum(CASE WHEN "with" THEN healing_to END) * 60.0 /
+                                 sum(CASE WHEN "with" THEN duration END) AS hpm_to,
+                             sum(CASE WHEN "with" THEN healing_from END) * 60.0 /
+                                 sum(CASE WHEN "with" THEN duration END) AS hpm_from,
+                             total(CASE WHEN "with" THEN duration END) as time_with,
+                             total(CASE WHEN against THEN duration END) as time_against
+                         FROM (
+                             SELECT
+                                 p1.logid,
+                                 p2.playerid,
+                                 p1.team = p2.team AS with,
+                                 p1.team != p2.team AS against,
+                                 (p1.wins > p1.losses)::INT AS win,
+                                 (p1.wins = p1.losses)::INT AS tie,
+                                 p1.dmg,
+                                 p1.dt,
+                                 hs1.healing AS healing_to,
+                                 hs2.healing AS healing_from,
+                                 nullif(log.duration, 0) AS duration
+                             FROM log_nodups AS log
+                             JOIN player_stats AS p1 USING (logid)
+                             JOIN player_stats AS p2 USING (logid)
+                             LEFT JOIN heal_stats AS hs1 ON (
+                                 hs1.healer = p1.playerid
+                                 AND hs1.healee = p2.playerid
+                                 AND hs1.logid = p1.logid
+                             ) LEFT JOIN heal_stats AS hs2 ON (
+                                 hs2.healer = p2.playerid
+                                 AND hs2.healee = p1.playerid
+                                 AND hs2.logid = p1.logid
+                             ) WHERE p1.playerid = %(playerid)s
+                                AND p2.playerid != p1.playerid
+                                AND p2.team NOTNULL
+                                {}
+                         ) AS peers
+                         GROUP BY playerid"""
+
     peers = get_db().cursor()
     peers.execute(
         """SELECT
                *,
                name,
                avatarhash
-           FROM (SELECT
-                   playerid,
-                   total("with"::INT) AS with,
-                   total(against::INT) AS against,
-                   (sum(CASE WHEN "with" THEN win END) +
-                       0.5 * sum(CASE WHEN "with" THEN tie END)) /
-                       sum("with"::INT) AS winrate_with,
-                   (sum(CASE WHEN against THEN win END) +
-                       0.5 * sum(CASE WHEN against THEN tie END)) /
-                       sum(against::INT) AS winrate_against,
-                   sum(CASE WHEN "with" THEN dmg END) * 60.0 /
-                       sum(CASE WHEN "with" THEN duration END) AS dpm,
-                   sum(CASE WHEN "with" THEN dt END) * 60.0 /
-                       sum(CASE WHEN "with" THEN duration END) AS dtm,
-                   sum(CASE WHEN "with" THEN healing_to END) * 60.0 /
-                       sum(CASE WHEN "with" THEN duration END) AS hpm_to,
-                   sum(CASE WHEN "with" THEN healing_from END) * 60.0 /
-                       sum(CASE WHEN "with" THEN duration END) AS hpm_from,
-                   total(CASE WHEN "with" THEN duration END) as time_with,
-                   total(CASE WHEN against THEN duration END) as time_against
-               FROM (
-                   SELECT
-                       p1.logid,
-                       p2.playerid,
-                       p1.team = p2.team AS with,
-                       p1.team != p2.team AS against,
-                       (p1.wins > p1.losses)::INT AS win,
-                       (p1.wins = p1.losses)::INT AS tie,
-                       p1.dmg,
-                       p1.dt,
-                       hs1.healing AS healing_to,
-                       hs2.healing AS healing_from,
-                       nullif(log.duration, 0) AS duration
-                   FROM log_nodups AS log
-                   JOIN player_stats AS p1 USING (logid)
-                   JOIN player_stats AS p2 USING (logid)
-                   LEFT JOIN heal_stats AS hs1 ON (
-                       hs1.healer = p1.playerid
-                       AND hs1.healee = p2.playerid
-                       AND hs1.logid = p1.logid
-                   ) LEFT JOIN heal_stats AS hs2 ON (
-                       hs2.healer = p2.playerid
-                       AND hs2.healee = p1.playerid
-                       AND hs2.logid = p1.logid
-                   ) WHERE p1.playerid = %(playerid)s
-                      AND p2.playerid != p1.playerid
-                      AND p2.team NOTNULL
-                      {}
-               ) AS peers
-               GROUP BY playerid
+           FROM ({}
                ORDER BY {} NULLS LAST
                LIMIT %(limit)s OFFSET %(offset)s
            ) AS peers
            JOIN player USING (playerid)
-           JOIN name USING (nameid);""".format(filter_clauses, order_clause),
+           JOIN name USING (nameid);""".format(peers_query.format(filter_clauses), order_clause),
         { 'playerid': flask.g.playerid, **filters, 'limit': limit, 'offset': offset })
     return flask.render_template("player/peers.html", peers=peers.fetchall())
 
 @player.route('/totals')
+@cached
 def totals(steamid):
     c = get_db()
     filters = get_filter_params()
     filter_clauses = get_filter_clauses(filters, *surrogate_filter_columns)
 
+    # The cube can be used for any filters on its dimensions
+    if filter_clauses == \
+       get_filter_clauses(filters, 'league', 'formatid', 'primary_classid', 'mapid'):
+        totals_query = """SELECT
+                              coalesce(sum(logs), 0)::BIGINT AS logs,
+                              sum(round_wins)::BIGINT AS round_wins,
+                              sum(round_losses)::BIGINT AS round_losses,
+                              sum(round_ties)::BIGINT AS round_ties,
+                              sum(wins)::BIGINT AS wins,
+                              sum(losses)::BIGINT AS losses,
+                              sum(ties)::BIGINT AS ties,
+                              {}
+                          FROM player_cube
+                          WHERE playerid = %(playerid)s
+                              {}""".format(",\n".join(
+                                  f"total({col}) AS {col}" for col in total_columns
+                              ), filter_clauses)
+        events_query = """SELECT
+                              eventid,
+                              {}
+                          FROM player_event_cube
+                          WHERE playerid = %(playerid)s
+                              {}
+                          GROUP BY eventid""".format(",\n".join(
+                              f"total({cls}) AS {cls}" for cls in classes
+                          ), filter_clauses)
+    else:
+        totals_query = """SELECT
+                              count(*) AS logs,
+                              sum(wins) AS round_wins,
+                              sum(losses) AS round_losses,
+                              sum(ties) AS round_ties,
+                              sum((wins > losses)::INT) AS wins,
+                              sum((wins < losses)::INT) AS losses,
+                              sum((wins = losses)::INT) AS ties,
+                              total(ps.kills) AS kills,
+                              total(ps.deaths) AS deaths,
+                              total(ps.assists) AS assists,
+                              total(log.duration) AS duration,
+                              total(ps.dmg) AS dmg,
+                              total(dt) AS dt,
+                              total(hr) AS hr,
+                              total(airshots) AS airshots,
+                              total(medkits) AS medkits,
+                              total(medkits_hp) AS medkits_hp,
+                              total(backstabs) AS backstabs,
+                              total(headshots) AS headshots,
+                              total(headshots_hit) AS headshots_hit,
+                              total(sentries) AS sentries,
+                              total(cpc) AS cpc,
+                              total(ic) AS ic,
+                              -- Medic stuff
+                              total(hs.healing) AS healing,
+                              total(ubers) AS ubers,
+                              total(drops) AS drops,
+                              total(advantages_lost) AS advantages_lost,
+                              total(deaths_after_uber) AS deaths_after_uber,
+                              total(deaths_before_uber) AS deaths_before_uber
+                          FROM player_stats AS ps
+                          LEFT JOIN player_stats_extra AS pse USING (logid, playerid)
+                          JOIN log_nodups AS log USING (logid)
+                          LEFT JOIN medic_stats AS ms USING (logid, playerid)
+                          LEFT JOIN (SELECT
+                                  logid,
+                                  healer AS playerid,
+                                  sum(healing) AS healing
+                              FROM heal_stats
+                              GROUP BY logid, playerid
+                          ) AS hs USING (logid, playerid)
+                          WHERE ps.playerid = %(playerid)s
+                              {}""".format(filter_clauses)
+        events_query = """SELECT
+                              eventid,
+                              total(demoman) AS demoman,
+                              total(engineer) AS engineer,
+                              total(heavyweapons) AS heavyweapons,
+                              total(medic) AS medic,
+                              total(pyro) AS pyro,
+                              total(scout) AS scout,
+                              total(sniper) AS sniper,
+                              total(soldier) AS soldier,
+                              total(spy) AS spy
+                          FROM event
+                          LEFT JOIN event_stats USING (eventid)
+                          LEFT JOIN log_nodups AS log USING (logid)
+                          LEFT JOIN player_stats USING (logid, playerid)
+                          WHERE playerid = %(playerid)s
+                              {}
+                          GROUP BY eventid""".format(filter_clauses)
+
     totals = c.cursor()
-    totals.execute(
+    execute_prepared(totals,
         """SELECT
-               count(*) AS logs,
-               (sum((wins > losses)::INT) + 0.5 * sum((wins = losses)::INT)) /
-                   nullif(count(*), 0) AS winrate,
-               (sum(wins) + 0.5 * sum(ties)) /
-                   nullif(sum(wins + losses + ties), 0) AS round_winrate,
-               sum(wins) AS round_wins,
-               sum(losses) AS round_losses,
-               sum(ties) AS round_ties,
-               sum((wins > losses)::INT) AS wins,
-               sum((wins < losses)::INT) AS losses,
-               sum((wins = losses)::INT) AS ties,
-               total(ps.kills) AS kills,
-               total(ps.deaths) AS deaths,
-               total(ps.assists) AS assists,
-               total(log.duration) AS duration,
-               total(ps.dmg) AS dmg,
-               total(dt) AS dt,
-               total(hr) AS hr,
-               total(airshots) AS airshots,
-               total(medkits) AS medkits,
-               total(medkits_hp) AS medkits_hp,
-               total(backstabs) AS backstabs,
-               total(headshots) AS headshots,
-               total(headshots_hit) AS headshots_hit,
-               total(sentries) AS sentries,
-               total(cpc) AS cpc,
-               total(ic) AS ic,
-               -- Medic stuff
-               total(hs.healing) AS healing,
-               total(ubers) AS ubers,
-               total(drops) AS drops,
-               total(advantages_lost) AS advantages_lost,
-               total(deaths_after_uber) AS deaths_after_uber,
-               total(deaths_before_uber) AS deaths_before_uber,
+               *,
+               (wins + 0.5 * ties) / nullif(logs, 0) AS winrate,
+               (round_wins + 0.5 * round_ties) /
+                   nullif(round_wins + round_losses + round_ties, 0) AS round_winrate,
                -- Averages
-               total(ps.kills) * 30 * 60 / nullif(total(log.duration), 0) AS k30,
-               total(ps.deaths) * 30 * 60 / nullif(total(log.duration), 0) AS d30,
-               total(ps.assists) * 30 * 60 / nullif(total(log.duration), 0) AS a30,
-               total(ps.dmg) * 60 / nullif(total(log.duration), 0) AS dpm,
-               total(ps.dt) * 60 / nullif(total(log.duration), 0) AS dtm,
-               total(hr) * 60 / nullif(total(log.duration), 0) AS hrm,
-               total(airshots) * 30 * 60 / nullif(total(log.duration), 0) AS as30,
-               total(medkits) * 30 * 60 / nullif(total(log.duration), 0) AS mk30,
-               total(medkits_hp) * 60 / nullif(total(log.duration), 0) AS mkhpm,
-               total(backstabs) * 30 * 60 / nullif(total(log.duration), 0) AS bs30,
-               total(headshots) * 30 * 60 / nullif(total(log.duration), 0) AS hs30,
-               total(headshots_hit) * 30 * 60 / nullif(total(log.duration), 0) AS hsh30,
-               total(sentries) * 30 * 60 / nullif(total(log.duration), 0) AS sen30,
-               total(cpc) * 30 * 60 / nullif(total(log.duration), 0) AS cpc30,
-               total(ic) * 30 * 60 / nullif(total(log.duration), 0) AS ic30,
+               kills * 30 * 60 / nullif(duration, 0) AS k30,
+               deaths * 30 * 60 / nullif(duration, 0) AS d30,
+               assists * 30 * 60 / nullif(duration, 0) AS a30,
+               dmg * 60 / nullif(duration, 0) AS dpm,
+               dt * 60 / nullif(duration, 0) AS dtm,
+               hr * 60 / nullif(duration, 0) AS hrm,
+               airshots * 30 * 60 / nullif(duration, 0) AS as30,
+               medkits * 30 * 60 / nullif(duration, 0) AS mk30,
+               medkits_hp * 60 / nullif(duration, 0) AS mkhpm,
+               backstabs * 30 * 60 / nullif(duration, 0) AS bs30,
+               headshots * 30 * 60 / nullif(duration, 0) AS hs30,
+               headshots_hit * 30 * 60 / nullif(duration, 0) AS hsh30,
+               sentries * 30 * 60 / nullif(duration, 0) AS sen30,
+               cpc * 30 * 60 / nullif(duration, 0) AS cpc30,
+               ic * 30 * 60 / nullif(duration, 0) AS ic30,
                -- Medic averages
-               total(hs.healing) * 60 / nullif(total(log.duration), 0) AS hgm,
-               total(ubers) * 30 * 60 / nullif(total(log.duration), 0) AS ub30,
-               total(drops) * 30 * 60 / nullif(total(log.duration), 0) AS drp30,
-               total(advantages_lost) * 30 * 60 / nullif(total(log.duration), 0) AS adl30,
-               total(deaths_after_uber) * 30 * 60 / nullif(total(log.duration), 0) AS dau30,
-               total(deaths_before_uber) * 30 * 60 / nullif(total(log.duration), 0) AS abu30
-           FROM player_stats AS ps
-           LEFT JOIN player_stats_extra AS pse USING (logid, playerid)
-           JOIN log_nodups AS log USING (logid)
-           LEFT JOIN medic_stats AS ms USING (logid, playerid)
-           LEFT JOIN (SELECT
-                   logid,
-                   healer AS playerid,
-                   sum(healing) AS healing
-               FROM heal_stats
-               GROUP BY logid, playerid
-           ) AS hs USING (logid, playerid)
-           WHERE ps.playerid = %(playerid)s
-               {};""".format(filter_clauses),
+               healing * 60 / nullif(duration, 0) AS hgm,
+               ubers * 30 * 60 / nullif(duration, 0) AS ub30,
+               drops * 30 * 60 / nullif(duration, 0) AS drp30,
+               advantages_lost * 30 * 60 / nullif(duration, 0) AS adl30,
+               deaths_after_uber * 30 * 60 / nullif(duration, 0) AS dau30,
+               deaths_before_uber * 30 * 60 / nullif(duration, 0) AS abu30
+           FROM ({}) AS totals;""".format(totals_query),
         {'playerid': flask.g.playerid, **filters})
     totals = totals.fetchone()
 
     events = c.cursor()
-    events.execute(
+    execute_prepared(events,
             """SELECT *
                FROM event
-               LEFT JOIN (SELECT
-                       eventid,
-                       total(demoman) AS demoman,
-                       total(engineer) AS engineer,
-                       total(heavyweapons) AS heavyweapons,
-                       total(medic) AS medic,
-                       total(pyro) AS pyro,
-                       total(scout) AS scout,
-                       total(sniper) AS sniper,
-                       total(soldier) AS soldier,
-                       total(spy) AS spy
-                   FROM event
-                   LEFT JOIN event_stats USING (eventid)
-                   LEFT JOIN log_nodups AS log USING (logid)
-                   LEFT JOIN player_stats USING (logid, playerid)
-                   WHERE playerid = %(playerid)s
-                       {}
-                   GROUP BY eventid) AS data USING (eventid);""".format(filter_clauses),
+               LEFT JOIN ({}) AS data USING (eventid);""".format(events_query),
                { 'playerid': flask.g.playerid, **filters })
 
     # Pivot from rows of events to rows of classes
@@ -526,82 +655,132 @@ def totals(steamid):
     return flask.render_template("player/totals.html", totals=totals, class_totals=class_totals)
 
 @player.route('/weapons')
+@cached
 def weapons(steamid):
     filters = get_filter_params()
     filter_clauses = get_filter_clauses(filters, 'classid', *base_filter_columns)
     weapons = get_db().cursor()
-    weapons.execute(
-        """SELECT
-               weapon,
-               sum(ws.kills) * 30.0 * 60 / nullif(sum(cs.duration), 0) AS k30,
-               sum(ws.dmg) * 60.0 / nullif(sum(cs.duration), 0) AS dpm,
-               sum(CASE WHEN ws.shots::BOOL THEN ws.dmg END) / nullif(sum(ws.shots), 0.0) AS dps,
-               sum(CASE WHEN ws.hits::BOOL THEN ws.dmg END) / nullif(sum(ws.hits), 0.0) AS dph,
-               total(ws.hits) / nullif(sum(ws.shots), 0.0) AS acc,
-               total(ws.kills) AS kills,
-               total(cs.duration) AS duration,
-               total(ws.dmg) AS dmg,
-               sum(ws.shots) AS shots,
-               sum(ws.hits) AS hits,
-               count(*) AS logs
-           FROM weapon_stats AS ws
-           JOIN weapon_pretty USING (weaponid)
-           JOIN class_stats AS cs USING (logid, playerid, classid)
-           JOIN log_nodups AS log USING (logid)
-           WHERE playerid = %(playerid)s
-               {}
-           GROUP BY weapon
-           ORDER BY weapon ASC NULLS LAST;""".format(filter_clauses),
-        {'playerid': flask.g.playerid, **filters})
+    # The cube can be used for any filters on its dimensions
+    if filter_clauses == get_filter_clauses(filters, 'league', 'formatid', 'classid', 'mapid'):
+        weapons.execute(
+            """SELECT
+                   weapon,
+                   sum(kills) * 30.0 * 60 / nullif(sum(duration), 0) AS k30,
+                   CASE WHEN sum(dmg_logs) > 0 THEN sum(dmg) END * 60.0 /
+                       nullif(sum(duration), 0) AS dpm,
+                   CASE WHEN sum(dmg_shot_logs) > 0 THEN sum(dmg_shot) END /
+                       nullif(sum(shots), 0.0) AS dps,
+                   CASE WHEN sum(dmg_hit_logs) > 0 THEN sum(dmg_hit) END /
+                       nullif(sum(hits), 0.0) AS dph,
+                   total(hits) / nullif(sum(shots), 0.0) AS acc,
+                   total(kills) AS kills,
+                   total(duration) AS duration,
+                   total(dmg) AS dmg,
+                   CASE WHEN sum(shots_logs) > 0 THEN sum(shots)::BIGINT END AS shots,
+                   CASE WHEN sum(shots_logs) > 0 THEN sum(hits)::BIGINT END AS hits,
+                   sum(logs)::BIGINT AS logs
+               FROM player_weapon_cube
+               JOIN weapon_pretty USING (weaponid)
+               WHERE playerid = %(playerid)s
+                   {}
+               GROUP BY weapon
+               ORDER BY weapon ASC NULLS LAST;""".format(filter_clauses),
+            {'playerid': flask.g.playerid, **filters})
+    else:
+        weapons.execute(
+            """SELECT
+                   weapon,
+                   sum(ws.kills) * 30.0 * 60 / nullif(sum(cs.duration), 0) AS k30,
+                   sum(ws.dmg) * 60.0 / nullif(sum(cs.duration), 0) AS dpm,
+                   sum(CASE WHEN ws.shots::BOOL THEN ws.dmg END) /
+                       nullif(sum(ws.shots), 0.0) AS dps,
+                   sum(CASE WHEN ws.hits::BOOL THEN ws.dmg END) /
+                       nullif(sum(ws.hits), 0.0) AS dph,
+                   total(ws.hits) / nullif(sum(ws.shots), 0.0) AS acc,
+                   total(ws.kills) AS kills,
+                   total(cs.duration) AS duration,
+                   total(ws.dmg) AS dmg,
+                   sum(ws.shots) AS shots,
+                   sum(ws.hits) AS hits,
+                   count(*) AS logs
+               FROM weapon_stats AS ws
+               JOIN weapon_pretty USING (weaponid)
+               JOIN class_stats AS cs USING (logid, playerid, classid)
+               JOIN log_nodups AS log USING (logid)
+               WHERE playerid = %(playerid)s
+                   {}
+               GROUP BY weapon
+               ORDER BY weapon ASC NULLS LAST;""".format(filter_clauses),
+            {'playerid': flask.g.playerid, **filters})
     return flask.render_template("player/weapons.html", weapons=weapons)
 
 @player.route('/trends')
+@cached
 def trends(steamid):
     filters = get_filter_params()
+    filter_clauses = get_filter_clauses(filters, *surrogate_filter_columns)
     window = clamp(flask.request.args.get('window', 20, int), 1, 500)
-    cur = get_db().cursor()
-    cur.execute(
-        """SELECT
-               log.logid,
-               time,
-               (sum((wins > losses)::INT) OVER win + 0.5 * sum((wins = losses)::INT) OVER win) /
-                   count(*) OVER win AS winrate,
-               (sum(wins + 0.5 * ties) OVER win) /
-                   nullif(sum(wins + losses + ties) OVER win, 0) AS round_winrate,
-               sum(ps.kills) OVER win * 30.0 * 60 /
-                   nullif(sum(log.duration) OVER win, 0) AS kills,
-               sum(ps.deaths) OVER win * 30.0 * 60 /
-                   nullif(sum(log.duration) OVER win, 0) AS deaths,
-               sum(ps.assists) OVER win * 30.0 * 60 /
-                   nullif(sum(log.duration) OVER win, 0) AS assists,
-               sum(ps.dmg) OVER win * 60.0 / nullif(sum(log.duration) OVER win, 0) AS dpm,
-               sum(ps.dt) OVER win * 60.0 /
-                   nullif(sum(nullelse(ps.dt, log.duration)) OVER win, 0) AS dtm,
-               sum(hsg.healing) OVER win * 60.0 /
-                   nullif(sum(nullelse(hsg.healing, log.duration)) OVER win, 0) AS hpm_given,
-               sum(hsr.healing) OVER win * 60.0 /
-                   nullif(sum(nullelse(hsr.healing, log.duration)) OVER win, 0) AS hpm_recieved
-           FROM log_nodups AS log
-           JOIN player_stats AS ps USING (logid)
-           LEFT JOIN heal_stats_given AS hsg USING (logid, playerid)
-           LEFT JOIN heal_stats_received AS hsr USING (logid, playerid)
-           WHERE ps.playerid = %(playerid)s
-               {}
-           WINDOW win AS (
-               PARTITION BY ps.playerid
-               ORDER BY log.logid
-               GROUPS BETWEEN %(window)s - 1 PRECEDING AND CURRENT ROW
-           ) ORDER BY log.logid DESC
-           LIMIT 10000;""".format(get_filter_clauses(filters, *surrogate_filter_columns)),
-           {'playerid': flask.g.playerid, 'window': window, **filters})
-    trends = list(dict(row) for row in cur)
-    trends.reverse()
+    points = flask.request.args.get('points', None, int)
+    if points is not None:
+        points = clamp(points, 3, 10000)
+
+    series = get_series(flask.g.playerid, filters, filter_clauses, flask.g.player['version'])
+    trends = series.trends(window, limit=10000, points=points)
     return flask.render_template("player/trends.html", trends=trends, window=window)
 
 @player.route('/maps')
+@cached
 def maps(steamid):
     filters = get_filter_params()
     filter_clauses = get_filter_clauses(filters, *surrogate_filter_columns)
+    # The cube can be used for any filters on its dimensions
+    if filter_clauses == \
+       get_filter_clauses(filters, 'league', 'formatid', 'primary_classid', 'mapid'):
+        stats_query = """SELECT
+                             mapid,
+                             sum(logs)::BIGINT AS logs,
+                             sum(round_wins)::BIGINT AS round_wins,
+                             sum(round_losses)::BIGINT AS round_losses,
+                             sum(round_ties)::BIGINT AS round_ties,
+                             sum(wins)::BIGINT AS wins,
+                             sum(losses)::BIGINT AS losses,
+                             sum(ties)::BIGINT AS ties,
+                             total(duration) AS duration,
+                             total(kills) AS kills,
+                             total(deaths) AS deaths,
+                             total(assists) AS assists,
+                             total(dmg) AS dmg,
+                             total(dt) AS dt,
+                             total(hits) AS hits,
+                             total(shots) AS shots
+                         FROM player_cube
+                         WHERE playerid = %(playerid)s
+                             {}
+                         GROUP BY mapid"""
+    else:
+        stats_query = """SELECT
+                             mapid,
+                             count(*) AS logs,
+                             sum(wins) AS round_wins,
+                             sum(losses) AS round_losses,
+                             sum(ties) AS round_ties,
+                             sum((wins > losses)::INT) AS wins,
+                             sum((wins < losses)::INT) AS losses,
+                             sum((wins = losses)::INT) AS ties,
+                             total(duration) AS duration,
+                             total(kills) AS kills,
+                             total(deaths) AS deaths,
+                             total(assists) AS assists,
+                             total(dmg) AS dmg,
+                             total(dt) AS dt,
+                             total(hits) AS hits,
+                             total(shots) AS shots
+                         FROM log_nodups
+                         JOIN player_stats using (logid)
+                         WHERE playerid = %(playerid)s
+                             {}
+                         GROUP BY mapid"""
+
     maps = get_db().cursor()
     maps.execute(
         """SELECT
@@ -636,29 +815,7 @@ def maps(steamid):
                     FROM unnest(regexp_split_to_array(lower(map), '[^a-z0-9]+')) AS part
                     WHERE part != '') AS parts,
                    stats.*
-               FROM (SELECT
-                       mapid,
-                       count(*) AS logs,
-                       sum(wins) AS round_wins,
-                       sum(losses) AS round_losses,
-                       sum(ties) AS round_ties,
-                       sum((wins > losses)::INT) AS wins,
-                       sum((wins < losses)::INT) AS losses,
-                       sum((wins = losses)::INT) AS ties,
-                       total(duration) AS duration,
-                       total(kills) AS kills,
-                       total(deaths) AS deaths,
-                       total(assists) AS assists,
-                       total(dmg) AS dmg,
-                       total(dt) AS dt,
-                       total(hits) AS hits,
-                       total(shots) AS shots
-                   FROM log_nodups
-                   JOIN player_stats using (logid)
-                   WHERE playerid = %(playerid)s
-                       {}
-                   GROUP BY mapid
-               ) AS stats
+               FROM ({}) AS stats
                JOIN map USING (mapid)
            ) AS maps
            GROUP BY ROLLUP (parts[1], parts[2], parts[3:])
@@ -668,6 +825,6 @@ def maps(steamid):
                    WHEN grouping(parts[2]) = 0 THEN coalesce(parts[2], '')
                    ELSE NULL
                END NULLS FIRST,
-               parts[3:] COLLATE numeric NULLS FIRST;""".format(filter_clauses),
+               parts[3:] COLLATE numeric NULLS FIRST;""".format(stats_query.format(filter_clauses)),
         {'playerid': flask.g.playerid, **filters})
     return flask.render_template("player/maps.html", maps=maps.fetchall())
@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+import bisect
+from collections import defaultdict
+import heapq
+import threading
+import time
+
+import flask
+from mpmetrics import Counter
+
+from .common import get_players
+from .util import get_db, get_pagination
+
+class PlayerIndex:
+    """A sorted array of aliases, for searching by prefix
+
+    :param rows: Rows of (playerid, alias, logs, steamid64, name, avatarhash, last_active), where
+                 ``alias`` is one of the player's names, ``logs`` is how many logs it was used in,
+                 and ``name`` is the player's current name.
+    """
+
+    def __init__(self, rows):
+        self.players = {}
+        entries = []
+        for playerid, alias, logs, steamid64, name, avatarhash, last_active in rows:
+            self.players[playerid] = (steamid64, name, avatarhash, last_active)
+            entries.append((alias.lower(), -logs, playerid, alias))
+        entries.sort()
+        self.keys = [entry[0] for entry in entries]
+        self.entries = [entry[1:] for entry in entries]
+        self.loaded = time.monotonic()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def load(cls, size):
+        """Load the most-used aliases from the database
+
+        :param int size: The number of aliases to load
+        :return: The index
+        :rtype: PlayerIndex
+        """
+
+        cur = get_db().cursor()
+        cur.execute("""SELECT
+                           playerid,
+                           alias.name,
+                           logs,
+                           steamid64::TEXT,
+                           name.name,
+                           avatarhash,
+                           last_active
+                       FROM (SELECT
+                               playerid,
+                               nameid,
+                               logs
+                           FROM player_search
+                           ORDER BY logs DESC
+                           LIMIT %s
+                       ) AS aliases
+                       JOIN name AS alias USING (nameid)
+                       JOIN player USING (playerid)
+                       JOIN name ON (name.nameid = player.nameid)
+                       WHERE last_active NOTNULL;""", (size,))
+        return cls(cur)
+
+    def search(self, prefix, limit):
+        """Find players with an alias starting with ``prefix``
+
+        Players are ordered by how many logs they used their matching aliases in, and then by how
+        recently they were active. This is the same ranking used by :py:func:`get_players`.
+
+        :param str prefix: The prefix to search for, case-insensitively
+        :param int limit: The maximum number of players to return
+        :return: Players with ``steamid64``, ``name``, ``avatarhash``, and ``aliases`` (the
+                 matching aliases, most-used first)
+        :rtype: list of dict
+        """
+
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\U0010ffff', start)
+
+        logs = defaultdict(int)
+        aliases = defaultdict(list)
+        for neg_logs, playerid, alias in self.entries[start:end]:
+            logs[playerid] -= neg_logs
+            aliases[playerid].append((neg_logs, alias))
+
+        results = []
+        for playerid in heapq.nlargest(limit, logs,
+                                       key=lambda playerid: (logs[playerid],
+                                                             self.players[playerid][3],
+                                                             playerid)):
+            steamid64, name, avatarhash, _ = self.players[playerid]
+            results.append({
+                'steamid64': steamid64,
+                'name': name,
+                'avatarhash': avatarhash,
+                'aliases': [alias for _, alias in sorted(aliases[playerid])],
+            })
+        return results
+
+player_index_requests = Counter('player_index_requests', "Player searches using the in-memory index",
+                                labelnames=('result',))
+
+# Seconds before the index is reloaded
+PLAYER_INDEX_TTL = 3600
+player_index = None
+player_index_lock = threading.Lock()
+
+def get_player_index():
+    """Get this process's player index, loading it if it is missing or stale
+
+    :return: The index, or ``None`` if it is disabled by ``PLAYER_INDEX_SIZE``
+    :rtype: PlayerIndex
+    """
+
+    global player_index
+    size = int(flask.current_app.config['PLAYER_INDEX_SIZE'])
+    if not size:
+        return None
+
+    with player_index_lock:
+        if player_index is None or time.monotonic() - player_index.loaded > PLAYER_INDEX_TTL:
+            player_index = PlayerIndex.load(size)
+        return player_index
+
+def autocomplete_players(q):
+    """Search for players for autocompletion
+
+    Popular aliases are searched by prefix in memory. If that doesn't fill a page, fall back to
+    searching all aliases by prefix with :py:func:`get_players`. Both rank players the same way,
+    except that the index doesn't count the logs of aliases which are too rare to be loaded.
+
+    :param str q: The search query
+    :return: Players, as for :py:meth:`PlayerIndex.search`
+    :rtype: list of dict
+    """
+
+    limit, offset = get_pagination(limit=25)
+    if len(q) >= 3 and not offset and (index := get_player_index()):
+        results = index.search(q, limit)
+        if len(results) == limit:
+            player_index_requests.labels('hit').inc()
+            return results
+        player_index_requests.labels('miss').inc()
+    return [dict(player) for player in get_players(q, prefix=True)]
@@ -0,0 +1,240 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+
+from collections import OrderedDict
+import threading
+
+from mpmetrics import Counter
+import numpy as np
+
+from .util import FILTER_PARAMS, get_db
+
+def rolling_sum(values, window):
+    """Calculate the sum of each value and the ``window - 1`` values preceding it
+
+    :param values: The values to sum
+    :type values: :py:class:`numpy.ndarray`
+    :param int window: The number of values to sum
+    :return: The rolling sums
+    :rtype: :py:class:`numpy.ndarray`
+    """
+
+    sums = np.concatenate(((0,), np.cumsum(values)))
+    ends = np.arange(1, len(sums))
+    return sums[ends] - sums[np.maximum(ends - window, 0)]
+
+def ratio(numerator, denominator, scale=1):
+    """Divide two series, using NaN where the denominator is 0"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator != 0, numerator * scale / denominator, np.nan)
+
+def lttb(x, y, threshold):
+    """Downsample a series with the Largest-Triangle-Three-Buckets algorithm
+
+    The first and last points are always kept. The remaining points are split into ``threshold -
+    2`` buckets, and the point from each bucket which forms the largest triangle with the previous
+    point and the average of the next bucket is kept. NaNs are only kept if their whole bucket is
+    NaN.
+
+    :param x: The x coordinates of the series, in increasing order
+    :type x: :py:class:`numpy.ndarray`
+    :param y: The y coordinates of the series
+    :type y: :py:class:`numpy.ndarray`
+    :param int threshold: The number of points to keep
+    :return: The indices of the points to keep
+    :rtype: :py:class:`numpy.ndarray`
+    """
+
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    valid = ~np.isnan(y)
+    indices = np.empty(threshold, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (end, edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        next_valid = valid[next_start:next_end]
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end][next_valid].mean() if next_valid.any() else 0
+        ay = y[a] if valid[a] else 0
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - ay) - (x[a] - x[start:end]) * (avg_y - ay))
+        a = start + np.argmax(np.where(valid[start:end], area, -1))
+        indices[i + 1] = a
+    return indices
+
+class PlayerSeries:
+    """A player's stats from each log, stored as columns
+
+    :param rows: Rows of (logid, time, win, tie, round_wins, round_losses, round_ties, kills,
+                 deaths, assists, dmg, dt, healing_given, healing_received, duration), ordered by
+                 logid. NULL stats may be ``None``.
+    """
+
+    columns = ('win', 'tie', 'round_wins', 'round_losses', 'round_ties', 'kills', 'deaths',
+               'assists', 'dmg', 'dt', 'healing_given', 'healing_received', 'duration')
+
+    def __init__(self, rows):
+        ids = np.array([row[:2] for row in rows], dtype=np.int64).reshape(-1, 2)
+        self.logid = ids[:, 0]
+        self.time = ids[:, 1]
+        stats = np.array([row[2:] for row in rows], dtype=np.float64) \
+                  .reshape(-1, len(self.columns))
+        for i, col in enumerate(self.columns):
+            setattr(self, col, stats[:, i])
+
+    def __len__(self):
+        return len(self.logid)
+
+    @classmethod
+    def load(cls, playerid, filters, filter_clauses):
+        """Load a player's series from the database
+
+        :param int playerid: The player to load
+        :param filters: Filters from :py:func:`get_filter_params`
+        :param str filter_clauses: Clauses for ``filters`` from :py:func:`get_filter_clauses`
+        :return: The player's series
+        :rtype: PlayerSeries
+        """
+
+        cur = get_db().cursor()
+        cur.execute(
+            """SELECT
+                   log.logid,
+                   time,
+                   (wins > losses)::INT AS win,
+                   (wins = losses)::INT AS tie,
+                   wins,
+                   losses,
+                   ties,
+                   ps.kills,
+                   ps.deaths,
+                   ps.assists,
+                   ps.dmg,
+                   ps.dt,
+                   hsg.healing,
+                   hsr.healing,
+                   log.duration
+               FROM log_nodups AS log
+               JOIN player_stats AS ps USING (logid)
+               LEFT JOIN heal_stats_given AS hsg USING (logid, playerid)
+               LEFT JOIN heal_stats_received AS hsr USING (logid, playerid)
+               WHERE ps.playerid = %(playerid)s
+                   {}
+               ORDER BY log.logid;""".format(filter_clauses),
+            { 'playerid': playerid, **filters })
+        return cls(cur.fetchall())
+
+    def rolling(self, window):
+        """Calculate rolling averages of this series
+
+        Each average covers a log and the ``window - 1`` logs before it. Averages of stats which
+        are not reported in every log only include the duration of logs which have them.
+
+        :param int window: The number of logs to average over
+        :return: Averages for each log, which are NaN if they are undefined
+        :rtype: dict of str to :py:class:`numpy.ndarray`
+        """
+
+        def rsum(values):
+            return rolling_sum(values, window)
+
+        def partial(values):
+            present = ~np.isnan(values)
+            return rsum(np.where(present, values, 0)), rsum(np.where(present, self.duration, 0))
+
+        duration = rsum(self.duration)
+        rounds = rsum(self.round_wins + self.round_losses + self.round_ties)
+        dt, dt_duration = partial(self.dt)
+        given, given_duration = partial(self.healing_given)
+        received, received_duration = partial(self.healing_received)
+        return {
+            'winrate': ratio(rsum(self.win + 0.5 * self.tie), rsum(np.ones(len(self)))),
+            'round_winrate': ratio(rsum(self.round_wins + 0.5 * self.round_ties), rounds),
+            'kills': ratio(rsum(self.kills), duration, 30 * 60),
+            'deaths': ratio(rsum(self.deaths), duration, 30 * 60),
+            'assists': ratio(rsum(self.assists), duration, 30 * 60),
+            'dpm': ratio(rsum(self.dmg), duration, 60),
+            'dtm': ratio(dt, dt_duration, 60),
+            'hpm_given': ratio(given, given_duration, 60),
+            'hpm_recieved': ratio(received, received_duration, 60),
+        }
+
+    def trends(self, window, limit=None, points=None):
+        """Get rolling averages for each log, suitable for charting
+
+        :param int window: The number of logs to average over
+        :param int limit: The number of most-recent logs to return
+        :param int points: If set, downsample each average to this many points. The union of
+                           the points kept for each average is returned.
+        :return: Rows of logid, time, and averages, ordered by logid
+        :rtype: list of dict
+        """
+
+        averages = self.rolling(window)
+        logid = self.logid
+        time = self.time
+        if limit is not None:
+            logid = logid[-limit:]
+            time = time[-limit:]
+            averages = { name: values[-limit:] for name, values in averages.items() }
+
+        if points is not None:
+            x = np.arange(len(logid))
+            indices = np.unique(np.concatenate([lttb(x, values, points)
+                                                for values in averages.values()]))
+            logid = logid[indices]
+            time = time[indices]
+            averages = { name: values[indices] for name, values in averages.items() }
+
+        columns = { 'logid': logid.tolist(), 'time': time.tolist() }
+        for name, values in averages.items():
+            values = values.astype(object)
+            values[np.isnan(averages[name])] = None
+            columns[name] = values.tolist()
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+series_cache_requests = Counter('series_cache_requests', "Lookups of cached player series",
+                                labelnames=('result',))
+
+# Number of series to cache in each process
+SERIES_CACHE_SIZE = 64
+series_cache = OrderedDict()
+series_lock = threading.Lock()
+
+def get_series(playerid, filters, filter_clauses, version):
+    """Get a player's series, loading it from the database if it is not cached
+
+    Series are cached in-process, so requests for the same series with different windows do not
+    need to query the database.
+
+    :param int playerid: The player to get
+    :param filters: Filters from :py:func:`get_filter_params`
+    :param str filter_clauses: Clauses for ``filters`` from :py:func:`get_filter_clauses`
+    :param version: The current version of the player's logs, such as their ``version``
+    :return: The player's series
+    :rtype: PlayerSeries
+    """
+
+    key = (playerid, tuple(filters[name] for name in FILTER_PARAMS),
+           tuple(player['steamid64'] for player in filters['players']))
+    with series_lock:
+        cached = series_cache.get(key)
+        if cached and cached[0] == version:
+            series_cache.move_to_end(key)
+            series_cache_requests.labels('hit').inc()
+            return cached[1]
+
+    series_cache_requests.labels('miss').inc()
+    series = PlayerSeries.load(playerid, filters, filter_clauses)
+    with series_lock:
+        series_cache[key] = (version, series)
+        series_cache.move_to_end(key)
+        while len(series_cache) > SERIES_CACHE_SIZE:
+            series_cache.popitem(last=False)
+    return series
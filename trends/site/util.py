@@ -1,14 +1,25 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # Copyright (C) 2021 Sean Anderson <seanga2@gmail.com>
 
-from functools import wraps
-from collections import namedtuple
+import base64
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dateutil import tz
+import decimal
+from functools import lru_cache, wraps
+import hashlib
 from itertools import islice
+import json
+import os
+import re
 import sys
+import threading
+import time
+import weakref
 
 import flask
+from mpmetrics import Counter, Gauge, Histogram
 import psycopg2
 from psycopg2.extras import NumericRange
 import pylibmc
@@ -36,20 +47,250 @@ def global_context(name):
         return decorated
     return decorator
 
+db_pool_connections = Gauge('db_pool_connections', "Pooled database connections",
+                            labelnames=('state',))
+db_pool_checkouts = Counter('db_pool_checkouts', "Database connections checked out from the pool",
+                            labelnames=('source',))
+db_pool_discards = Counter('db_pool_discards', "Database connections discarded by the pool",
+                           labelnames=('reason',))
+db_pool_connect_time = Histogram('db_pool_connect_seconds', "Time spent opening connections")
+
+class ConnectionPool:
+    """A pool of database connections
+
+    Connections may not be shared between processes, so each (uWSGI) worker needs its own pool.
+    """
+
+    def __init__(self, url, size, timeout):
+        """Create a ``ConnectionPool``
+
+        :param str url: Database to connect to
+        :param int size: Maximum number of idle connections to keep
+        :param int timeout: Statement timeout, in milliseconds
+        """
+
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _pop(self):
+        with self.lock:
+            if not self.idle:
+                return None
+            c = self.idle.pop()
+        db_pool_connections.labels('idle').dec()
+        return c
+
+    def get(self, name):
+        """Check out a connection
+
+        Idle connections are health-checked before being returned. If there are no (healthy) idle
+        connections, a new connection is opened.
+
+        :param str name: The application name to use for the connection
+        :return: A database connection
+        """
+
+        while c := self._pop():
+            try:
+                # Doubles as a health check
+                c.cursor().execute("SELECT set_config('application_name', %s, FALSE);", (name,))
+            except psycopg2.Error:
+                db_pool_discards.labels('unhealthy').inc()
+                c.close()
+            else:
+                db_pool_checkouts.labels('pool').inc()
+                break
+        else:
+            with db_pool_connect_time.time():
+                # Session settings go in the startup packet, so RESET ALL won't undo them
+                c = db_connect(self.url, name, options=f"-c statement_timeout={self.timeout}")
+            db_pool_checkouts.labels('new').inc()
+
+        db_pool_connections.labels('active').inc()
+        return c
+
+    def put(self, c):
+        """Return a connection to the pool
+
+        Any open transaction is rolled back, and session state (such as temporary tables and
+        settings) is reset. Broken connections, or connections in excess of the pool's size, are
+        closed.
+
+        :param c: The connection to return
+        """
+
+        db_pool_connections.labels('active').dec()
+        try:
+            # psycopg2 doesn't notice when we COMMIT ourselves, so always roll back
+            c.rollback()
+            c.autocommit = True
+            c.cursor().execute("DISCARD TEMP; RESET ALL;")
+            c.autocommit = False
+        except psycopg2.Error:
+            db_pool_discards.labels('broken').inc()
+            c.close()
+            return
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(c)
+                db_pool_connections.labels('idle').inc()
+                return
+        db_pool_discards.labels('full').inc()
+        c.close()
+
+    def close(self):
+        """Close all idle connections
+
+        This must be called before forking, since connections may not be shared between processes.
+        """
+
+        while c := self._pop():
+            c.close()
+
+def get_pool():
+    app = flask.current_app
+    pool = app.extensions.get('db_pool')
+    # uWSGI creates the app before forking workers
+    if pool is None or pool.pid != os.getpid():
+        pool = ConnectionPool(app.config['DATABASE'], int(app.config['DATABASE_POOL_SIZE']),
+                              app.config['TIMEOUT'])
+        app.extensions['db_pool'] = pool
+    return pool
+
+db_prepares = Counter('db_prepares', "Statements prepared", labelnames=('endpoint',))
+db_prepared_executions = Counter('db_prepared_executions',
+                                 "Executions of already-prepared statements",
+                                 labelnames=('endpoint',))
+db_prepare_time = Histogram('db_prepare_seconds', "Time spent preparing statements",
+                            labelnames=('endpoint',))
+
+# Names of the statements prepared on each connection, in least-recently-used order
+prepared_statements = weakref.WeakKeyDictionary()
+# Maximum number of statements to keep prepared on each connection
+PREPARED_STATEMENTS_MAX = 128
+
+PLACEHOLDER = re.compile(r"%(?:\((\w+)\))?s|%%")
+
+@lru_cache(maxsize=1024)
+def parse_placeholders(query):
+    keys = []
+    positional = 0
+    def replace(match):
+        nonlocal positional
+        if match[0] == '%%':
+            return '%'
+
+        if match[1] is None:
+            key = positional
+            positional += 1
+        else:
+            key = match[1]
+        if key not in keys:
+            keys.append(key)
+        return f"${keys.index(key) + 1}"
+
+    text = PLACEHOLDER.sub(replace, query)
+    return "stmt_{}".format(hashlib.md5(query.encode()).hexdigest()), text, tuple(keys)
+
+def execute_prepared(cur, query, vars=None):
+    """Execute a query as a server-side prepared statement
+
+    The first time a query is executed on a connection, it is prepared. Afterwards, only its
+    parameters are sent. This lets postgres skip parsing and analyzing the query, and planning it
+    once a generic plan is chosen. Queries are identified by their text, so queries with different
+    filter clauses are prepared separately.
+
+    Parameter types are inferred by postgres, so they may need casts. Tuple parameters (e.g. for
+    ``IN %s``) cannot be prepared, and such queries are executed normally. Use arrays (e.g.
+    ``= ANY(%s)``) instead.
+
+    Planning time saved can be estimated from ``db_prepared_executions`` and ``db_prepare_seconds``.
+
+    :param cur: The cursor to execute with
+    :param str query: The query to execute, with psycopg2-style placeholders
+    :param vars: The parameters of the query
+    """
+
+    name, text, keys = parse_placeholders(query)
+    values = tuple(vars[key] for key in keys)
+    if any(isinstance(value, tuple) for value in values):
+        cur.execute(query, vars)
+        return
+
+    endpoint = flask.request.endpoint
+    statements = prepared_statements.setdefault(cur.connection, OrderedDict())
+    if name in statements:
+        statements.move_to_end(name)
+        db_prepared_executions.labels(endpoint).inc()
+    else:
+        if len(statements) >= PREPARED_STATEMENTS_MAX:
+            cur.execute(f"DEALLOCATE {statements.popitem(last=False)[0]};")
+        start = time.monotonic()
+        cur.execute(f"PREPARE {name} AS {text}")
+        db_prepare_time.labels(endpoint).observe(time.monotonic() - start)
+        db_prepares.labels(endpoint).inc()
+        statements[name] = None
+
+    if values:
+        cur.execute(f"EXECUTE {name} ({', '.join(('%s',) * len(values))});", values)
+    else:
+        cur.execute(f"EXECUTE {name};")
+
 @global_context('db_conn')
 def get_db():
     try:
-        c = db_connect(flask.current_app.config['DATABASE'],
-                       "{} {}".format(sys.argv[0], flask.request.path))
+        return get_pool().get("{} {}".format(sys.argv[0], flask.request.path))
     except psycopg2.OperationalError as error:
         flask.current_app.logger.exception("Could not connect to database")
         raise werkzeug.exceptions.ServiceUnavailable() from error
-    c.cursor().execute("SET statement_timeout = %s;", (flask.current_app.config['TIMEOUT'],))
-    return c
 
 def put_db(exception):
     if db := flask.g.pop('db_conn', None):
-        db.close()
+        get_pool().put(db)
+
+def fanout(*funcs):
+    """Call functions concurrently, each with its own database connection
+
+    The first function is called in the current thread, and the rest are called in new threads.
+    Each thread gets a copy of the request context and of ``flask.g`` (except for connections), so
+    functions may use :func:`get_db` as usual. Since each function uses a different connection,
+    they cannot see each other's temporary tables or uncommitted changes, and may see slightly
+    different snapshots of the database. Results must be fetched before returning, as connections
+    are returned to the pool when each thread finishes.
+
+    :param funcs: The functions to call, without arguments
+    :return: What each function returned
+    :rtype: list
+    """
+
+    state = { name: flask.g.get(name) for name in flask.g if name not in ('db_conn', 'mc_conn') }
+
+    def call(f):
+        for name, value in state.items():
+            setattr(flask.g, name, value)
+
+        # Re-raise exceptions in the original thread, so teardown sees them only once
+        try:
+            return f(), None
+        except Exception as error:
+            return None, error
+
+    with ThreadPoolExecutor(max(len(funcs) - 1, 1)) as executor:
+        # Each thread needs its own copy of the request context
+        futures = [executor.submit(flask.copy_current_request_context(call), f)
+                   for f in funcs[1:]]
+        results = [funcs[0]()] if funcs else []
+        for future in futures:
+            result, error = future.result()
+            if error:
+                raise error
+            results.append(result)
+    return results
 
 class NoopClient:
     def get(self, key, default=None):
@@ -72,6 +313,220 @@ def get_mc():
             flask.current_app.logger.exception("Could not connect to memcached")
     return NoopClient()
 
+view_cache_requests = Counter('view_cache_requests', "Lookups of cached views",
+                              labelnames=('endpoint', 'result'))
+
+# Request arguments parsed by get_filter_params
+FILTER_ARGS = frozenset({'class', 'format', 'league', 'comp', 'divid', 'steamid64', 'map', 'title',
+                         'name', 'date_from', 'date_to', 'timezone'})
+# Parameters which normalize the above
+FILTER_PARAMS = ('class', 'format', 'league', 'comp', 'divid', 'map', 'title', 'name',
+                 'date_from_ts', 'date_to_ts')
+
+def get_cache_key():
+    """Get a key identifying the current request
+
+    Filters are normalized, so requests with equivalent filters share a key. Other arguments (such
+    as ordering and pagination) are included as-is.
+
+    :return: A memcached-safe key
+    :rtype: str
+    """
+
+    filters = get_filter_params()
+    args = sorted((name, value) for name, value in flask.request.args.items(multi=True)
+                  if name not in FILTER_ARGS)
+    key = repr((
+        flask.request.view_args,
+        tuple(filters[name] for name in FILTER_PARAMS),
+        tuple(player['steamid64'] for player in filters['players']),
+        args,
+    ))
+    return "view_{}_{}".format(flask.request.endpoint, hashlib.md5(key.encode()).hexdigest())
+
+def cached_view(version, timeout=60 * 60):
+    """Cache the rendered output of a view in memcached
+
+    Cached output is keyed on the endpoint, view arguments, filters, and request arguments. It is
+    only used if its version matches the current version, so views should be cached only if all of
+    their data changes along with the version.
+
+    :param version: Function returning the current version of the view's data, such as a player's
+                    ``version``. It is called with the view's arguments.
+    :param int timeout: Seconds after which cached output expires, limiting how long stale output
+                        (e.g. from before a template changed) may be served.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            mc = get_mc()
+            key = get_cache_key()
+            current = version(*args, **kwargs)
+            cached = mc.get(key)
+            if cached and cached['version'] == current:
+                view_cache_requests.labels(flask.request.endpoint, 'hit').inc()
+                return cached['body']
+
+            view_cache_requests.labels(flask.request.endpoint, 'miss').inc()
+            body = f(*args, **kwargs)
+            if isinstance(body, str):
+                mc.set(key, { 'version': current, 'body': body }, time=timeout,
+                       min_compress_len=1024)
+            return body
+        return decorated
+    return decorator
+
+# Tokens of a parsed ILIKE pattern, standing for '%' and '_'
+LIKE_ANY = object()
+LIKE_ONE = object()
+
+def parse_like(pattern):
+    """Parse an ``ILIKE`` pattern for :py:func:`like_match`
+
+    :param str pattern: The pattern, using the default escape character
+    :return: :py:data:`LIKE_ANY`, :py:data:`LIKE_ONE`, or a lower-case character for each
+             (unescaped) character of the pattern
+    :rtype: tuple
+    """
+
+    tokens = []
+    chars = iter(pattern)
+    for c in chars:
+        if c == '\\':
+            tokens.append(next(chars, c).lower())
+        elif c == '%':
+            tokens.append(LIKE_ANY)
+        elif c == '_':
+            tokens.append(LIKE_ONE)
+        else:
+            tokens.append(c.lower())
+    return tuple(tokens)
+
+def like_match(tokens, string):
+    """Match a whole string against a parsed ``ILIKE`` pattern
+
+    Only the most recent ``%`` needs to be backtracked to: if the rest of the pattern can't match
+    after it, then letting an earlier ``%`` match more won't help. This takes at most
+    O(len(tokens) * len(string)) steps, unlike a backtracking regular expression, which can take
+    exponential time for patterns like ``%_%_%_%Z%``.
+
+    :param tokens: The pattern, from :py:func:`parse_like`
+    :type tokens: tuple
+    :param str string: The string to match
+    :rtype: bool
+    """
+
+    string = string.lower()
+    t = s = 0
+    # Where to resume after the most recent '%' if the rest of the pattern doesn't match
+    star = None
+    while s < len(string):
+        if t < len(tokens) and (tokens[t] is LIKE_ONE or tokens[t] == string[s]):
+            t += 1
+            s += 1
+        elif t < len(tokens) and tokens[t] is LIKE_ANY:
+            t += 1
+            star = (t, s)
+        elif star:
+            # Let the '%' match one more character
+            t, s = star[0], star[1] + 1
+            star = (t, s)
+        else:
+            return False
+    return all(token is LIKE_ANY for token in tokens[t:])
+
+class Dimensions:
+    """Small tables which rarely change, for resolving filters without querying them
+
+    :param cur: The cursor to load the tables with
+    """
+
+    def __init__(self, cur):
+        # Names map to tuples of ids, since competition names are not unique
+        cur.execute("SELECT class, classid FROM class;")
+        self.classes = { name: (id,) for name, id in cur }
+        cur.execute("SELECT format, formatid FROM format;")
+        self.formats = { name: (id,) for name, id in cur }
+        cur.execute("SELECT name, array_agg(compid ORDER BY compid) FROM competition GROUP BY name;")
+        self.comps = { name: tuple(ids) for name, ids in cur }
+        cur.execute("SELECT map, mapid FROM map ORDER BY mapid;")
+        self.maps = [tuple(row) for row in cur]
+        self.match_maps = lru_cache(maxsize=256)(self._match_maps)
+        self.loaded = time.monotonic()
+
+    def _match_maps(self, pattern):
+        """Find maps matching an ``ILIKE`` pattern
+
+        :param str pattern: The pattern to match
+        :return: The ids of matching maps
+        :rtype: tuple of int
+        """
+
+        tokens = parse_like(pattern)
+        return tuple(mapid for map, mapid in self.maps if like_match(tokens, map))
+
+# Seconds before dimensions and players are reloaded
+DIMENSIONS_TTL = 600
+dimensions = None
+dimensions_lock = threading.Lock()
+
+def get_dimensions():
+    """Get this process's dimensions, loading them if they are missing or stale
+
+    :rtype: Dimensions
+    """
+
+    global dimensions
+    with dimensions_lock:
+        if dimensions is None or time.monotonic() - dimensions.loaded > DIMENSIONS_TTL:
+            dimensions = Dimensions(get_db().cursor())
+        return dimensions
+
+# Players looked up for filters, by steamid64, in least-recently-used order
+filter_players = OrderedDict()
+filter_players_lock = threading.Lock()
+FILTER_PLAYERS_MAX = 1024
+
+def get_filter_players(steamids):
+    """Look up players to filter by
+
+    :param steamids: The steamid64s of the players
+    :type steamids: tuple of int
+    :return: Players with ``steamid64``, ``playerid``, ``avatarhash``, and ``name``, in the order
+             they were requested. Unknown players are omitted.
+    :rtype: list
+    """
+
+    now = time.monotonic()
+    players = {}
+    with filter_players_lock:
+        for steamid in steamids:
+            if (entry := filter_players.get(steamid)) and now - entry[0] <= DIMENSIONS_TTL:
+                filter_players.move_to_end(steamid)
+                players[steamid] = entry[1]
+
+    if missing := tuple(steamid for steamid in steamids if steamid not in players):
+        cur = get_db().cursor()
+        cur.execute("""SELECT
+                           steamid64,
+                           playerid,
+                           avatarhash,
+                           name
+                       FROM player
+                       JOIN name USING (nameid)
+                       WHERE steamid64 IN %s;""",
+                    (missing,))
+        with filter_players_lock:
+            for player in cur:
+                players[player['steamid64']] = player
+                filter_players[player['steamid64']] = (now, player)
+                filter_players.move_to_end(player['steamid64'])
+            while len(filter_players) > FILTER_PLAYERS_MAX:
+                filter_players.popitem(last=False)
+
+    return [players[steamid] for steamid in dict.fromkeys(steamids) if steamid in players]
+
 @global_context('filters')
 def get_filter_params():
     args = flask.request.args
@@ -83,17 +538,7 @@ def get_filter_params():
     params['comp'] = args.get('comp', type=str)
     params['divid'] = args.get('divid', type=int)
     if val := tuple(args.getlist('steamid64', type=int)[:5]):
-        players = get_db().cursor()
-        players.execute("""SELECT
-                               steamid64,
-                               playerid,
-                               avatarhash,
-                               name
-                           FROM player
-                           JOIN name USING (nameid)
-                           WHERE steamid64 IN %s;""",
-                        (val,))
-        params['players'] = players.fetchall()
+        params['players'] = get_filter_players(val)
     else:
         params['players'] = ()
 
@@ -107,6 +552,16 @@ def get_filter_params():
     set_like_param('title')
     set_like_param('name')
 
+    # Resolve names to ids here, so queries don't need subqueries against the dimension tables.
+    # The ids are passed as (array) parameters, so the text of prepared statements doesn't depend
+    # on them. Unknown names resolve to no ids, which match nothing.
+    if params['class'] or params['format'] or params['comp'] or params['map']:
+        dims = get_dimensions()
+        params['classids'] = list(dims.classes.get(params['class'], ()))
+        params['formatids'] = list(dims.formats.get(params['format'], ()))
+        params['compids'] = list(dims.comps.get(params['comp'], ()))
+        params['mapids'] = list(dims.match_maps(params['map'])) if params['map'] else []
+
     timezone = args.get('timezone', tz.UTC, tz.gettz)
     def set_date_params(name):
         name_ts = "{}_ts".format(name)
@@ -146,29 +601,21 @@ def get_filter_clauses(params, *valid_columns, **column_map):
     id_clause('league')
     id_clause('divid')
 
-    def simple_clause(name, column, table=None, table_col=None):
+    def simple_clause(name, column):
         if not params[name]:
             return
 
         if name in column_map:
             clauses.append(f"AND {column_map[name]} = %({name})s")
         elif column in column_map:
-            clauses.append(f"""AND {column_map[column]} = (
-                                   SELECT {column}
-                                   FROM {name if table is None else table}
-                                   WHERE {name if table_col is None else table_col} = %({name})s
-                               )""")
+            clauses.append(f"AND {column_map[column]} = ANY(%({column}s)s::INT[])")
 
     simple_clause('class', 'classid')
     simple_clause('format', 'formatid')
-    simple_clause('comp', 'compid', 'competition', 'name')
+    simple_clause('comp', 'compid')
 
     if 'primary_classid' in column_map and params['class']:
-        clauses.append(f"""AND {column_map['primary_classid']} = (
-                               SELECT classid
-                               FROM class
-                               WHERE class = %(class)s
-                           )""")
+        clauses.append(f"AND {column_map['primary_classid']} = ANY(%(classids)s::INT[])")
 
     def like_clause(name):
         if name in column_map and params[name]:
@@ -179,11 +626,7 @@ def get_filter_clauses(params, *valid_columns, **column_map):
     like_clause('map')
 
     if 'mapid' in column_map and params['map']:
-        clauses.append(f"""AND {column_map['mapid']} IN (
-                               SELECT mapid
-                               FROM map
-                               WHERE map ILIKE %(map)s
-                           )""")
+        clauses.append(f"AND {column_map['mapid']} = ANY(%(mapids)s::INT[])")
 
     def date_clause(name, op):
         if 'time' in column_map and params[name]:
@@ -213,8 +656,23 @@ def get_filter_clauses(params, *valid_columns, **column_map):
 
 dir_map = {'desc': "DESC", 'asc': "ASC"}
 
+Keyset = namedtuple('Keyset', ('column', 'key', 'dir', 'nulls_last'))
+
 @global_context('order')
-def get_order(column_map, default_column, default_dir='desc'):
+def get_order(column_map, default_column, default_dir='desc', key=None, nulls_last=False):
+    """Get the order to sort rows by
+
+    :param column_map: Map of ``sort`` parameter values to the columns to sort by
+    :type column_map: dict of str to str
+    :param str default_column: The column to sort by if none is specified
+    :param str default_dir: The direction to sort by if none is specified
+    :param str key: A unique column to break ties with. If set, the ``after`` parameter may be
+                    used to paginate (see :py:func:`get_after_clause`). The sort columns and key
+                    must also be the names of columns in the result.
+    :param bool nulls_last: Whether the sort columns may be NULL. NULLs sort last.
+    :return: The order as request parameters, and the ``ORDER BY`` clause
+    :rtype: tuple of (dict, str)
+    """
     args = flask.request.args
 
     column = args.get('sort', type=str)
@@ -225,8 +683,84 @@ def get_order(column_map, default_column, default_dir='desc'):
     if dir not in dir_map.keys():
         dir = default_dir
 
-    return ({ 'sort': column, 'sort_dir': dir },
-            "{} {}".format(column_map[column], dir_map[dir]))
+    order = { 'sort': column, 'sort_dir': dir }
+    column = column_map[column]
+    dir = dir_map[dir]
+    if key is None:
+        return order, "{} {}".format(column, dir)
+
+    flask.g.keyset = Keyset(column, key, dir, nulls_last)
+    order_clause = "{} {}{}".format(column, dir, " NULLS LAST" if nulls_last else "")
+    if column != key:
+        order_clause += ", {} {}".format(key, dir)
+    return order, order_clause
+
+def encode_cursor(values):
+    # Numeric values are encoded as strings to avoid losing precision
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode() \
+                 .rstrip('=')
+
+def decode_cursor(cursor):
+    def decode_value(value):
+        if isinstance(value, str):
+            return decimal.Decimal(value)
+        if value is None or isinstance(value, (int, float)):
+            return value
+        raise ValueError("Invalid cursor value")
+
+    values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Cursors must have two values")
+    return [decode_value(value) for value in values]
+
+def get_after_clause():
+    """Get a clause selecting the rows after the ``after`` parameter
+
+    Unlike ``OFFSET``, this lets postgres skip directly to the next page, instead of fetching and
+    discarding all of the rows before it. :py:func:`get_order` must be called with a ``key``
+    first. Cursors are opaque, and are created by :py:func:`get_next_cursor`.
+
+    :return: The clause, and its parameters
+    :rtype: tuple of (str, dict)
+    """
+
+    cursor = flask.request.args.get('after', type=str)
+    if not cursor:
+        return "", {}
+
+    try:
+        value, key = decode_cursor(cursor)
+    except (ValueError, decimal.InvalidOperation):
+        flask.abort(400, "Invalid cursor")
+
+    keyset = flask.g.keyset
+    op = '<' if keyset.dir == "DESC" else '>'
+    params = { 'after_value': value, 'after_key': key }
+    if keyset.column == keyset.key:
+        clause = f"AND {keyset.key} {op} %(after_key)s"
+    elif not keyset.nulls_last:
+        clause = f"AND ({keyset.column}, {keyset.key}) {op} (%(after_value)s, %(after_key)s)"
+    elif value is None:
+        clause = f"AND {keyset.column} ISNULL AND {keyset.key} {op} %(after_key)s"
+    else:
+        clause = f"""AND ({keyset.column} {op} %(after_value)s
+                         OR ({keyset.column} = %(after_value)s
+                             AND {keyset.key} {op} %(after_key)s)
+                         OR {keyset.column} ISNULL)"""
+    return clause, params
+
+def get_next_cursor(rows):
+    """Get a cursor for the page after ``rows``, or ``None`` if there are no more rows
+
+    :param rows: The rows on this page
+    :type rows: list of :py:class:`psycopg2.extras.DictRow`
+    :rtype: str
+    """
+
+    keyset = flask.g.get('keyset')
+    if keyset is None or not rows or len(rows) < get_pagination().limit:
+        return None
+    return encode_cursor((rows[-1][keyset.column], rows[-1][keyset.key]))
 
 Page = namedtuple('Page', ('limit', 'offset'))
 
@@ -1,25 +1,25 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # Copyright (C) 2020-21 Sean Anderson <seanga2@gmail.com>
 
-import base64
 from decimal import Decimal
 import gettext
-import hashlib
-import os, os.path
+import os
 import sys
 
 import blinker
 import flask
+import jinja2
 import sentry_sdk
 import werkzeug.exceptions
 import werkzeug.routing
-import werkzeug.utils
 
 from .api import api, json_handler
+from .assets import load_manifest
 from .league import league
 from .player import player
 from .root import root, metrics_extension
-from .util import put_db
+from .search import get_player_index
+from .util import get_dimensions, get_next_cursor, get_pool, put_db
 
 @flask.before_render_template.connect_via(blinker.ANY)
 def trace_template_start(app, template, context):
@@ -39,12 +39,18 @@ def trace_template_error(app, exception):
 
 class DefaultConfig:
     DATABASE = "postgresql:///trends"
+    DATABASE_POOL_SIZE = 4
     TIMEOUT = 60000
     MEMCACHED_SERVERS = "127.0.0.1:11211"
+    # Number of aliases to search in-memory for autocompletion, or 0 to disable
+    PLAYER_INDEX_SIZE = 100000
+    # Directory to cache compiled templates in, if any
+    TEMPLATE_CACHE = None
 
 class EnvConfig:
     def __init__(self):
-        for name in ("DATABASE", "TIMEOUT", "MEMCACHED_SERVERS"):
+        for name in ("DATABASE", "DATABASE_POOL_SIZE", "TIMEOUT", "MEMCACHED_SERVERS",
+                     "PLAYER_INDEX_SIZE", "TEMPLATE_CACHE"):
             val = os.environ.get(name)
             if val is not None:
                 setattr(self, name, val)
@@ -103,29 +109,11 @@ def wlt_class(wins, losses):
 
 class StaticHashDefaults:
     def __init__(self, app):
-        self.app = app
-        self.cache = {}
+        self.manifest = load_manifest(app.static_folder)
 
     def __call__(self, endpoint, values):
-        if endpoint != 'static' or 'filename' not in values:
-            return
-
-        filename = werkzeug.utils.safe_join(self.app.static_folder, values['filename'])
-        if not os.path.isfile(filename):
-            return
-
-        mtime, hash = self.cache.get(filename, (None, None))
-        if mtime == os.path.getmtime(filename):
+        if endpoint == 'static' and (hash := self.manifest.get(values.get('filename'))):
             values['h'] = hash
-            return
-
-        hash = hashlib.md5()
-        with open(filename, 'rb') as file:
-            hash.update(file.read())
-        hash = base64.urlsafe_b64encode(hash.digest())[:10]
-
-        self.cache[filename] = (mtime, hash)
-        values['h'] = hash
 
 class IntListConverter(werkzeug.routing.BaseConverter):
     def to_python(self, value):
@@ -170,11 +158,15 @@ def create_app():
     app.add_template_filter(duration_filter, 'duration')
     app.add_template_filter(avatar_filter, 'avatar')
 
+    if app.config['TEMPLATE_CACHE']:
+        app.jinja_options['bytecode_cache'] = \
+            jinja2.FileSystemBytecodeCache(app.config['TEMPLATE_CACHE'])
     app.jinja_options['trim_blocks'] = True
     app.jinja_options['lstrip_blocks'] = True
     app.jinja_env.policies["json.dumps_kwargs"] = { 'default': json_default }
     app.jinja_env.globals.update(zip=zip)
     app.jinja_env.globals.update(wlt_class=wlt_class)
+    app.jinja_env.globals.update(next_cursor=get_next_cursor)
     app.jinja_env.add_extension('jinja2.ext.do')
     app.jinja_env.add_extension('jinja2.ext.i18n')
     app.jinja_env.install_null_translations(newstyle=True)
@@ -187,3 +179,28 @@ def create_app():
     metrics_extension.init_app(app)
 
     return app
+
+def warmup(app):
+    """Prepare an app to serve requests
+
+    This should be called in the uWSGI master before it forks any workers. Templates are compiled,
+    and in-memory tables are loaded, so each worker shares them instead of doing this itself on its
+    first requests.
+
+    :param app: The app to warm up
+    :type app: flask.Flask
+    """
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    try:
+        with app.test_request_context():
+            get_dimensions()
+            get_player_index()
+    except Exception:
+        app.logger.exception("Could not load in-memory tables; they will be loaded by each worker")
+    finally:
+        # Connections may not be shared with the workers
+        with app.app_context():
+            get_pool().close()
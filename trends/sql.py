@@ -2,29 +2,45 @@
 # Copyright (C) 2020 Sean Anderson <seanga2@gmail.com>
 
 import contextlib
+import contextvars
+import io
 import logging
 import os
+import re
 import sys
 
+from mpmetrics import Histogram
 import psycopg2, psycopg2.extras
 from sentry_sdk import Hub, tracing_utils
 
 from .steamid import SteamID
+from .util import classes
 
-tracing_disabled = False
+tracing_disabled = contextvars.ContextVar('tracing_disabled', default=False)
 
 @contextlib.contextmanager
 def disable_tracing():
-    global tracing_disabled
-    tracing_disabled = True
-    yield
-    tracing_disabled = False
+    """Don't trace queries executed in the current context"""
+    token = tracing_disabled.set(True)
+    try:
+        yield
+    finally:
+        tracing_disabled.reset(token)
+
+db_query_time = Histogram('db_query_seconds',
+                          "Time spent executing queries outside of sampled transactions")
 
 class TracingCursor(psycopg2.extras.DictCursor):
     def _log(self, query, vars, paramstyle=psycopg2.paramstyle):
-        if tracing_disabled:
+        if tracing_disabled.get():
             return contextlib.nullcontext()
-        return tracing_utils.record_sql_queries(Hub.current, self, query, vars,
+
+        # Formatting the query is expensive, so don't bother unless the span will be sent
+        hub = Hub.current
+        span = hub.scope.span
+        if span is None or not span.sampled:
+            return db_query_time.time()
+        return tracing_utils.record_sql_queries(hub, self, query, vars,
                                                 paramstyle, False)
 
     def execute(self, query, vars=None):
@@ -35,10 +51,12 @@ class TracingCursor(psycopg2.extras.DictCursor):
         with self._log(procname, vars, paramstyle=None):
             super().callproc(procname, vars)
 
-def db_connect(url, name=None):
+def db_connect(url, name=None, **kwargs):
     """Setup a database connection
 
     :param str url: Database to connect to
+    :param str name: The application name to connect with
+    :param kwargs: Additional connection parameters
     :return: A database connection
     :rtype: sqlite.Connection
     """
@@ -47,34 +65,110 @@ def db_connect(url, name=None):
     psycopg2.extensions.register_adapter(SteamID, psycopg2.extensions.AsIs)
     psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
     return psycopg2.connect(url, cursor_factory=TracingCursor,
-                            application_name=name or " ".join(sys.argv))
+                            application_name=name or " ".join(sys.argv), **kwargs)
+
+@contextlib.contextmanager
+def no_wait_callback():
+    """Temporarily unregister the wait callback, since psycopg2 doesn't support COPY with it"""
+    callback = psycopg2.extensions.get_wait_callback()
+    psycopg2.extensions.set_wait_callback(None)
+    try:
+        yield
+    finally:
+        psycopg2.extensions.set_wait_callback(callback)
+
+def copy_value(value):
+    if value is None:
+        return r"\N"
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (list, tuple)):
+        return "{{{}}}".format(",".join("NULL" if val is None else str(val) for val in value))
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n') \
+                     .replace('\r', '\\r')
+
+def copy_rows(cur, table, columns, rows):
+    """Bulk load rows into a table using COPY
+
+    Arrays are only supported if they contain numbers.
+
+    :param cur: The cursor to copy with
+    :param str table: The table to copy into
+    :param columns: The columns present in each row
+    :type columns: sequence of str
+    :param rows: The rows to copy
+    :type rows: iterable of sequences
+    :return: The number of rows copied
+    :rtype: int
+    """
+
+    buf = io.StringIO()
+    count = 0
+    for row in rows:
+        buf.write("\t".join(copy_value(value) for value in row))
+        buf.write("\n")
+        count += 1
+    buf.seek(0)
+
+    with no_wait_callback():
+        cur.copy_expert("COPY {} ({}) FROM STDIN;".format(table, ", ".join(columns)), buf)
+    return count
 
 def db_schema(cur):
     with open("{}/schema.sql".format(os.path.dirname(__file__))) as schema:
         cur.execute(schema.read())
 
-def _db_init(cur):
-    # Create new partitions for log_json, if there is anything in the default partition
-    cur.execute("SELECT max(logid)/100000 FROM log_json_default")
-    max_part = cur.fetchone()[0]
-    if max_part is None:
+# Number of logids in each log_json partition
+PARTITION_SIZE = 100000
+
+def partition_name(i):
+    return f"log_json_{i:#02}e5"
+
+def db_init(c):
+    """Check that the database is ready for use
+
+    This runs every time we connect, so it only does constant-time checks. Partitions are managed
+    by :func:`create_partitions`.
+
+    :param c: The database connection
+    """
+
+    cur = c.cursor()
+    cur.execute("SELECT EXISTS (SELECT * FROM log_json_default);")
+    if cur.fetchone()[0]:
+        logging.warning("log_json_default is not empty; partitions need to be created")
+
+    cur.execute("SELECT max(logid) FROM log;")
+    max_logid = cur.fetchone()[0] or 0
+    cur.execute("SELECT to_regclass(%s);", (partition_name(max_logid // PARTITION_SIZE + 1),))
+    if cur.fetchone()[0] is None:
+        logging.warning("Partitions need to be created for upcoming logs")
+
+def set_default_minimum(cur, minimum):
+    cur.execute("""ALTER TABLE log_json_default
+                   ADD CONSTRAINT new_minimum CHECK (logid >= %s);""", (minimum,))
+    cur.execute("ALTER TABLE log_json_default DROP CONSTRAINT minimum;")
+    cur.execute("ALTER TABLE log_json_default RENAME CONSTRAINT new_minimum TO minimum;")
+
+def split_default(cur, existing):
+    # Move anything in the default partition into its own partition
+    cur.execute("""SELECT
+                       min(logid) / %(size)s,
+                       max(logid) / %(size)s
+                   FROM log_json_default;""", { 'size': PARTITION_SIZE })
+    min_part, max_part = cur.fetchone()
+    if min_part is None:
         return
 
-    for i in range(max_part + 1):
-        tbl = f"log_json_{i:#02}e5"
-        cur.execute("BEGIN;")
-        try:
-            cur.execute("SELECT %s::regclass;", (tbl,))
-        except psycopg2.Error:
-            cur.execute("ROLLBACK;")
-        else:
-            cur.execute("COMMIT;")
+    for i in range(min_part, max_part + 1):
+        if i in existing:
             continue
 
+        tbl = partition_name(i)
         cur.execute("BEGIN;")
-        lower = i * 1e5
-        upper = (i + 1) * 1e5
-        logging.info("Creating partition %s", tbl)
+        lower = i * PARTITION_SIZE
+        upper = (i + 1) * PARTITION_SIZE
+        logging.info("Creating partition %s from log_json_default", tbl)
 
         cur.execute(f"CREATE TABLE {tbl} (LIKE log_json);")
         cur.execute(f"ALTER TABLE {tbl} ADD CHECK (logid >= %s AND logid < %s);", (lower, upper))
@@ -85,20 +179,57 @@ def _db_init(cur):
                         ORDER BY logid;""", (lower, upper));
         cur.execute(f"ANALYZE {tbl};")
         cur.execute(f"DELETE FROM log_json_default WHERE logid IN (SELECT logid FROM {tbl});")
-        cur.execute("""ALTER TABLE log_json_default
-                       ADD CONSTRAINT new_minimum CHECK (logid >= %s);""", (upper,))
-        cur.execute("ALTER TABLE log_json_default DROP CONSTRAINT minimum;")
-        cur.execute("ALTER TABLE log_json_default RENAME CONSTRAINT new_minimum TO minimum;")
+        set_default_minimum(cur, upper)
         cur.execute(f"""ALTER TABLE log_json
                         ATTACH PARTITION {tbl}
                             FOR VALUES FROM (%s) TO (%s);""", (lower, upper))
         cur.execute("COMMIT;")
+        existing.add(i)
+
+def create_partitions(c, ahead=2):
+    """Create log_json partitions
+
+    Any logs in the default partition are moved into new partitions. Then, empty partitions are
+    created for upcoming logs, so that new logs never get inserted into the default partition.
+
+    :param c: The database connection
+    :param int ahead: The number of partitions to create past the newest log
+    """
 
-def db_init(c):
     cur = c.cursor()
     cur.execute("SELECT pg_advisory_lock(0);")
     try:
-        _db_init(cur)
+        cur.execute("""SELECT
+                           relname
+                       FROM pg_inherits
+                       JOIN pg_class ON (pg_class.oid = inhrelid)
+                       WHERE inhparent = 'log_json'::regclass;""")
+        existing = set()
+        for row in cur:
+            if match := re.fullmatch(r"log_json_(\d+)e5", row[0]):
+                existing.add(int(match[1]))
+
+        split_default(cur, existing)
+
+        cur.execute("SELECT max(logid) FROM log;")
+        max_part = (cur.fetchone()[0] or 0) // PARTITION_SIZE + ahead
+        missing = [i for i in range(max_part + 1) if i not in existing]
+        if not missing:
+            return
+
+        cur.execute("BEGIN;")
+        for i in missing:
+            logging.info("Creating partition %s", partition_name(i))
+            cur.execute(f"""CREATE TABLE {partition_name(i)}
+                            PARTITION OF log_json
+                            FOR VALUES FROM (%s) TO (%s);""",
+                        (i * PARTITION_SIZE, (i + 1) * PARTITION_SIZE))
+
+        # Nothing can be in the default partition below the last partition
+        cur.execute("SELECT EXISTS (SELECT * FROM log_json_default);")
+        if not cur.fetchone()[0]:
+            set_default_minimum(cur, (max(existing | set(missing)) + 1) * PARTITION_SIZE)
+        cur.execute("COMMIT;")
     finally:
         cur.execute("SELECT pg_advisory_unlock(0);")
 
@@ -144,6 +275,557 @@ def publicize(c, tables):
     for table in tables[::-1]:
         cur.execute("""DELETE FROM {};""".format(table[0]))
 
+# Same as player_stats.primary_classid, for use with player_stats_backing
+primary_classid = """CASE
+                         WHEN class_durations[1] * 1.5 > array_sum(class_durations)
+                             THEN classids[1]
+                     END"""
+
+def update_class_summary(cur, schema, logids, sign=1, target='public'):
+    """Add logs to (or remove logs from) ``player_class_summary``
+
+    Logs which change after they are summarized (e.g. when their league changes) must be removed
+    before the change and added back afterwards.
+
+    :param cur: The database cursor
+    :param str schema: The schema containing the ``log``, ``player_stats_backing``, and
+                       ``class_stats`` tables to summarize, e.g. ``pg_temp`` when importing
+    :param str logids: A query selecting the logids to summarize
+    :param int sign: ``1`` to add logs, or ``-1`` to remove them
+    :param str target: The schema containing the summary to update
+    """
+
+    cur.execute(f"""INSERT INTO {target}.player_class_summary AS summary
+                    SELECT
+                        playerid,
+                        classid,
+                        formatid,
+                        league,
+                        %(sign)s * count(*),
+                        %(sign)s * count(*) FILTER (WHERE mostly AND wins > losses),
+                        %(sign)s * count(*) FILTER (WHERE mostly AND wins < losses),
+                        %(sign)s * count(*) FILTER (WHERE mostly AND wins = losses),
+                        %(sign)s * sum(duration),
+                        %(sign)s * sum(dmg),
+                        %(sign)s * coalesce(sum(hits), 0),
+                        %(sign)s * coalesce(sum(shots), 0)
+                    FROM (SELECT
+                            playerid,
+                            classid,
+                            formatid,
+                            league,
+                            classid = {primary_classid} AS mostly,
+                            ps.wins,
+                            ps.losses,
+                            cs.duration,
+                            cs.dmg,
+                            cs.hits,
+                            cs.shots
+                        FROM {schema}.log
+                        JOIN {schema}.player_stats_backing AS ps USING (logid)
+                        JOIN {schema}.class_stats AS cs USING (logid, playerid)
+                        WHERE log.duplicate_of ISNULL
+                            AND logid IN ({logids})
+                    ) AS classes
+                    GROUP BY playerid, classid, formatid, league
+                    ORDER BY playerid, classid, formatid, league
+                    ON CONFLICT (playerid, classid, formatid, league) DO UPDATE SET
+                        logs = summary.logs + EXCLUDED.logs,
+                        wins = summary.wins + EXCLUDED.wins,
+                        losses = summary.losses + EXCLUDED.losses,
+                        ties = summary.ties + EXCLUDED.ties,
+                        duration = summary.duration + EXCLUDED.duration,
+                        dmg = summary.dmg + EXCLUDED.dmg,
+                        hits = summary.hits + EXCLUDED.hits,
+                        shots = summary.shots + EXCLUDED.shots;""", { 'sign': sign })
+
+    if sign < 0:
+        cur.execute(f"""DELETE FROM {target}.player_class_summary
+                        WHERE logs = 0
+                            AND playerid IN (SELECT
+                                    playerid
+                                FROM {schema}.player_stats_backing
+                                WHERE logid IN ({logids})
+                            );""")
+
+def update_peer_summary(cur, schema, logids, sign=1, target='public'):
+    """Add logs to (or remove logs from) ``player_peer``
+
+    See :func:`update_class_summary` for details.
+
+    :param cur: The database cursor
+    :param str schema: The schema containing the ``log``, ``player_stats_backing``, and
+                       ``heal_stats`` tables to summarize
+    :param str logids: A query selecting the logids to summarize
+    :param int sign: ``1`` to add logs, or ``-1`` to remove them
+    :param str target: The schema containing the summary to update
+    """
+
+    cur.execute(f"""INSERT INTO {target}.player_peer AS summary
+                    SELECT
+                        playerid,
+                        peerid,
+                        formatid,
+                        league,
+                        %(sign)s * count(*) FILTER (WHERE teammate),
+                        %(sign)s * count(*) FILTER (WHERE NOT teammate),
+                        %(sign)s * count(*) FILTER (WHERE teammate AND wins > losses),
+                        %(sign)s * count(*) FILTER (WHERE teammate AND wins = losses),
+                        %(sign)s * count(*) FILTER (WHERE NOT teammate AND wins > losses),
+                        %(sign)s * count(*) FILTER (WHERE NOT teammate AND wins = losses),
+                        %(sign)s * coalesce(sum(duration) FILTER (WHERE teammate), 0),
+                        %(sign)s * coalesce(sum(duration) FILTER (WHERE NOT teammate), 0),
+                        %(sign)s * coalesce(sum(dmg) FILTER (WHERE teammate), 0),
+                        %(sign)s * coalesce(sum(dt) FILTER (WHERE teammate), 0),
+                        %(sign)s * count(dt) FILTER (WHERE teammate),
+                        %(sign)s * coalesce(sum(healing_to) FILTER (WHERE teammate), 0),
+                        %(sign)s * count(healing_to) FILTER (WHERE teammate),
+                        %(sign)s * coalesce(sum(healing_from) FILTER (WHERE teammate), 0),
+                        %(sign)s * count(healing_from) FILTER (WHERE teammate)
+                    FROM (SELECT
+                            p1.playerid,
+                            p2.playerid AS peerid,
+                            log.formatid,
+                            log.league,
+                            p1.team = p2.team AS teammate,
+                            p1.wins,
+                            p1.losses,
+                            log.duration,
+                            p1.dmg,
+                            p1.dt,
+                            hs1.healing AS healing_to,
+                            hs2.healing AS healing_from
+                        FROM {schema}.log
+                        JOIN {schema}.player_stats_backing AS p1 USING (logid)
+                        JOIN {schema}.player_stats_backing AS p2 USING (logid)
+                        LEFT JOIN {schema}.heal_stats AS hs1 ON (
+                            hs1.logid = log.logid
+                            AND hs1.healer = p1.playerid
+                            AND hs1.healee = p2.playerid
+                        ) LEFT JOIN {schema}.heal_stats AS hs2 ON (
+                            hs2.logid = log.logid
+                            AND hs2.healer = p2.playerid
+                            AND hs2.healee = p1.playerid
+                        ) WHERE log.duplicate_of ISNULL
+                            AND log.logid IN ({logids})
+                            AND p2.playerid != p1.playerid
+                    ) AS peers
+                    GROUP BY playerid, peerid, formatid, league
+                    ORDER BY playerid, peerid, formatid, league
+                    ON CONFLICT (playerid, peerid, formatid, league) DO UPDATE SET
+                        logs_with = summary.logs_with + EXCLUDED.logs_with,
+                        logs_against = summary.logs_against + EXCLUDED.logs_against,
+                        wins_with = summary.wins_with + EXCLUDED.wins_with,
+                        ties_with = summary.ties_with + EXCLUDED.ties_with,
+                        wins_against = summary.wins_against + EXCLUDED.wins_against,
+                        ties_against = summary.ties_against + EXCLUDED.ties_against,
+                        duration_with = summary.duration_with + EXCLUDED.duration_with,
+                        duration_against = summary.duration_against + EXCLUDED.duration_against,
+                        dmg_with = summary.dmg_with + EXCLUDED.dmg_with,
+                        dt_with = summary.dt_with + EXCLUDED.dt_with,
+                        dt_logs = summary.dt_logs + EXCLUDED.dt_logs,
+                        healing_to = summary.healing_to + EXCLUDED.healing_to,
+                        healing_to_logs = summary.healing_to_logs + EXCLUDED.healing_to_logs,
+                        healing_from = summary.healing_from + EXCLUDED.healing_from,
+                        healing_from_logs =
+                            summary.healing_from_logs + EXCLUDED.healing_from_logs;""",
+                { 'sign': sign })
+
+    if sign < 0:
+        cur.execute(f"""DELETE FROM {target}.player_peer
+                        WHERE logs_with = 0
+                            AND logs_against = 0
+                            AND playerid IN (SELECT
+                                    playerid
+                                FROM {schema}.player_stats_backing
+                                WHERE logid IN ({logids})
+                            );""")
+
+def update_player_search(cur, schema, logids, sign=1, target='public'):
+    """Add logs to (or remove logs from) ``player_search``
+
+    See :func:`update_class_summary` for details.
+
+    :param cur: The database cursor
+    :param str schema: The schema containing the ``log`` and ``player_stats_backing`` tables to
+                       summarize
+    :param str logids: A query selecting the logids to summarize
+    :param int sign: ``1`` to add logs, or ``-1`` to remove them
+    :param str target: The schema containing the summary to update
+    """
+
+    cur.execute(f"""INSERT INTO {target}.player_search AS summary
+                    SELECT
+                        playerid,
+                        nameid,
+                        lower(name),
+                        %(sign)s * count(*)
+                    FROM {schema}.log
+                    JOIN {schema}.player_stats_backing AS ps USING (logid)
+                    JOIN name USING (nameid)
+                    WHERE log.duplicate_of ISNULL
+                        AND logid IN ({logids})
+                    GROUP BY playerid, nameid, name
+                    ORDER BY playerid, nameid
+                    ON CONFLICT (playerid, nameid) DO UPDATE
+                    SET logs = summary.logs + EXCLUDED.logs;""", { 'sign': sign })
+
+    if sign < 0:
+        cur.execute(f"""DELETE FROM {target}.player_search
+                        WHERE logs = 0
+                            AND playerid IN (SELECT
+                                    playerid
+                                FROM {schema}.player_stats_backing
+                                WHERE logid IN ({logids})
+                            );""")
+
+def update_cube(cur, table, keys, columns, source, schema, logids, sign=1, target='public',
+                cube=()):
+    """Add logs to (or remove logs from) a per-player cube
+
+    Cubes are summaries which have a ``logs`` column, and which are keyed on ``playerid`` (among
+    other things).
+
+    :param cur: The database cursor
+    :param str table: The cube to update
+    :param keys: The key columns of the cube
+    :type keys: sequence of str
+    :param columns: The remaining columns of the cube, and the aggregates which calculate them
+    :type columns: dict of str to str
+    :param str source: A query selecting the rows to aggregate. It is formatted with ``schema``
+                       and ``logids``.
+    :param str schema: The schema containing the tables to summarize
+    :param str logids: A query selecting the logids to summarize
+    :param int sign: ``1`` to add logs, or ``-1`` to remove them
+    :param str target: The schema containing the cube to update
+    :param cube: Key columns to also roll up, as with ``GROUP BY CUBE``. The cube must have an
+                 additional ``grouping_id`` key column holding ``GROUPING()`` of these columns, so
+                 that rollups are kept apart from rows where these columns are really ``NULL``.
+    :type cube: sequence of str
+    """
+
+    group = select = ", ".join(keys)
+    if cube:
+        rollups = ", ".join(cube)
+        group = ", ".join((*(key for key in keys if key not in cube), f"CUBE ({rollups})"))
+        select += f", GROUPING({rollups}) AS grouping_id"
+        keys = (*keys, 'grouping_id')
+
+    keys = ", ".join(keys)
+    aggregates = ", ".join(f"%(sign)s * {agg} AS {col}" for col, agg in columns.items())
+    set_clause = ", ".join(f"{col} = summary.{col} + EXCLUDED.{col}" for col in columns)
+    source = source.format(schema=schema, logids=logids)
+
+    cur.execute(f"""INSERT INTO {target}.{table} AS summary ({keys}, {", ".join(columns)})
+                    SELECT {select}, {aggregates}
+                    FROM ({source}) AS source
+                    GROUP BY {group}
+                    ORDER BY {keys}
+                    ON CONFLICT ({keys}) DO UPDATE
+                    SET {set_clause};""", { 'sign': sign })
+
+    if sign < 0:
+        cur.execute(f"""DELETE FROM {target}.{table}
+                        WHERE logs = 0
+                            AND playerid IN (SELECT
+                                    playerid
+                                FROM {schema}.player_stats_backing
+                                WHERE logid IN ({logids})
+                            );""")
+
+def update_player_cube(cur, schema, logids, sign=1, target='public'):
+    """Add logs to (or remove logs from) ``player_cube`` and its weapon and event sub-cubes
+
+    See :func:`update_class_summary` for details.
+
+    :param cur: The database cursor
+    :param str schema: The schema containing the log tables to summarize
+    :param str logids: A query selecting the logids to summarize
+    :param int sign: ``1`` to add logs, or ``-1`` to remove them
+    :param str target: The schema containing the summary to update
+    """
+
+    update_cube(cur, 'player_cube',
+                ('playerid', 'league', 'formatid', 'primary_classid', 'mapid'), {
+                    'logs': "count(*)",
+                    'wins': "count(*) FILTER (WHERE wins > losses)",
+                    'losses': "count(*) FILTER (WHERE wins < losses)",
+                    'ties': "count(*) FILTER (WHERE wins = losses)",
+                    'round_wins': "sum(wins)",
+                    'round_losses': "sum(losses)",
+                    'round_ties': "sum(ties)",
+                    'duration': "sum(duration)",
+                    **{ col: f"coalesce(sum({col}), 0)" for col in (
+                        'kills', 'deaths', 'assists', 'dmg', 'dt', 'hits', 'shots', 'hr',
+                        'airshots', 'medkits', 'medkits_hp', 'backstabs', 'headshots',
+                        'headshots_hit', 'sentries', 'cpc', 'ic', 'healing', 'ubers', 'drops',
+                        'advantages_lost', 'deaths_after_uber', 'deaths_before_uber',
+                    )},
+                }, f"""SELECT
+                        playerid,
+                        league,
+                        formatid,
+                        {primary_classid} AS primary_classid,
+                        mapid,
+                        ps.wins,
+                        ps.losses,
+                        ps.ties,
+                        log.duration,
+                        ps.kills,
+                        ps.deaths,
+                        ps.assists,
+                        ps.dmg,
+                        ps.dt,
+                        ps.hits,
+                        ps.shots,
+                        pse.hr,
+                        pse.airshots,
+                        pse.medkits,
+                        pse.medkits_hp,
+                        pse.backstabs,
+                        pse.headshots,
+                        pse.headshots_hit,
+                        pse.sentries,
+                        pse.cpc,
+                        pse.ic,
+                        hs.healing,
+                        ms.ubers,
+                        ms.drops,
+                        ms.advantages_lost,
+                        ms.deaths_after_uber,
+                        ms.deaths_before_uber
+                    FROM {{schema}}.log
+                    JOIN {{schema}}.player_stats_backing AS ps USING (logid)
+                    LEFT JOIN {{schema}}.player_stats_extra AS pse USING (logid, playerid)
+                    LEFT JOIN {{schema}}.medic_stats AS ms USING (logid, playerid)
+                    LEFT JOIN (SELECT
+                            logid,
+                            healer AS playerid,
+                            sum(healing) AS healing
+                        FROM {{schema}}.heal_stats
+                        WHERE logid IN ({{logids}})
+                        GROUP BY logid, healer
+                    ) AS hs USING (logid, playerid)
+                    WHERE log.duplicate_of ISNULL
+                        AND logid IN ({{logids}})""", schema, logids, sign, target)
+
+    update_cube(cur, 'player_weapon_cube',
+                ('playerid', 'league', 'formatid', 'classid', 'mapid', 'weaponid'), {
+                    'logs': "count(*)",
+                    'kills': "sum(kills)",
+                    'duration': "sum(duration)",
+                    'dmg': "coalesce(sum(dmg), 0)",
+                    'dmg_logs': "count(dmg)",
+                    'shots': "coalesce(sum(shots), 0)",
+                    'hits': "coalesce(sum(hits), 0)",
+                    'shots_logs': "count(shots)",
+                    'dmg_shot': "coalesce(sum(dmg) FILTER (WHERE shots::BOOL), 0)",
+                    'dmg_shot_logs': "count(dmg) FILTER (WHERE shots::BOOL)",
+                    'dmg_hit': "coalesce(sum(dmg) FILTER (WHERE hits::BOOL), 0)",
+                    'dmg_hit_logs': "count(dmg) FILTER (WHERE hits::BOOL)",
+                }, """SELECT
+                        playerid,
+                        league,
+                        formatid,
+                        classid,
+                        mapid,
+                        weaponid,
+                        ws.kills,
+                        cs.duration,
+                        ws.dmg,
+                        ws.shots,
+                        ws.hits
+                    FROM {schema}.log
+                    JOIN {schema}.weapon_stats AS ws USING (logid)
+                    JOIN {schema}.class_stats AS cs USING (logid, playerid, classid)
+                    WHERE log.duplicate_of ISNULL
+                        AND logid IN ({logids})""", schema, logids, sign, target)
+
+    event_columns = ", ".join(f"es.{cls}" for cls in classes)
+    update_cube(cur, 'player_event_cube',
+                ('playerid', 'league', 'formatid', 'primary_classid', 'mapid', 'eventid'), {
+                    'logs': "count(*)",
+                    **{ cls: f"sum({cls})" for cls in classes },
+                }, f"""SELECT
+                        playerid,
+                        league,
+                        formatid,
+                        {primary_classid} AS primary_classid,
+                        mapid,
+                        eventid,
+                        {event_columns}
+                    FROM {{schema}}.log
+                    JOIN {{schema}}.player_stats_backing AS ps USING (logid)
+                    JOIN {{schema}}.event_stats AS es USING (logid, playerid)
+                    WHERE log.duplicate_of ISNULL
+                        AND logid IN ({{logids}})""", schema, logids, sign, target)
+
+def update_leaderboard_cube(cur, schema, logids, sign=1, target='public'):
+    """Add logs to (or remove logs from) ``leaderboard_cube``
+
+    See :func:`update_class_summary` for details.
+
+    :param cur: The database cursor
+    :param str schema: The schema containing the ``log`` and ``player_stats_backing`` tables to
+                       summarize
+    :param str logids: A query selecting the logids to summarize
+    :param int sign: ``1`` to add logs, or ``-1`` to remove them
+    :param str target: The schema containing the summary to update
+    """
+
+    update_cube(cur, 'leaderboard_cube', ('playerid', 'league', 'formatid', 'classid', 'mapid'), {
+                    'logs': "count(*)",
+                    'duration': "sum(duration)",
+                    'wins': "count(*) FILTER (WHERE wins > losses)",
+                    'ties': "count(*) FILTER (WHERE wins = losses)",
+                    'losses': "count(*) FILTER (WHERE wins < losses)",
+                    'kills': "sum(kills)",
+                    'deaths': "sum(deaths)",
+                    'assists': "sum(assists)",
+                    'dmg': "sum(dmg)",
+                    'dt': "coalesce(sum(dt), 0)",
+                    'dt_logs': "count(dt)",
+                    'shots': "coalesce(sum(shots), 0)",
+                    'hits': "coalesce(sum(hits), 0)",
+                }, f"""SELECT
+                        playerid,
+                        league,
+                        formatid,
+                        {primary_classid} AS classid,
+                        mapid,
+                        log.duration,
+                        ps.wins,
+                        ps.losses,
+                        ps.kills,
+                        ps.deaths,
+                        ps.assists,
+                        ps.dmg,
+                        ps.dt,
+                        ps.shots,
+                        ps.hits
+                    FROM {{schema}}.log
+                    JOIN {{schema}}.player_stats_backing AS ps USING (logid)
+                    WHERE log.duplicate_of ISNULL
+                        AND logid IN ({{logids}})""", schema, logids, sign, target,
+                cube=('league', 'formatid', 'classid', 'mapid'))
+
+# Leaderboard columns, calculated from the sums of leaderboard_cube cells
+leaderboard_metrics = {
+    'duration': "sum(duration)",
+    'logs': "sum(wins + losses + ties)",
+    'winrate': "sum(0.5 * ties + wins) / sum(wins + losses + ties)",
+    'rating': "(50 + sum(0.5 * ties + wins)) / (100 + sum(wins + losses + ties))",
+    'k30': "sum(kills) * 30.0 * 60 / nullif(sum(duration), 0)",
+    'd30': "sum(deaths) * 30.0 * 60 / nullif(sum(duration), 0)",
+    'a30': "sum(assists) * 30.0 * 60 / nullif(sum(duration), 0)",
+    'kd': "sum(kills) * 1.0 / nullif(sum(deaths), 0)",
+    'kad': "(sum(kills) + sum(assists)) * 1.0 / nullif(sum(deaths), 0)",
+    'dpm': "sum(dmg) * 60.0 / nullif(sum(duration), 0)",
+    'dtm': """CASE WHEN sum(dt_logs) > 0 THEN
+                  sum(dt) * 60.0 / nullif(sum(duration), 0)
+              END""",
+    'ddm': """CASE WHEN sum(dt_logs) > 0 THEN
+                  (sum(dmg) - sum(dt)) * 60.0 / nullif(sum(duration), 0)
+              END""",
+    'dr': "sum(dmg) * 1.0 / nullif(sum(dt), 0)",
+    'acc': "sum(hits) * 1.0 / nullif(sum(shots), 0)",
+}
+
+def update_leaderboard_ranks(cur):
+    """Recompute ``leaderboard_rank`` from ``leaderboard_cube``
+
+    Unlike the other summaries, this cannot be updated incrementally, since adding a log may move
+    a player anywhere in the rankings.
+
+    :param cur: The database cursor
+    """
+
+    cur.execute("DELETE FROM leaderboard_rank;")
+    for sort, metric in leaderboard_metrics.items():
+        cur.execute(f"""INSERT INTO leaderboard_rank
+                            (league, formatid, classid, grouping_id, sort, players, nonnull)
+                        SELECT
+                            league,
+                            formatid,
+                            classid,
+                            grouping_id,
+                            %(sort)s,
+                            array_agg(playerid ORDER BY metric DESC NULLS LAST, playerid),
+                            count(metric)
+                        FROM (SELECT
+                                playerid,
+                                league,
+                                formatid,
+                                classid,
+                                grouping_id,
+                                {metric} AS metric
+                            FROM leaderboard_cube
+                            -- Maps are not ranked
+                            WHERE grouping_id & 1 = 1
+                            GROUP BY playerid, league, formatid, classid, grouping_id
+                        ) AS cell
+                        GROUP BY league, formatid, classid, grouping_id;""", { 'sort': sort })
+        logging.info("Ranked players by %s", sort)
+
+def update_summaries(cur, schema, logids, sign=1, target='public'):
+    """Add logs to (or remove logs from) all per-player summaries
+
+    :param cur: The database cursor
+    :param str schema: The schema containing the tables to summarize
+    :param str logids: A query selecting the logids to summarize
+    :param int sign: ``1`` to add logs, or ``-1`` to remove them
+    :param str target: The schema containing the summaries to update
+    """
+
+    update_class_summary(cur, schema, logids, sign, target)
+    update_peer_summary(cur, schema, logids, sign, target)
+    update_player_search(cur, schema, logids, sign, target)
+    update_player_cube(cur, schema, logids, sign, target)
+    update_leaderboard_cube(cur, schema, logids, sign, target)
+    if target == 'public':
+        update_player_versions(cur, schema, logids)
+
+def update_player_versions(cur, schema, logids):
+    """Bump the versions of players in some logs, so their cached pages are invalidated
+
+    :param cur: The database cursor
+    :param str schema: The schema containing the ``player_stats_backing`` table
+    :param str logids: A query selecting the modified logids
+    """
+
+    cur.execute(f"""UPDATE player
+                    SET version = nextval('log_version')
+                    WHERE playerid IN (SELECT
+                            playerid
+                        FROM {schema}.player_stats_backing
+                        WHERE logid IN ({logids})
+                    );""")
+
+# Tables updated by update_summaries
+summary_tables = ('player_class_summary', 'player_peer', 'player_search', 'player_cube',
+                  'player_weapon_cube', 'player_event_cube', 'leaderboard_cube')
+
+def summarize_all(cur, target='public', update=update_summaries):
+    """Add all logs to the summaries
+
+    This is done one partition at a time, to limit the size of each aggregate.
+
+    :param cur: The database cursor
+    :param str target: The schema containing the (empty) summaries to update
+    :param update: The function used to update the summaries. This may be e.g.
+                   :py:func:`update_class_summary` to rebuild just one summary.
+    """
+
+    cur.execute("SELECT min(logid), max(logid) FROM log;")
+    first, last = cur.fetchone()
+    for i in range(first or 0, (last or 0) + 1, PARTITION_SIZE):
+        update(cur, 'public', f"""SELECT logid
+                                  FROM log
+                                  WHERE logid >= {i}
+                                      AND logid < {i + PARTITION_SIZE}""",
+               target=target)
+        logging.info("Summarized logs %s to %s", i, i + PARTITION_SIZE - 1)
+
 def table_columns(c, table):
     cur = c.cursor()
     cur.execute("""SELECT